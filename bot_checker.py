@@ -3,13 +3,15 @@
 Если клиент подключил бота - уведомления идут через бота
 Если нет - через userbot (аккаунт МЕСТО)
 """
+import asyncio
 import sqlite3
 import tempfile
 import os
 from typing import Optional
-import httpx
 
 from config import config
+from database import phone_key
+from http_clients import http_clients
 
 
 def normalize_phone(phone: str) -> str:
@@ -24,66 +26,145 @@ def normalize_phone(phone: str) -> str:
     return "+" + digits
 
 
-async def get_bot_client_chat_id(phone: str) -> Optional[int]:
+class BotMembershipIndex:
     """
-    Проверить, есть ли клиент в боте по номеру телефона.
-    Возвращает telegram_id если найден, None если нет.
+    Индекс клиентов бота в памяти: phone_key -> telegram_id.
+    Фоновая задача раз в BOT_DB_REFRESH_SECONDS делает условный GET
+    clients.db из S3 (If-None-Match / If-Modified-Since) и, если файл
+    изменился, собирает новый словарь и подменяет им старый целиком.
     """
-    if not config.S3_ACCESS_KEY or not config.S3_BUCKET:
-        return None
     
-    normalized = normalize_phone(phone)
+    BOT_DB_KEY = 'clients.db'
     
-    try:
-        # Скачиваем БД бота из S3
-        import boto3
-        from botocore.config import Config as BotoConfig
+    def __init__(self):
+        self._index = {}
+        self._etag: Optional[str] = None
+        self._last_modified = None
+        self._s3 = None
+        self._task: Optional[asyncio.Task] = None
+        self._refresh_lock = asyncio.Lock()
+        self.loaded = False
+    
+    @property
+    def enabled(self) -> bool:
+        return bool(config.S3_ACCESS_KEY and config.S3_BUCKET)
+    
+    def _client(self):
+        """S3 клиент (создаётся один раз)"""
+        if self._s3 is None:
+            import boto3
+            from botocore.config import Config as BotoConfig
+            
+            self._s3 = boto3.client(
+                's3',
+                endpoint_url=config.S3_ENDPOINT,
+                aws_access_key_id=config.S3_ACCESS_KEY,
+                aws_secret_access_key=config.S3_SECRET_KEY,
+                region_name='ru-1',
+                config=BotoConfig(signature_version='s3v4')
+            )
+        return self._s3
+    
+    def _download(self) -> Optional[dict]:
+        """
+        Скачать БД бота, если она изменилась (синхронно, в отдельном потоке).
+        Возвращает новый индекс или None, если файл не менялся.
+        """
         from botocore.exceptions import ClientError
         
-        s3 = boto3.client(
-            's3',
-            endpoint_url=config.S3_ENDPOINT,
-            aws_access_key_id=config.S3_ACCESS_KEY,
-            aws_secret_access_key=config.S3_SECRET_KEY,
-            region_name='ru-1',
-            config=BotoConfig(signature_version='s3v4')
-        )
+        params = {'Bucket': config.S3_BUCKET, 'Key': self.BOT_DB_KEY}
+        if self._etag:
+            params['IfNoneMatch'] = self._etag
+        if self._last_modified:
+            params['IfModifiedSince'] = self._last_modified
+        
+        try:
+            response = self._client().get_object(**params)
+        except ClientError as e:
+            status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+            if status == 304 or e.response.get('Error', {}).get('Code') in ('304', 'NotModified'):
+                return None
+            raise
         
-        # Скачиваем во временный файл
         with tempfile.NamedTemporaryFile(delete=False, suffix='.db') as tmp:
             tmp_path = tmp.name
+            for chunk in response['Body'].iter_chunks(1024 * 1024):
+                tmp.write(chunk)
         
-        s3.download_file(config.S3_BUCKET, 'clients.db', tmp_path)
-        
-        # Ищем клиента по телефону
-        conn = sqlite3.connect(tmp_path)
-        cursor = conn.cursor()
-        
-        # Пробуем разные форматы номера
-        phone_variants = [
-            normalized,
-            normalized[1:] if normalized.startswith('+') else normalized,
-            '8' + normalized[2:] if normalized.startswith('+7') else normalized,
-        ]
-        
-        for phone_var in phone_variants:
-            cursor.execute(
-                "SELECT telegram_id FROM clients WHERE phone_number LIKE ?",
-                (f"%{phone_var[-10:]}%",)
-            )
-            result = cursor.fetchone()
-            if result:
+        try:
+            conn = sqlite3.connect(tmp_path)
+            try:
+                rows = conn.execute("SELECT phone_number, telegram_id FROM clients").fetchall()
+            finally:
                 conn.close()
-                os.unlink(tmp_path)
-                return result[0]
+        finally:
+            os.unlink(tmp_path)
         
-        conn.close()
-        os.unlink(tmp_path)
-        return None
+        index = {}
+        for phone, telegram_id in rows:
+            key = phone_key(phone)
+            if key and telegram_id:
+                index[key] = telegram_id
         
-    except Exception as e:
-        print(f"Ошибка проверки клиента в боте: {e}")
-        return None
+        self._etag = response.get('ETag')
+        self._last_modified = response.get('LastModified')
+        return index
+    
+    async def refresh(self):
+        """Обновить индекс, если БД бота изменилась"""
+        if not self.enabled:
+            return
+        async with self._refresh_lock:
+            try:
+                index = await asyncio.to_thread(self._download)
+            except Exception as e:
+                print(f"Ошибка загрузки БД бота: {e}")
+                return
+            if index is not None:
+                self._index = index
+                print(f"🤖 Индекс клиентов бота обновлён: {len(index)}")
+            self.loaded = True
+    
+    async def _run(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(config.BOT_DB_REFRESH_SECONDS)
+    
+    def start(self):
+        """Запустить фоновое обновление"""
+        if self.enabled and (self._task is None or self._task.done()):
+            self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Остановить фоновое обновление"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def get(self, phone: str) -> Optional[int]:
+        """telegram_id клиента бота по телефону"""
+        if not self.enabled:
+            return None
+        if not self.loaded:
+            # Без фоновой задачи (скрипты) — загружаем при первом обращении
+            await self.refresh()
+        return self._index.get(phone_key(phone))
+
+
+# Синглтон
+bot_index = BotMembershipIndex()
+
+
+async def get_bot_client_chat_id(phone: str) -> Optional[int]:
+    """
+    Проверить, есть ли клиент в боте по номеру телефона.
+    Возвращает telegram_id если найден, None если нет.
+    """
+    return await bot_index.get(phone)
 
 
 async def send_via_bot(chat_id: int, text: str) -> bool:
@@ -92,16 +173,16 @@ async def send_via_bot(chat_id: int, text: str) -> bool:
         return False
     
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"https://api.telegram.org/bot{config.BOT_TOKEN}/sendMessage",
-                json={
-                    "chat_id": chat_id,
-                    "text": text,
-                    "parse_mode": "HTML"
-                }
-            )
-            return response.status_code == 200
+        client = http_clients.get("telegram_bot")
+        response = await client.post(
+            f"https://api.telegram.org/bot{config.BOT_TOKEN}/sendMessage",
+            json={
+                "chat_id": chat_id,
+                "text": text,
+                "parse_mode": "HTML"
+            }
+        )
+        return response.status_code == 200
     except Exception as e:
         print(f"Ошибка отправки через бота: {e}")
         return False
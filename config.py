@@ -14,34 +14,102 @@ class Config:
     TELEGRAM_PHONE = os.getenv("TELEGRAM_PHONE", "")
     TELEGRAM_SESSION_NAME = "yclients_reminder"
     
+    # Кэш номеров, которых нет в Telegram: повторная проверка через
+    # TELEGRAM_MISS_RECHECK_HOURS, затем интервал удваивается до максимума
+    TELEGRAM_MISS_RECHECK_HOURS = float(os.getenv("TELEGRAM_MISS_RECHECK_HOURS", 6))
+    TELEGRAM_MISS_RECHECK_MAX_HOURS = float(os.getenv("TELEGRAM_MISS_RECHECK_MAX_HOURS", 168))
+    
+    # Отправка сообщений: скорость (сообщ/сек) подстраивается между MIN и MAX по FloodWait
+    TELEGRAM_SEND_RATE = float(os.getenv("TELEGRAM_SEND_RATE", 1.0))
+    TELEGRAM_SEND_MIN_RATE = float(os.getenv("TELEGRAM_SEND_MIN_RATE", 0.1))
+    TELEGRAM_SEND_MAX_RATE = float(os.getenv("TELEGRAM_SEND_MAX_RATE", 2.0))
+    TELEGRAM_SEND_BURST = int(os.getenv("TELEGRAM_SEND_BURST", 3))
+    TELEGRAM_SEND_WORKERS = int(os.getenv("TELEGRAM_SEND_WORKERS", 2))
+    
+    # Outbox: доставка сообщений с повторными попытками
+    OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", 4))             # Параллельных доставок
+    OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 5))   # После — состояние dead
+    OUTBOX_RETRY_SECONDS = int(os.getenv("OUTBOX_RETRY_SECONDS", 60))  # Первая пауза, далее x2
+    OUTBOX_POLL_SECONDS = float(os.getenv("OUTBOX_POLL_SECONDS", 5))
+    OUTBOX_CLAIM_BATCH = int(os.getenv("OUTBOX_CLAIM_BATCH", 2))     # Сообщений за одно взятие воркером
+    RECORD_EVENT_COALESCE_SECONDS = int(os.getenv("RECORD_EVENT_COALESCE_SECONDS", 60))  # Склейка правок одной записи
+    
     # YClients
     YCLIENTS_PARTNER_TOKEN = os.getenv("YCLIENTS_PARTNER_TOKEN", "")
     YCLIENTS_USER_TOKEN = os.getenv("YCLIENTS_USER_TOKEN", "")
     YCLIENTS_COMPANY_ID = int(os.getenv("YCLIENTS_COMPANY_ID", 0))
     YCLIENTS_APP_ID = int(os.getenv("YCLIENTS_APP_ID", 36592))  # Application ID для чата
     YCLIENTS_API_URL = "https://api.yclients.com/api/v1"
+    YCLIENTS_PAGE_CONCURRENCY = int(os.getenv("YCLIENTS_PAGE_CONCURRENCY", 4))  # Страниц списка параллельно
+    YCLIENTS_HTTP_TIMEOUT = float(os.getenv("YCLIENTS_HTTP_TIMEOUT", 15))
+    YCLIENTS_HTTP_MAX_CONNECTIONS = int(os.getenv("YCLIENTS_HTTP_MAX_CONNECTIONS", 10))
+    RECORDS_WINDOW_DAYS = int(os.getenv("RECORDS_WINDOW_DAYS", 14))         # Окно снимка записей
+    RECORDS_SNAPSHOT_TTL = float(os.getenv("RECORDS_SNAPSHOT_TTL", 30))     # Секунд до повторной загрузки
+    SALON_TIMEZONE = os.getenv("SALON_TIMEZONE", "Europe/Moscow")           # Время записей без смещения
+    RECORDS_FULL_SYNC_MINUTES = int(os.getenv("RECORDS_FULL_SYNC_MINUTES", 15))  # Полная сверка (удалённые записи)
+    RECORDS_CURSOR_OVERLAP = int(os.getenv("RECORDS_CURSOR_OVERLAP", 120))       # Секунд запаса для changed_after
+    RECORDS_ARCHIVE_AFTER_HOURS = int(os.getenv("RECORDS_ARCHIVE_AFTER_HOURS", 24))  # Прошедшие записи -> archived
+    
+    # Адаптивный интервал polling (секунды)
+    POLL_MIN_SECONDS = int(os.getenv("POLL_MIN_SECONDS", 20))              # Когда записи меняются
+    POLL_MAX_SECONDS = int(os.getenv("POLL_MAX_SECONDS", 300))             # Когда изменений нет
+    POLL_RECONCILE_SECONDS = int(os.getenv("POLL_RECONCILE_SECONDS", 900)) # Когда webhook работает
+    POLL_BACKOFF = float(os.getenv("POLL_BACKOFF", 1.5))                   # Рост интервала за пустой опрос
+    WEBHOOK_HEALTHY_MINUTES = int(os.getenv("WEBHOOK_HEALTHY_MINUTES", 30))  # Webhook исправен, если события были за это время
     
     # Webhook
     WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
     WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", 8000))
     WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+    WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 4))                  # Воркеров разбора журнала webhook
+    WEBHOOK_JOURNAL_POLL_SECONDS = float(os.getenv("WEBHOOK_JOURNAL_POLL_SECONDS", 5))
+    CONVERSATION_FEED_POLL_SECONDS = float(os.getenv("CONVERSATION_FEED_POLL_SECONDS", 2))  # Сообщения из main.py (другой процесс)
+    CONVERSATION_FEED_KEEPALIVE = float(os.getenv("CONVERSATION_FEED_KEEPALIVE", 15))      # Пинг открытых виджетов
     
     # Telegram Bot (для клиентов которые подключили бота)
     BOT_TOKEN = os.getenv("BOT_TOKEN", "")
     BOT_USERNAME = os.getenv("BOT_USERNAME", "Mesto_yclients_bot")
+    BOT_API_HTTP_TIMEOUT = float(os.getenv("BOT_API_HTTP_TIMEOUT", 10))
+    BOT_API_HTTP_MAX_CONNECTIONS = int(os.getenv("BOT_API_HTTP_MAX_CONNECTIONS", 5))
+    
+    # HTTP/2 для внешних API (нужен пакет h2)
+    HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "false").lower() in ("1", "true", "yes")
     
     # S3 для проверки БД бота
     S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY", "")
     S3_SECRET_KEY = os.getenv("S3_SECRET_KEY", "")
     S3_BUCKET = os.getenv("S3_BUCKET", "")
     S3_ENDPOINT = os.getenv("S3_ENDPOINT", "https://s3.twcstorage.ru")
+    BOT_DB_REFRESH_SECONDS = int(os.getenv("BOT_DB_REFRESH_SECONDS", 60))  # Проверка обновлений БД бота
     
     # Напоминания (в минутах)
     REMINDER_BEFORE_24H = int(os.getenv("REMINDER_BEFORE_24H", 1440))  # 24 часа
     REMINDER_BEFORE_2H = int(os.getenv("REMINDER_BEFORE_2H", 120))     # 2 часа
+    REMINDER_TIMER_MAX_SLEEP = int(os.getenv("REMINDER_TIMER_MAX_SLEEP", 60))  # Секунд: перечитать расписание из БД
+    
+    # Конвейер проходов планировщика (воркеров на этап)
+    PIPELINE_ROUTE_WORKERS = int(os.getenv("PIPELINE_ROUTE_WORKERS", 8))
+    PIPELINE_SEND_WORKERS = int(os.getenv("PIPELINE_SEND_WORKERS", 4))
+    PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", 100))      # Элементов в очереди этапа
+    PIPELINE_BATCH_WAIT = float(os.getenv("PIPELINE_BATCH_WAIT", 0.5))    # Секунд добора пачки для поиска в Telegram
     
     # База данных
     DATABASE_PATH = "data/reminders.db"
+    DATABASE_POOL_SIZE = int(os.getenv("DATABASE_POOL_SIZE", 4))  # Постоянных соединений
+    DATABASE_HEALTHCHECK_INTERVAL = float(os.getenv("DATABASE_HEALTHCHECK_INTERVAL", 30))  # Секунд простоя до проверки
+    DATABASE_CLOSE_TIMEOUT = float(os.getenv("DATABASE_CLOSE_TIMEOUT", 5))  # Ожидание занятых соединений при закрытии
+    
+    # Отложенная запись (group commit) переписки и напоминаний
+    DATABASE_WRITE_BEHIND = os.getenv("DATABASE_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+    DATABASE_FLUSH_INTERVAL_MS = int(os.getenv("DATABASE_FLUSH_INTERVAL_MS", 50))  # Макс. ожидание пачки
+    DATABASE_FLUSH_MAX_ROWS = int(os.getenv("DATABASE_FLUSH_MAX_ROWS", 100))       # Макс. строк в пачке
+    
+    # Хранение: старые строки уходят в помесячные архивные базы
+    RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", 180))                 # Сколько дней держать в основной базе
+    RETENTION_HOUR = int(os.getenv("RETENTION_HOUR", 4))                   # Час запуска (мало нагрузки)
+    RETENTION_ARCHIVE_DIR = os.getenv("RETENTION_ARCHIVE_DIR", "data/archive")
+    RETENTION_VACUUM_PAGES = int(os.getenv("RETENTION_VACUUM_PAGES", 500))  # Страниц за один шаг incremental_vacuum
+    RETENTION_VACUUM_PAUSE = float(os.getenv("RETENTION_VACUUM_PAUSE", 0.5))  # Секунд между шагами
 
 
 config = Config()
@@ -0,0 +1,97 @@
+"""
+Живая лента переписки для чата YClients
+Виджет подписывается на сообщения клиента (SSE) и получает новые
+без перезагрузки страницы. Database.save_conversation оповещает ленту
+сразу; сообщения, сохранённые другим процессом (main.py), замечает
+одна общая проверка по первичному ключу — пока есть хоть один подписчик.
+Сами сообщения всегда читаются из БД после last_id, поэтому
+переподключение продолжает ленту без пропусков.
+"""
+import asyncio
+from collections import defaultdict
+from typing import Optional
+
+from config import config
+from database import db
+
+
+class ConversationFeed:
+    def __init__(self):
+        self._subscribers = defaultdict(set)  # yclients_client_id -> {asyncio.Event}
+        self._watcher: Optional[asyncio.Task] = None
+        self._listening = False
+    
+    def publish(self, yclients_client_id: int):
+        """Разбудить подписчиков клиента (вызывается из save_conversation)"""
+        for wakeup in self._subscribers.get(yclients_client_id, ()):
+            wakeup.set()
+    
+    async def subscribe(self, yclients_client_id: int, last_id: Optional[int] = None):
+        """
+        Сообщения клиента с id больше last_id — сначала пропущенные,
+        затем новые по мере появления. Без last_id — только новые.
+        Раз в CONVERSATION_FEED_KEEPALIVE секунд тишины отдаёт None
+        (для пинга соединения).
+        """
+        if last_id is None:
+            last_id, _ = await db.get_new_conversation_clients(None)
+        
+        wakeup = asyncio.Event()
+        self._subscribers[yclients_client_id].add(wakeup)
+        self._ensure_started()
+        try:
+            while True:
+                wakeup.clear()
+                rows = await db.get_conversation_since(yclients_client_id, last_id)
+                for row in rows:
+                    last_id = row["id"]
+                    yield row
+                if rows:
+                    continue
+                
+                try:
+                    await asyncio.wait_for(wakeup.wait(), config.CONVERSATION_FEED_KEEPALIVE)
+                except asyncio.TimeoutError:
+                    yield None
+        finally:
+            subscribers = self._subscribers.get(yclients_client_id)
+            if subscribers is not None:
+                subscribers.discard(wakeup)
+                if not subscribers:
+                    del self._subscribers[yclients_client_id]
+    
+    def _ensure_started(self):
+        if not self._listening:
+            db.add_conversation_listener(self.publish)
+            self._listening = True
+        if self._watcher is None or self._watcher.done():
+            self._watcher = asyncio.create_task(self._watch())
+    
+    async def _watch(self):
+        """Замечать сообщения других процессов, пока есть подписчики"""
+        last_id = None
+        while self._subscribers:
+            try:
+                last_id, client_ids = await db.get_new_conversation_clients(last_id)
+                for client_id in client_ids:
+                    self.publish(client_id)
+            except Exception as e:
+                print(f"❌ Лента переписки: {e}")
+            await asyncio.sleep(config.CONVERSATION_FEED_POLL_SECONDS)
+    
+    async def stop(self):
+        """Остановить проверку и отписаться от БД"""
+        if self._listening:
+            db.remove_conversation_listener(self.publish)
+            self._listening = False
+        if self._watcher is not None:
+            self._watcher.cancel()
+            try:
+                await self._watcher
+            except asyncio.CancelledError:
+                pass
+            self._watcher = None
+
+
+# Синглтон
+conversation_feed = ConversationFeed()
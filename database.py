@@ -2,22 +2,369 @@
 Модуль базы данных для хранения напоминаний и переписок
 """
 import aiosqlite
+import asyncio
 import os
+import re
+import sqlite3
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime
 from typing import Optional
 from config import config
+from records import SALON_TZ, FINGERPRINT_PREFIX
+
+
+def phone_key(phone: Optional[str]) -> Optional[str]:
+    """
+    Канонический ключ телефона для поиска: последние 10 цифр
+    (номер без кода страны, +7 / 8 / 7 дают одинаковый ключ).
+    """
+    if not phone:
+        return None
+    digits = ''.join(filter(str.isdigit, str(phone)))
+    if len(digits) < 10:
+        return digits or None
+    return digits[-10:]
+
+
+def _same_visit_legacy_hash(row: dict, known: dict) -> bool:
+    """
+    Сохранённый отпечаток старого формата (до FINGERPRINT_PREFIX), а время,
+    мастер и услуги не изменились — это не изменение записи
+    """
+    return (
+        not (row["hash"] or "").startswith(FINGERPRINT_PREFIX)
+        and row["starts_at"] == known.get("starts_at")
+        and row["staff_name"] == known["staff_name"]
+        and row["service_name"] == known["service_name"]
+    )
+
+
+def parse_known_starts_at(record_date: str, record_time: str) -> Optional[int]:
+    """Начало визита (epoch) из record_date/record_time — время салона"""
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M"):
+        try:
+            parsed = datetime.strptime(f"{record_date} {record_time}", fmt)
+        except (TypeError, ValueError):
+            continue
+        return int(parsed.replace(tzinfo=SALON_TZ).timestamp())
+    return None
+
+
+# Границы найденного слова в snippet поиска по переписке
+# (не встречаются в тексте — API заменяет их на разметку после экранирования)
+SNIPPET_OPEN = "\x02"
+SNIPPET_CLOSE = "\x03"
+
+
+# Текст сообщения для поискового индекса: «ё» -> «е»
+FTS_TEXT = "replace(replace({column}, 'ё', 'е'), 'Ё', 'Е')"
+
+
+# Ключи в sync_state: курсор и статистика polling, отчёт retention
+RECORDS_CURSOR_KEY = "records_cursor"
+POLL_STATS_KEY = "poll_stats"
+RETENTION_STATS_KEY = "retention_stats"
+
+
+# Настройки, применяемые к каждому соединению пула
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -8000",
+)
+
+
+class ConnectionPool:
+    """
+    Пул долгоживущих соединений SQLite.
+    Соединения открываются лениво (не больше size) и переиспользуются,
+    перед выдачей простаивавшее соединение проверяется запросом SELECT 1.
+    """
+    
+    def __init__(
+        self,
+        db_path: str,
+        size: int,
+        healthcheck_interval: float,
+        close_timeout: float = 5
+    ):
+        self.db_path = db_path
+        self.size = max(1, size)
+        self.healthcheck_interval = healthcheck_interval
+        self.close_timeout = close_timeout
+        self._idle: Optional[asyncio.LifoQueue] = None
+        self._returned: Optional[asyncio.Event] = None
+        self._connections = set()  # Все открытые соединения, в т.ч. выданные
+        self._opened = 0
+        self._last_used = {}
+        self._lock = asyncio.Lock()
+    
+    async def _open(self) -> aiosqlite.Connection:
+        """Открыть и настроить новое соединение"""
+        conn = await aiosqlite.connect(self.db_path)
+        conn.row_factory = aiosqlite.Row
+        for pragma in CONNECTION_PRAGMAS:
+            await conn.execute(pragma)
+        self._connections.add(conn)
+        return conn
+    
+    async def _is_healthy(self, conn: aiosqlite.Connection) -> bool:
+        """Проверка соединения, если оно давно не использовалось"""
+        last_used = self._last_used.get(id(conn), 0)
+        if time.monotonic() - last_used < self.healthcheck_interval:
+            return True
+        try:
+            cursor = await conn.execute("SELECT 1")
+            await cursor.fetchone()
+            return True
+        except (sqlite3.Error, ValueError):
+            return False
+    
+    async def _discard(self, conn: aiosqlite.Connection):
+        """Закрыть соединение и освободить слот пула"""
+        if conn not in self._connections:
+            return  # Уже закрыто (например, в close)
+        self._connections.discard(conn)
+        self._last_used.pop(id(conn), None)
+        self._opened -= 1
+        try:
+            await conn.close()
+        except Exception:
+            pass
+    
+    async def _get(self) -> aiosqlite.Connection:
+        if self._idle is None:
+            self._idle = asyncio.LifoQueue()
+            self._returned = asyncio.Event()
+        
+        while True:
+            if self._idle.empty():
+                async with self._lock:
+                    if self._opened < self.size:
+                        self._opened += 1
+                        try:
+                            return await self._open()
+                        except Exception:
+                            self._opened -= 1
+                            raise
+            
+            conn = await self._idle.get()
+            if await self._is_healthy(conn):
+                return conn
+            print("⚠️ Соединение с БД не прошло проверку, переоткрываем")
+            await self._discard(conn)
+    
+    @asynccontextmanager
+    async def acquire(self):
+        """Взять соединение из пула на время блока"""
+        conn = await self._get()
+        try:
+            yield conn
+        except BaseException:
+            # Не возвращаем в пул соединение с незавершённой транзакцией
+            try:
+                if conn.in_transaction:
+                    await conn.rollback()
+            except (sqlite3.Error, ValueError):
+                await self._discard(conn)
+                raise
+            self._release(conn)
+            raise
+        else:
+            self._release(conn)
+    
+    def _release(self, conn: aiosqlite.Connection):
+        if conn not in self._connections:
+            return  # Пул закрыт, пока соединение было выдано
+        self._last_used[id(conn)] = time.monotonic()
+        self._idle.put_nowait(conn)
+        self._returned.set()
+    
+    async def close(self):
+        """
+        Закрыть все соединения пула. Выданные соединения ждём
+        до close_timeout секунд, затем закрываем и их
+        """
+        if self._idle is None:
+            return
+        deadline = time.monotonic() + self.close_timeout
+        while self._idle.qsize() < len(self._connections):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                busy = len(self._connections) - self._idle.qsize()
+                print(f"⚠️ Закрываем {busy} занятых соединений с БД")
+                break
+            self._returned.clear()
+            try:
+                await asyncio.wait_for(self._returned.wait(), remaining)
+            except asyncio.TimeoutError:
+                pass
+        
+        while not self._idle.empty():
+            self._idle.get_nowait()
+        for conn in list(self._connections):
+            await self._discard(conn)
+
+
+class WriteBehindQueue:
+    """
+    Очередь отложенной записи (group commit).
+    Запросы копятся в памяти и выполняются пачкой в одной транзакции
+    раз в flush_interval_ms или по набору max_rows строк.
+    submit() возвращает управление, когда пачка закоммичена.
+    """
+    
+    def __init__(self, pool: ConnectionPool, flush_interval_ms: int, max_rows: int):
+        self.pool = pool
+        self.flush_interval = flush_interval_ms / 1000
+        self.max_rows = max(1, max_rows)
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+    
+    def _ensure_started(self):
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+    
+    async def submit(self, sql: str, params: tuple = ()):
+        """Поставить запрос в очередь и дождаться коммита пачки"""
+        self._ensure_started()
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait((sql, params, future))
+        await future
+    
+    async def _collect(self) -> list:
+        """Собрать пачку: первый запрос + всё, что придёт за интервал"""
+        batch = [await self._queue.get()]
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.max_rows:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+    
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            try:
+                await self._write_batch(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+    
+    async def _write_batch(self, batch: list):
+        """Записать пачку одной транзакцией, при ошибке — по одному"""
+        try:
+            async with self.pool.acquire() as conn:
+                for sql, params, _ in batch:
+                    await conn.execute(sql, params)
+                await conn.commit()
+        except Exception as e:
+            print(f"⚠️ Ошибка групповой записи ({len(batch)} строк): {e}")
+            for sql, params, future in batch:
+                try:
+                    async with self.pool.acquire() as conn:
+                        await conn.execute(sql, params)
+                        await conn.commit()
+                except Exception as single_error:
+                    if not future.done():
+                        future.set_exception(single_error)
+                    continue
+                if not future.done():
+                    future.set_result(None)
+            return
+        
+        for _, _, future in batch:
+            if not future.done():
+                future.set_result(None)
+    
+    async def flush(self):
+        """Дождаться записи всего, что уже стоит в очереди"""
+        if self._queue is not None and self._task is not None and not self._task.done():
+            await self._queue.join()
+    
+    async def close(self):
+        """Сбросить очередь на диск и остановить фоновую задачу"""
+        await self.flush()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
 
 
 class Database:
     def __init__(self):
         self.db_path = config.DATABASE_PATH
+        self.pool = ConnectionPool(
+            self.db_path,
+            size=config.DATABASE_POOL_SIZE,
+            healthcheck_interval=config.DATABASE_HEALTHCHECK_INTERVAL,
+            close_timeout=config.DATABASE_CLOSE_TIMEOUT
+        )
+        self.write_behind: Optional[WriteBehindQueue] = None
+        if config.DATABASE_WRITE_BEHIND:
+            self.write_behind = WriteBehindQueue(
+                self.pool,
+                flush_interval_ms=config.DATABASE_FLUSH_INTERVAL_MS,
+                max_rows=config.DATABASE_FLUSH_MAX_ROWS
+            )
+        # Подписчики на новые сообщения переписки: callback(yclients_client_id)
+        self._conversation_listeners = []
+    
+    def add_conversation_listener(self, callback):
+        """Вызывать callback(yclients_client_id) после сохранения сообщения"""
+        self._conversation_listeners.append(callback)
+    
+    def remove_conversation_listener(self, callback):
+        if callback in self._conversation_listeners:
+            self._conversation_listeners.remove(callback)
+    
+    def connection(self):
+        """Соединение из пула: async with db.connection() as conn"""
+        return self.pool.acquire()
+    
+    async def _write(self, sql: str, params: tuple = ()):
+        """
+        Выполнить запрос на запись.
+        В режиме write-behind запрос уходит в общую пачку,
+        иначе коммитится сразу.
+        """
+        if self.write_behind is not None:
+            await self.write_behind.submit(sql, params)
+            return
+        async with self.connection() as db:
+            await db.execute(sql, params)
+            await db.commit()
+    
+    async def flush(self):
+        """Дописать отложенные записи (write-behind)"""
+        if self.write_behind is not None:
+            await self.write_behind.flush()
+    
+    async def close(self):
+        """Сбросить отложенные записи и закрыть соединения с БД"""
+        if self.write_behind is not None:
+            await self.write_behind.close()
+        await self.pool.close()
         
     async def init(self):
         """Инициализация базы данных"""
         # Создаём директорию если не существует
         os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
         
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.connection() as db:
             # Таблица для отслеживания отправленных напоминаний
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS sent_reminders (
@@ -38,6 +385,7 @@ class Database:
                     telegram_user_id INTEGER,
                     telegram_username TEXT,
                     phone TEXT,
+                    phone_key TEXT,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
@@ -69,11 +417,234 @@ class Database:
                 )
             """)
             
+            # Номера, не найденные в Telegram (кэш отрицательных результатов)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS telegram_phone_misses (
+                    phone_key TEXT PRIMARY KEY,
+                    attempts INTEGER NOT NULL DEFAULT 1,
+                    checked_at INTEGER NOT NULL,
+                    next_check_at INTEGER NOT NULL
+                )
+            """)
+            
+            # Очередь исходящих сообщений (outbox)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    idempotency_key TEXT UNIQUE NOT NULL,
+                    channel TEXT NOT NULL DEFAULT 'userbot',
+                    recipient TEXT NOT NULL,
+                    message_text TEXT NOT NULL,
+                    record_id INTEGER,
+                    yclients_client_id INTEGER,
+                    reminder_type TEXT,
+                    priority INTEGER NOT NULL DEFAULT 1,
+                    deadline_at INTEGER,
+                    meta TEXT,
+                    state TEXT NOT NULL DEFAULT 'queued',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at INTEGER NOT NULL,
+                    last_error TEXT,
+                    telegram_message_id INTEGER,
+                    coalesce_key TEXT,
+                    reminder_record_id INTEGER,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_outbox_due "
+                "ON outbox(state, next_attempt_at)"
+            )
+            
+            # Миграция: ключ склейки уведомлений по одной записи
+            cursor = await db.execute("PRAGMA table_info(outbox)")
+            outbox_columns = {row["name"] for row in await cursor.fetchall()}
+            if "coalesce_key" not in outbox_columns:
+                print("📦 Миграция: добавляем coalesce_key в outbox")
+                await db.execute("ALTER TABLE outbox ADD COLUMN coalesce_key TEXT")
+            
+            # Миграция: ключ sent_reminders отдельно от record_id — у потеряшек
+            # это ID клиента, и в переписку он попадать не должен
+            if "reminder_record_id" not in outbox_columns:
+                print("📦 Миграция: добавляем reminder_record_id в outbox")
+                await db.execute("ALTER TABLE outbox ADD COLUMN reminder_record_id INTEGER")
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_outbox_coalesce "
+                "ON outbox(coalesce_key, state)"
+            )
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_outbox_recipient "
+                "ON outbox(recipient, channel, state)"
+            )
+            
+            # Журнал принятых webhook: пишется до ответа 200,
+            # разбирается воркерами webhook_journal
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS webhook_journal (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    received_at INTEGER NOT NULL,
+                    resource TEXT,
+                    status TEXT,
+                    resource_id INTEGER,
+                    payload TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    processed_at INTEGER
+                )
+            """)
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_webhook_journal_state "
+                "ON webhook_journal(state, id)"
+            )
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_webhook_journal_received "
+                "ON webhook_journal(received_at)"
+            )
+            
+            # Состояние синхронизации с YClients (курсор polling и т.п.)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS sync_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+            
+            # Моменты отправки напоминаний по записям (24h, 1h, review)
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS scheduled_messages (
+                    record_id INTEGER NOT NULL,
+                    kind TEXT NOT NULL,
+                    due_at INTEGER NOT NULL,
+                    expires_at INTEGER NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    PRIMARY KEY (record_id, kind)
+                )
+            """)
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_scheduled_due "
+                "ON scheduled_messages(state, due_at)"
+            )
+            
+            await self._migrate_phone_keys(db)
+            
+            # Индексы для частых выборок
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_links_telegram_user "
+                "ON client_telegram_links(telegram_user_id)"
+            )
+            # Переписка листается курсором (created_at, id): у created_at
+            # секундная точность, id разбивает совпадения
+            await db.execute("DROP INDEX IF EXISTS idx_conversations_client_created")
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_conversations_client_created_id "
+                "ON conversations(yclients_client_id, created_at, id)"
+            )
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_pending_user_created "
+                "ON pending_confirmations(telegram_user_id, created_at)"
+            )
+            await self._init_conversation_search(db)
+            
             await db.commit()
     
+    async def _init_conversation_search(self, db: aiosqlite.Connection):
+        """
+        Полнотекстовый индекс переписки (FTS5). Индекс хранит только
+        токены (content=conversations), триггеры держат его в актуальном
+        состоянии. unicode61 снимает диакритику только с латиницы, поэтому
+        «ё» заменяется на «е» при индексации (FTS_TEXT) и в запросе.
+        """
+        cursor = await db.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = 'conversations_fts'"
+        )
+        exists = await cursor.fetchone() is not None
+        try:
+            await db.execute("""
+                CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+                    message_text,
+                    content = 'conversations',
+                    content_rowid = 'id',
+                    tokenize = 'unicode61 remove_diacritics 2'
+                )
+            """)
+        except sqlite3.OperationalError as e:
+            print(f"⚠️ Поиск по переписке недоступен (SQLite без FTS5): {e}")
+            return
+        
+        new_text = FTS_TEXT.format(column="new.message_text")
+        old_text = FTS_TEXT.format(column="old.message_text")
+        await db.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS conversations_fts_insert 
+            AFTER INSERT ON conversations BEGIN 
+                INSERT INTO conversations_fts (rowid, message_text) 
+                VALUES (new.id, {new_text}); 
+            END
+        """)
+        await db.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS conversations_fts_delete 
+            AFTER DELETE ON conversations BEGIN 
+                INSERT INTO conversations_fts (conversations_fts, rowid, message_text) 
+                VALUES ('delete', old.id, {old_text}); 
+            END
+        """)
+        await db.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS conversations_fts_update 
+            AFTER UPDATE OF message_text ON conversations BEGIN 
+                INSERT INTO conversations_fts (conversations_fts, rowid, message_text) 
+                VALUES ('delete', old.id, {old_text}); 
+                INSERT INTO conversations_fts (rowid, message_text) 
+                VALUES (new.id, {new_text}); 
+            END
+        """)
+        
+        if not exists:
+            print("📦 Миграция: строим поисковый индекс переписки")
+            await db.execute(
+                f"INSERT INTO conversations_fts (rowid, message_text) "
+                f"SELECT id, {FTS_TEXT.format(column='message_text')} FROM conversations"
+            )
+    
+    async def _migrate_phone_keys(self, db: aiosqlite.Connection):
+        """
+        Миграция: колонка phone_key в client_telegram_links.
+        Для старых баз заполняет ключ по полю phone. Если один номер
+        привязан к нескольким клиентам, ключ получает связь с известным
+        Telegram ID, а среди них — самая свежая.
+        """
+        cursor = await db.execute("PRAGMA table_info(client_telegram_links)")
+        columns = {row["name"] for row in await cursor.fetchall()}
+        
+        if "phone_key" not in columns:
+            print("📦 Миграция: добавляем phone_key в client_telegram_links")
+            await db.execute("ALTER TABLE client_telegram_links ADD COLUMN phone_key TEXT")
+            
+            cursor = await db.execute(
+                "SELECT id, phone FROM client_telegram_links "
+                "ORDER BY telegram_user_id IS NULL, updated_at DESC, id DESC"
+            )
+            seen = set()
+            updates = []
+            for row in await cursor.fetchall():
+                key = phone_key(row["phone"])
+                if key and key not in seen:
+                    seen.add(key)
+                    updates.append((key, row["id"]))
+            await db.executemany(
+                "UPDATE client_telegram_links SET phone_key = ? WHERE id = ?",
+                updates
+            )
+        
+        await db.execute(
+            "CREATE UNIQUE INDEX IF NOT EXISTS idx_links_phone_key "
+            "ON client_telegram_links(phone_key)"
+        )
+    
     async def is_reminder_sent(self, record_id: int, reminder_type: str) -> bool:
         """Проверить, было ли уже отправлено напоминание"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.connection() as db:
             cursor = await db.execute(
                 "SELECT 1 FROM sent_reminders WHERE record_id = ? AND reminder_type = ?",
                 (record_id, reminder_type)
@@ -88,14 +659,12 @@ class Database:
         telegram_message_id: Optional[int] = None
     ):
         """Отметить напоминание как отправленное"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                """INSERT OR REPLACE INTO sent_reminders 
-                   (record_id, reminder_type, telegram_message_id, sent_at) 
-                   VALUES (?, ?, ?, ?)""",
-                (record_id, reminder_type, telegram_message_id, datetime.now())
-            )
-            await db.commit()
+        await self._write(
+            """INSERT OR REPLACE INTO sent_reminders 
+               (record_id, reminder_type, telegram_message_id, sent_at) 
+               VALUES (?, ?, ?, ?)""",
+            (record_id, reminder_type, telegram_message_id, datetime.now())
+        )
     
     async def link_client_telegram(
         self, 
@@ -104,20 +673,36 @@ class Database:
         telegram_user_id: Optional[int] = None,
         telegram_username: Optional[str] = None
     ):
-        """Связать клиента YClients с Telegram"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                """INSERT OR REPLACE INTO client_telegram_links 
-                   (yclients_client_id, telegram_user_id, telegram_username, phone, updated_at) 
-                   VALUES (?, ?, ?, ?, ?)""",
-                (yclients_client_id, telegram_user_id, telegram_username, phone, datetime.now())
-            )
-            await db.commit()
+        """
+        Связать клиента YClients с Telegram.
+        Существующая связь обновляется на месте; известный Telegram ID не
+        затирается пустым. Если номер уже привязан к другому клиенту,
+        phone_key остаётся за той связью, а у этой — NULL.
+        """
+        key = phone_key(phone)
+        await self._write(
+            """INSERT INTO client_telegram_links 
+               (yclients_client_id, telegram_user_id, telegram_username, phone, phone_key, updated_at) 
+               SELECT ?, ?, ?, ?,
+                      CASE WHEN EXISTS (
+                          SELECT 1 FROM client_telegram_links
+                          WHERE phone_key = ? AND yclients_client_id != ?
+                      ) THEN NULL ELSE ? END,
+                      ?
+               WHERE true
+               ON CONFLICT(yclients_client_id) DO UPDATE SET
+                   telegram_user_id = COALESCE(excluded.telegram_user_id, telegram_user_id),
+                   telegram_username = COALESCE(excluded.telegram_username, telegram_username),
+                   phone = excluded.phone,
+                   phone_key = excluded.phone_key,
+                   updated_at = excluded.updated_at""",
+            (yclients_client_id, telegram_user_id, telegram_username, phone,
+             key, yclients_client_id, key, datetime.now())
+        )
     
     async def get_telegram_by_client_id(self, yclients_client_id: int) -> Optional[dict]:
         """Получить Telegram данные по ID клиента YClients"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.connection() as db:
             cursor = await db.execute(
                 "SELECT * FROM client_telegram_links WHERE yclients_client_id = ?",
                 (yclients_client_id,)
@@ -127,8 +712,7 @@ class Database:
     
     async def get_client_by_telegram(self, telegram_user_id: int) -> Optional[dict]:
         """Получить клиента YClients по Telegram ID"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.connection() as db:
             cursor = await db.execute(
                 "SELECT * FROM client_telegram_links WHERE telegram_user_id = ?",
                 (telegram_user_id,)
@@ -136,16 +720,79 @@ class Database:
             row = await cursor.fetchone()
             return dict(row) if row else None
     
+    async def get_telegram_links(self) -> list:
+        """Все связи клиентов, для которых известен Telegram ID"""
+        async with self.connection() as db:
+            cursor = await db.execute(
+                """SELECT phone, phone_key, telegram_user_id, telegram_username 
+                   FROM client_telegram_links 
+                   WHERE telegram_user_id IS NOT NULL AND phone_key IS NOT NULL"""
+            )
+            rows = await cursor.fetchall()
+            return [dict(row) for row in rows]
+    
+    async def attach_telegram_by_phone(self, users: list):
+        """
+        Проставить Telegram ID связям, у которых он ещё не известен.
+        users — список (phone_key, telegram_user_id, telegram_username)
+        """
+        if not users:
+            return
+        async with self.connection() as db:
+            await db.executemany(
+                """UPDATE client_telegram_links 
+                   SET telegram_user_id = ?, telegram_username = ?, updated_at = ? 
+                   WHERE phone_key = ? AND telegram_user_id IS NULL""",
+                [(user_id, username, datetime.now(), key) for key, user_id, username in users]
+            )
+            await db.commit()
+    
+    async def get_phone_misses(self) -> dict:
+        """Кэш ненайденных номеров: phone_key -> (attempts, next_check_at)"""
+        async with self.connection() as db:
+            cursor = await db.execute(
+                "SELECT phone_key, attempts, next_check_at FROM telegram_phone_misses"
+            )
+            rows = await cursor.fetchall()
+            return {row[0]: (row[1], row[2]) for row in rows}
+    
+    async def save_phone_misses(self, misses: list):
+        """
+        Сохранить ненайденные номера.
+        misses — список (phone_key, attempts, checked_at, next_check_at)
+        """
+        if not misses:
+            return
+        async with self.connection() as db:
+            await db.executemany(
+                """INSERT OR REPLACE INTO telegram_phone_misses 
+                   (phone_key, attempts, checked_at, next_check_at) 
+                   VALUES (?, ?, ?, ?)""",
+                misses
+            )
+            await db.commit()
+    
+    async def clear_phone_misses(self, keys: list):
+        """Убрать номера из кэша ненайденных (пользователь нашёлся)"""
+        if not keys:
+            return
+        async with self.connection() as db:
+            await db.executemany(
+                "DELETE FROM telegram_phone_misses WHERE phone_key = ?",
+                [(key,) for key in keys]
+            )
+            await db.commit()
+    
     async def get_client_by_phone(self, phone: str) -> Optional[dict]:
         """Получить клиента по номеру телефона"""
-        # Нормализуем телефон
-        normalized = ''.join(filter(str.isdigit, phone))
+        key = phone_key(phone)
+        if not key:
+            return None
         
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.connection() as db:
             cursor = await db.execute(
-                "SELECT * FROM client_telegram_links WHERE phone LIKE ?",
-                (f"%{normalized[-10:]}%",)
+                "SELECT * FROM client_telegram_links WHERE phone_key = ?",
+                (key,)
             )
             row = await cursor.fetchone()
             return dict(row) if row else None
@@ -158,33 +805,202 @@ class Database:
         record_id: Optional[int] = None,
         telegram_message_id: Optional[int] = None
     ):
-        """Сохранить сообщение переписки"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                """INSERT INTO conversations 
-                   (yclients_client_id, record_id, direction, message_text, telegram_message_id) 
-                   VALUES (?, ?, ?, ?, ?)""",
-                (yclients_client_id, record_id, direction, message_text, telegram_message_id)
-            )
-            await db.commit()
+        """Сохранить сообщение переписки (и оповестить подписчиков)"""
+        await self._write(
+            """INSERT INTO conversations 
+               (yclients_client_id, record_id, direction, message_text, telegram_message_id) 
+               VALUES (?, ?, ?, ?, ?)""",
+            (yclients_client_id, record_id, direction, message_text, telegram_message_id)
+        )
+        for callback in list(self._conversation_listeners):
+            try:
+                callback(yclients_client_id)
+            except Exception as e:
+                print(f"⚠️ Ошибка подписчика переписки: {e}")
     
     async def get_conversation_history(
         self, 
         yclients_client_id: int, 
-        limit: int = 50
+        limit: int = 50,
+        before: Optional[tuple] = None,
+        after: Optional[tuple] = None
+    ) -> list:
+        """
+        Получить историю переписки с клиентом (новые сообщения первыми).
+        before / after — курсор (created_at, id): сообщения старше или
+        новее него. С after возвращаются ближайшие к курсору сообщения.
+        """
+        rows = await self._conversation_page(
+            yclients_client_id, limit, lower=after, upper=before, newest_first=after is None
+        )
+        return rows if after is None else rows[::-1]
+    
+    async def iter_conversation_history(
+        self,
+        yclients_client_id: int,
+        limit: int = 50,
+        before: Optional[tuple] = None,
+        after: Optional[tuple] = None,
+        chunk_size: int = 100
+    ):
+        """
+        Та же выборка, что get_conversation_history, но по порядку
+        (старые первыми) и частями — для потоковой отдачи. Между частями
+        соединение возвращается в пул.
+        """
+        lower, inclusive = after, False
+        if after is None:
+            # Начало окна — самое старое из limit последних сообщений
+            async with self.connection() as db:
+                where, params = self._conversation_where(yclients_client_id, None, before)
+                cursor = await db.execute(
+                    f"SELECT created_at, id FROM conversations WHERE {where} "
+                    f"ORDER BY created_at DESC, id DESC LIMIT 1 OFFSET ?",
+                    params + [limit - 1]
+                )
+                row = await cursor.fetchone()
+            if row is not None:
+                lower, inclusive = (row[0], row[1]), True
+        
+        remaining = limit
+        while remaining > 0:
+            rows = await self._conversation_page(
+                yclients_client_id, min(chunk_size, remaining),
+                lower=lower, upper=before, newest_first=False, lower_inclusive=inclusive
+            )
+            if not rows:
+                return
+            for row in rows:
+                yield row
+            remaining -= len(rows)
+            lower, inclusive = (rows[-1]["created_at"], rows[-1]["id"]), False
+    
+    @staticmethod
+    def _conversation_where(
+        yclients_client_id: int,
+        lower: Optional[tuple],
+        upper: Optional[tuple],
+        lower_inclusive: bool = False
+    ) -> tuple:
+        conditions = ["yclients_client_id = ?"]
+        params = [yclients_client_id]
+        if lower is not None:
+            conditions.append(f"(created_at, id) {'>=' if lower_inclusive else '>'} (?, ?)")
+            params.extend(lower)
+        if upper is not None:
+            conditions.append("(created_at, id) < (?, ?)")
+            params.extend(upper)
+        return " AND ".join(conditions), params
+    
+    async def _conversation_page(
+        self,
+        yclients_client_id: int,
+        limit: int,
+        lower: Optional[tuple] = None,
+        upper: Optional[tuple] = None,
+        newest_first: bool = True,
+        lower_inclusive: bool = False
     ) -> list:
-        """Получить историю переписки с клиентом"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        """Одна страница переписки между курсорами (по индексу client, created_at, id)"""
+        where, params = self._conversation_where(yclients_client_id, lower, upper, lower_inclusive)
+        order = "DESC" if newest_first else "ASC"
+        async with self.connection() as db:
             cursor = await db.execute(
-                """SELECT * FROM conversations 
-                   WHERE yclients_client_id = ? 
-                   ORDER BY created_at DESC LIMIT ?""",
-                (yclients_client_id, limit)
+                f"SELECT * FROM conversations WHERE {where} "
+                f"ORDER BY created_at {order}, id {order} LIMIT ?",
+                params + [limit]
             )
             rows = await cursor.fetchall()
             return [dict(row) for row in rows]
     
+    async def get_conversation_since(
+        self,
+        yclients_client_id: int,
+        after_id: int,
+        limit: int = 100
+    ) -> list:
+        """Сообщения переписки с id больше after_id (по порядку)"""
+        async with self.connection() as db:
+            cursor = await db.execute(
+                """SELECT * FROM conversations 
+                   WHERE yclients_client_id = ? AND id > ? 
+                   ORDER BY id LIMIT ?""",
+                (yclients_client_id, after_id, limit)
+            )
+            return [dict(row) for row in await cursor.fetchall()]
+    
+    async def get_new_conversation_clients(self, after_id: Optional[int]) -> tuple:
+        """
+        Кто получил сообщения после after_id (в том числе записанные
+        другим процессом): (последний id, set yclients_client_id).
+        Без after_id — только последний id. Запрос идёт по первичному ключу.
+        """
+        async with self.connection() as db:
+            if after_id is None:
+                cursor = await db.execute("SELECT MAX(id) FROM conversations")
+                row = await cursor.fetchone()
+                return row[0] or 0, set()
+            cursor = await db.execute(
+                "SELECT id, yclients_client_id FROM conversations WHERE id > ? ORDER BY id",
+                (after_id,)
+            )
+            rows = await cursor.fetchall()
+            if not rows:
+                return after_id, set()
+            return rows[-1][0], {row[1] for row in rows}
+    
+    async def search_conversations(
+        self,
+        query: str,
+        limit: int = 20,
+        yclients_client_id: Optional[int] = None,
+        after: Optional[tuple] = None
+    ) -> list:
+        """
+        Поиск по тексту переписки (FTS5), лучшие совпадения первыми.
+        Каждое слово запроса ищется как префикс («стрижк» найдёт «стрижку»).
+        after — курсор (rank, id) последнего результата предыдущей страницы.
+        """
+        words = re.findall(r"\w+", query.replace("ё", "е").replace("Ё", "Е"))
+        if not words:
+            return []
+        match = " ".join(f'"{word}"*' for word in words)
+        
+        conditions = ["conversations_fts MATCH ?"]
+        params = [match]
+        if yclients_client_id is not None:
+            conditions.append("c.yclients_client_id = ?")
+            params.append(yclients_client_id)
+        if after is not None:
+            conditions.append("(f.rank, c.id) > (?, ?)")
+            params.extend(after)
+        
+        async with self.connection() as db:
+            cursor = await db.execute(
+                f"""SELECT c.id, c.yclients_client_id, c.record_id, c.direction, c.created_at, 
+                           snippet(conversations_fts, 0, ?, ?, '…', 12) AS snippet, 
+                           f.rank AS rank 
+                    FROM conversations_fts f 
+                    JOIN conversations c ON c.id = f.rowid 
+                    WHERE {' AND '.join(conditions)} 
+                    ORDER BY f.rank, c.id LIMIT ?""",
+                [SNIPPET_OPEN, SNIPPET_CLOSE] + params + [limit]
+            )
+            return [dict(row) for row in await cursor.fetchall()]
+    
+    async def get_conversation_version(self, yclients_client_id: int) -> tuple:
+        """
+        Версия переписки: (число сообщений, последний id). Сообщения
+        не редактируются, так что версия меняется только с новыми.
+        """
+        async with self.connection() as db:
+            cursor = await db.execute(
+                "SELECT COUNT(*), MAX(id) FROM conversations WHERE yclients_client_id = ?",
+                (yclients_client_id,)
+            )
+            row = await cursor.fetchone()
+            return row[0], row[1]
+    
     async def add_pending_confirmation(
         self,
         record_id: int,
@@ -193,7 +1009,7 @@ class Database:
         record_datetime: str
     ):
         """Добавить запись в ожидание подтверждения"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.connection() as db:
             await db.execute(
                 """INSERT OR REPLACE INTO pending_confirmations 
                    (record_id, telegram_user_id, yclients_client_id, record_datetime) 
@@ -204,8 +1020,7 @@ class Database:
     
     async def get_pending_confirmation(self, telegram_user_id: int) -> Optional[dict]:
         """Получить ожидающую подтверждения запись для пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.connection() as db:
             cursor = await db.execute(
                 """SELECT * FROM pending_confirmations 
                    WHERE telegram_user_id = ? 
@@ -217,16 +1032,263 @@ class Database:
     
     async def remove_pending_confirmation(self, record_id: int, telegram_user_id: int):
         """Удалить запись из ожидающих подтверждения"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.connection() as db:
             await db.execute(
                 "DELETE FROM pending_confirmations WHERE record_id = ? AND telegram_user_id = ?",
                 (record_id, telegram_user_id)
             )
             await db.commit()
     
+    async def enqueue_outbox(
+        self,
+        idempotency_key: str,
+        recipient: str,
+        message_text: str,
+        channel: str = "userbot",
+        record_id: Optional[int] = None,
+        yclients_client_id: Optional[int] = None,
+        reminder_type: Optional[str] = None,
+        priority: int = 1,
+        deadline_at: Optional[int] = None,
+        meta: Optional[str] = None,
+        next_attempt_at: Optional[int] = None,
+        coalesce_key: Optional[str] = None,
+        reminder_record_id: Optional[int] = None,
+        replace_ids: Optional[list] = None
+    ) -> bool:
+        """
+        Поставить сообщение в outbox.
+        Повторная постановка с тем же idempotency_key игнорируется.
+        reminder_record_id — ключ для sent_reminders (без него — record_id).
+        replace_ids — придержанные сообщения (hold_queued_outbox), которые
+        новое заменяет: удаляются той же транзакцией.
+        Возвращает True, если сообщение добавлено.
+        """
+        async with self.connection() as db:
+            if replace_ids:
+                placeholders = ",".join("?" * len(replace_ids))
+                await db.execute(
+                    f"DELETE FROM outbox WHERE id IN ({placeholders}) AND state = 'held'",
+                    list(replace_ids)
+                )
+            cursor = await db.execute(
+                """INSERT OR IGNORE INTO outbox 
+                   (idempotency_key, channel, recipient, message_text, record_id, 
+                    yclients_client_id, reminder_type, priority, deadline_at, meta, 
+                    state, next_attempt_at, coalesce_key, reminder_record_id) 
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?, ?, ?)""",
+                (idempotency_key, channel, str(recipient), message_text, record_id,
+                 yclients_client_id, reminder_type, priority, deadline_at, meta,
+                 next_attempt_at or int(time.time()), coalesce_key, reminder_record_id)
+            )
+            await db.commit()
+            return cursor.rowcount > 0
+    
+    async def hold_queued_outbox(self, coalesce_key: str) -> list:
+        """
+        Придержать (state = 'held') ещё не отправленные сообщения с этим
+        ключом склейки — воркеры их не берут. Дальше они либо заменяются
+        новым (enqueue_outbox с replace_ids), либо удаляются
+        (drop_held_outbox), либо возвращаются в очередь (release_held_outbox).
+        Сообщение, которое воркер уже взял в отправку, не трогается.
+        """
+        async with self.connection() as db:
+            cursor = await db.execute(
+                "UPDATE outbox SET state = 'held', updated_at = ? "
+                "WHERE coalesce_key = ? AND state = 'queued' RETURNING *",
+                (datetime.now(), coalesce_key)
+            )
+            rows = [dict(row) for row in await cursor.fetchall()]
+            await db.commit()
+            return sorted(rows, key=lambda row: row["id"])
+    
+    async def release_held_outbox(self, outbox_ids: list):
+        """Вернуть в очередь придержанные сообщения, которые так и не заменили"""
+        if not outbox_ids:
+            return
+        placeholders = ",".join("?" * len(outbox_ids))
+        async with self.connection() as db:
+            await db.execute(
+                f"UPDATE outbox SET state = 'queued', updated_at = ? "
+                f"WHERE id IN ({placeholders}) AND state = 'held'",
+                [datetime.now(), *outbox_ids]
+            )
+            await db.commit()
+    
+    async def drop_held_outbox(self, outbox_ids: list):
+        """Удалить придержанные сообщения (сообщать больше не о чем)"""
+        if not outbox_ids:
+            return
+        placeholders = ",".join("?" * len(outbox_ids))
+        async with self.connection() as db:
+            await db.execute(
+                f"DELETE FROM outbox WHERE id IN ({placeholders}) AND state = 'held'",
+                list(outbox_ids)
+            )
+            await db.commit()
+    
+    async def claim_outbox(self, limit: int) -> list:
+        """
+        Забрать готовые к отправке сообщения (queued/failed с наступившим
+        временем попытки) и перевести их в состояние sending.
+        Получатели, которым сообщение уже отправляется (sending), пропускаются —
+        так разные воркеры не шлют одному получателю вперемешку.
+        """
+        async with self.connection() as db:
+            cursor = await db.execute(
+                """UPDATE outbox 
+                   SET state = 'sending', attempts = attempts + 1, updated_at = ? 
+                   WHERE id IN (
+                       SELECT id FROM outbox AS o 
+                       WHERE state IN ('queued', 'failed') AND next_attempt_at <= ? 
+                         AND NOT EXISTS (
+                             SELECT 1 FROM outbox AS busy 
+                             WHERE busy.recipient = o.recipient 
+                               AND busy.channel = o.channel 
+                               AND busy.state = 'sending'
+                         ) 
+                       ORDER BY priority, id LIMIT ?
+                   ) 
+                   RETURNING *""",
+                (datetime.now(), int(time.time()), limit)
+            )
+            rows = [dict(row) for row in await cursor.fetchall()]
+            await db.commit()
+            return sorted(rows, key=lambda row: (row["priority"], row["id"]))
+    
+    async def complete_outbox(
+        self,
+        outbox_id: int,
+        telegram_message_id: Optional[int] = None,
+        record_id: Optional[int] = None,
+        reminder_type: Optional[str] = None
+    ):
+        """Отметить сообщение отправленным (и напоминание — в sent_reminders)"""
+        now = datetime.now()
+        async with self.connection() as db:
+            await db.execute(
+                """UPDATE outbox 
+                   SET state = 'sent', telegram_message_id = ?, last_error = NULL, updated_at = ? 
+                   WHERE id = ?""",
+                (telegram_message_id, now, outbox_id)
+            )
+            if reminder_type and record_id is not None:
+                await db.execute(
+                    """INSERT OR REPLACE INTO sent_reminders 
+                       (record_id, reminder_type, telegram_message_id, sent_at) 
+                       VALUES (?, ?, ?, ?)""",
+                    (record_id, reminder_type, telegram_message_id, now)
+                )
+            await db.commit()
+    
+    async def fail_outbox(self, outbox_id: int, error: str, next_attempt_at: Optional[int]):
+        """
+        Неудачная попытка: failed с новым временем попытки
+        или dead, если next_attempt_at не задан
+        """
+        async with self.connection() as db:
+            if next_attempt_at is None:
+                await db.execute(
+                    "UPDATE outbox SET state = 'dead', last_error = ?, updated_at = ? WHERE id = ?",
+                    (error, datetime.now(), outbox_id)
+                )
+            else:
+                await db.execute(
+                    """UPDATE outbox 
+                       SET state = 'failed', last_error = ?, next_attempt_at = ?, updated_at = ? 
+                       WHERE id = ?""",
+                    (error, next_attempt_at, datetime.now(), outbox_id)
+                )
+            await db.commit()
+    
+    async def requeue_interrupted_outbox(self) -> int:
+        """
+        После перезапуска: сообщения, застрявшие в sending (процесс упал
+        во время отправки) или held (упал во время склейки), возвращаются в очередь
+        """
+        async with self.connection() as db:
+            cursor = await db.execute(
+                "UPDATE outbox SET state = 'queued', updated_at = ? "
+                "WHERE state IN ('sending', 'held')",
+                (datetime.now(),)
+            )
+            await db.commit()
+            return cursor.rowcount
+    
+    async def append_webhook(self, resource: str, status: str, resource_id, payload: str) -> int:
+        """Записать принятый webhook в журнал (одна запись, сразу на диск)"""
+        async with self.connection() as db:
+            cursor = await db.execute(
+                """INSERT INTO webhook_journal (received_at, resource, status, resource_id, payload) 
+                   VALUES (?, ?, ?, ?, ?)""",
+                (int(time.time()), resource, status, resource_id, payload)
+            )
+            await db.commit()
+            return cursor.lastrowid
+    
+    async def claim_webhooks(self, limit: int) -> list:
+        """Забрать ожидающие webhook из журнала по порядку (state -> processing)"""
+        async with self.connection() as db:
+            cursor = await db.execute(
+                """UPDATE webhook_journal SET state = 'processing', attempts = attempts + 1 
+                   WHERE id IN (
+                       SELECT id FROM webhook_journal WHERE state = 'pending' ORDER BY id LIMIT ?
+                   ) 
+                   RETURNING *""",
+                (limit,)
+            )
+            rows = [dict(row) for row in await cursor.fetchall()]
+            await db.commit()
+            return sorted(rows, key=lambda row: row["id"])
+    
+    async def finish_webhook(self, journal_id: int, error: Optional[str] = None):
+        """Отметить webhook обработанным (done) или упавшим (failed)"""
+        await self._write(
+            "UPDATE webhook_journal SET state = ?, last_error = ?, processed_at = ? WHERE id = ?",
+            ("failed" if error else "done", error, int(time.time()), journal_id)
+        )
+    
+    async def requeue_webhooks(
+        self,
+        since: Optional[int] = None,
+        until: Optional[int] = None,
+        resource: Optional[str] = None,
+        states: tuple = ("processing",)
+    ) -> int:
+        """
+        Вернуть webhook в очередь (state -> pending).
+        По умолчанию — прерванные перезапуском; для повтора за период
+        передать since/until (epoch) и нужные состояния.
+        """
+        conditions = [f"state IN ({','.join('?' * len(states))})"]
+        params = list(states)
+        if since is not None:
+            conditions.append("received_at >= ?")
+            params.append(since)
+        if until is not None:
+            conditions.append("received_at < ?")
+            params.append(until)
+        if resource:
+            conditions.append("resource = ?")
+            params.append(resource)
+        async with self.connection() as db:
+            cursor = await db.execute(
+                f"UPDATE webhook_journal SET state = 'pending' WHERE {' AND '.join(conditions)}",
+                params
+            )
+            await db.commit()
+            return cursor.rowcount
+    
+    async def get_last_webhook_at(self) -> Optional[int]:
+        """Когда пришёл последний webhook (epoch)"""
+        async with self.connection() as db:
+            cursor = await db.execute("SELECT MAX(received_at) FROM webhook_journal")
+            row = await cursor.fetchone()
+            return row[0]
+    
     async def init_records_tracking(self):
         """Инициализация таблицы для отслеживания записей (polling)"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.connection() as db:
             await db.execute("""
                 CREATE TABLE IF NOT EXISTS known_records (
                     id INTEGER PRIMARY KEY,
@@ -239,16 +1301,56 @@ class Database:
                     record_time TEXT,
                     status TEXT DEFAULT 'active',
                     hash TEXT,
+                    client_id INTEGER,
+                    starts_at INTEGER,
+                    event_seq INTEGER NOT NULL DEFAULT 0,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
+            
+            # Миграция: ID клиента YClients нужен напоминаниям из таймера
+            cursor = await db.execute("PRAGMA table_info(known_records)")
+            columns = {row["name"] for row in await cursor.fetchall()}
+            if "client_id" not in columns:
+                print("📦 Миграция: добавляем client_id в known_records")
+                await db.execute("ALTER TABLE known_records ADD COLUMN client_id INTEGER")
+            
+            # Миграция: начало визита в epoch — выборки по времени идут по индексу,
+            # а не разбором record_date/record_time каждой строки
+            if "starts_at" not in columns:
+                print("📦 Миграция: добавляем starts_at в known_records")
+                await db.execute("ALTER TABLE known_records ADD COLUMN starts_at INTEGER")
+                cursor = await db.execute(
+                    "SELECT record_id, record_date, record_time FROM known_records "
+                    "WHERE status = 'active'"
+                )
+                updates = []
+                for row in await cursor.fetchall():
+                    starts_at = parse_known_starts_at(row["record_date"], row["record_time"])
+                    if starts_at is not None:
+                        updates.append((starts_at, row["record_id"]))
+                await db.executemany(
+                    "UPDATE known_records SET starts_at = ? WHERE record_id = ?", updates
+                )
+            
+            # Миграция: номер принятого изменения — входит в ключ
+            # идемпотентности уведомления, чтобы повтор A→B→A→B не терялся
+            if "event_seq" not in columns:
+                print("📦 Миграция: добавляем event_seq в known_records")
+                await db.execute(
+                    "ALTER TABLE known_records ADD COLUMN event_seq INTEGER NOT NULL DEFAULT 0"
+                )
+            await db.execute(
+                "CREATE INDEX IF NOT EXISTS idx_known_records_status_starts "
+                "ON known_records(status, starts_at)"
+            )
+            
             await db.commit()
     
     async def get_known_record(self, record_id: int) -> Optional[dict]:
         """Получить известную запись"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.connection() as db:
             cursor = await db.execute(
                 "SELECT * FROM known_records WHERE record_id = ?",
                 (record_id,)
@@ -266,32 +1368,549 @@ class Database:
         record_date: str,
         record_time: str,
         record_hash: str,
-        status: str = "active"
+        status: str = "active",
+        client_id: Optional[int] = None,
+        starts_at: Optional[int] = None
     ):
         """Сохранить известную запись"""
-        async with aiosqlite.connect(self.db_path) as db:
-            await db.execute(
-                """INSERT OR REPLACE INTO known_records 
+        if starts_at is None:
+            starts_at = parse_known_starts_at(record_date, record_time)
+        await self._write(
+            """INSERT OR REPLACE INTO known_records 
+               (record_id, client_phone, client_name, service_name, staff_name, 
+                record_date, record_time, hash, status, client_id, starts_at, updated_at) 
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (record_id, client_phone, client_name, service_name, staff_name,
+             record_date, record_time, record_hash, status, client_id, starts_at, datetime.now())
+        )
+    
+    async def diff_known_records(
+        self,
+        snapshot: list,
+        window_start: Optional[str] = None,
+        window_end: Optional[str] = None
+    ) -> tuple:
+        """
+        Сравнить снимок записей из API с known_records одним проходом в SQL.
+        
+        snapshot — список dict с полями known_records (record_id, client_phone,
+        client_name, service_name, staff_name, record_date, record_time, hash,
+        client_id, starts_at).
+        Прошедшие записи в архиве (status = 'archived') новыми не считаются.
+        Удалёнными считаются только активные записи с датой внутри окна
+        [window_start, window_end], которых нет в снимке. Без окна
+        (снимок только изменённых записей) удалённые не ищутся.
+        
+        Возвращает (new_ids, changed, deleted_rows), где changed —
+        dict record_id -> прежний hash.
+        """
+        async with self.connection() as db:
+            await db.execute("""
+                CREATE TEMP TABLE IF NOT EXISTS fetched_records (
+                    record_id INTEGER PRIMARY KEY,
+                    client_phone TEXT,
+                    client_name TEXT,
+                    service_name TEXT,
+                    staff_name TEXT,
+                    record_date TEXT,
+                    record_time TEXT,
+                    hash TEXT,
+                    client_id INTEGER,
+                    starts_at INTEGER
+                )
+            """)
+            await db.execute("DELETE FROM fetched_records")
+            await db.executemany(
+                """INSERT OR REPLACE INTO fetched_records 
                    (record_id, client_phone, client_name, service_name, staff_name, 
-                    record_date, record_time, hash, status, updated_at) 
-                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                (record_id, client_phone, client_name, service_name, staff_name,
-                 record_date, record_time, record_hash, status, datetime.now())
+                    record_date, record_time, hash, client_id, starts_at) 
+                   VALUES (:record_id, :client_phone, :client_name, :service_name, 
+                           :staff_name, :record_date, :record_time, :hash, :client_id, 
+                           :starts_at)""",
+                snapshot
+            )
+            
+            cursor = await db.execute("""
+                SELECT f.record_id FROM fetched_records f
+                LEFT JOIN known_records k ON k.record_id = f.record_id
+                WHERE k.record_id IS NULL OR k.status = 'deleted'
+            """)
+            new_ids = [row[0] for row in await cursor.fetchall()]
+            
+            cursor = await db.execute("""
+                SELECT f.record_id, k.hash FROM fetched_records f
+                JOIN known_records k ON k.record_id = f.record_id
+                WHERE k.status = 'active' AND k.hash IS NOT f.hash
+            """)
+            changed = {row[0]: row[1] for row in await cursor.fetchall()}
+            
+            deleted_rows = []
+            if window_start is not None:
+                cursor = await db.execute(
+                    """SELECT k.* FROM known_records k
+                       WHERE k.status = 'active'
+                         AND k.record_date BETWEEN ? AND ?
+                         AND NOT EXISTS (
+                             SELECT 1 FROM fetched_records f WHERE f.record_id = k.record_id
+                         )""",
+                    (window_start, window_end)
+                )
+                deleted_rows = [dict(row) for row in await cursor.fetchall()]
+            
+            await db.execute("DELETE FROM fetched_records")
+            await db.commit()
+            return new_ids, changed, deleted_rows
+    
+    async def apply_record_events(self, events: list) -> list:
+        """
+        Применить события по записям (RecordEvent) к known_records одной
+        транзакцией с блокировкой записи — так webhook и polling из разных
+        процессов не примут одно изменение дважды.
+        
+        Событие без изменений (тот же отпечаток, уже удалённая запись)
+        и правки прошедших записей из архива отбрасываются.
+        Возвращает принятые: dict с kind (created / changed / cancelled),
+        record_id, old_hash, seq — номером изменения записи (растёт
+        с каждым принятым событием), row — строкой known_records
+        (для отмены — последней сохранённой) и previous — строкой
+        до изменения (для revert_record_events).
+        """
+        if not events:
+            return []
+        now = datetime.now()
+        accepted = []
+        async with self.connection() as db:
+            await db.execute("BEGIN IMMEDIATE")
+            try:
+                for event in events:
+                    cursor = await db.execute(
+                        "SELECT * FROM known_records WHERE record_id = ?",
+                        (event.record_id,)
+                    )
+                    row = await cursor.fetchone()
+                    row = dict(row) if row else None
+                    if row is not None and row["status"] == "archived":
+                        continue
+                    active = row is not None and row["status"] == "active"
+                    seq = (row["event_seq"] if row is not None else 0) + 1
+                    
+                    if event.deleted:
+                        if not active:
+                            continue
+                        await db.execute(
+                            "UPDATE known_records SET status = 'deleted', event_seq = ?, updated_at = ? "
+                            "WHERE record_id = ?",
+                            (seq, now, event.record_id)
+                        )
+                        accepted.append({
+                            "kind": "cancelled", "record_id": event.record_id,
+                            "old_hash": row["hash"], "seq": seq, "row": row, "previous": row
+                        })
+                        continue
+                    
+                    known = event.known
+                    if active and row["hash"] == known["hash"]:
+                        continue
+                    if active and _same_visit_legacy_hash(row, known):
+                        # Отпечаток старого формата, а визит тот же — только
+                        # обновляем отпечаток, без уведомления клиенту
+                        await db.execute(
+                            "UPDATE known_records SET hash = ? WHERE record_id = ?",
+                            (known["hash"], event.record_id)
+                        )
+                        continue
+                    await db.execute(
+                        """INSERT OR REPLACE INTO known_records 
+                           (record_id, client_phone, client_name, service_name, staff_name, 
+                            record_date, record_time, hash, status, client_id, starts_at, 
+                            event_seq, updated_at) 
+                           VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'active', ?, ?, ?, ?)""",
+                        (known["record_id"], known["client_phone"], known["client_name"],
+                         known["service_name"], known["staff_name"], known["record_date"],
+                         known["record_time"], known["hash"], known.get("client_id"),
+                         known.get("starts_at"), seq, now)
+                    )
+                    accepted.append({
+                        "kind": "changed" if active else "created",
+                        "record_id": event.record_id,
+                        "old_hash": row["hash"] if active else None,
+                        "seq": seq,
+                        "row": known,
+                        "previous": row if active else None
+                    })
+                await db.commit()
+            except BaseException:
+                await db.rollback()
+                raise
+        return accepted
+    
+    async def revert_record_events(self, changes: list):
+        """
+        Откатить принятые изменения (из apply_record_events), уведомление
+        о которых не удалось поставить в outbox: запись возвращается к
+        прежнему состоянию, и следующая сверка примет изменение заново.
+        Новая запись помечается удалённой, номер изменения (event_seq)
+        не уменьшается. Если по записи уже принято более новое изменение,
+        откат пропускается.
+        """
+        if not changes:
+            return
+        now = datetime.now()
+        async with self.connection() as db:
+            for change in changes:
+                previous = change["previous"]
+                if previous is None:
+                    await db.execute(
+                        "UPDATE known_records SET status = 'deleted', updated_at = ? "
+                        "WHERE record_id = ? AND event_seq = ?",
+                        (now, change["record_id"], change["seq"])
+                    )
+                    continue
+                await db.execute(
+                    """UPDATE known_records 
+                       SET client_phone = ?, client_name = ?, service_name = ?, staff_name = ?, 
+                           record_date = ?, record_time = ?, hash = ?, status = ?, 
+                           client_id = ?, starts_at = ?, updated_at = ? 
+                       WHERE record_id = ? AND event_seq = ?""",
+                    (previous["client_phone"], previous["client_name"], previous["service_name"],
+                     previous["staff_name"], previous["record_date"], previous["record_time"],
+                     previous["hash"], previous["status"], previous.get("client_id"),
+                     previous.get("starts_at"), now, change["record_id"], change["seq"])
+                )
+            await db.commit()
+    
+    async def get_active_known_records_by_ids(self, record_ids: list) -> list:
+        """Активные записи из known_records по списку ID"""
+        if not record_ids:
+            return []
+        placeholders = ",".join("?" * len(record_ids))
+        async with self.connection() as db:
+            cursor = await db.execute(
+                f"SELECT * FROM known_records "
+                f"WHERE status = 'active' AND record_id IN ({placeholders})",
+                list(record_ids)
+            )
+            return [dict(row) for row in await cursor.fetchall()]
+    
+    async def get_sync_state(self, key: str) -> Optional[str]:
+        """Значение из sync_state"""
+        async with self.connection() as db:
+            cursor = await db.execute("SELECT value FROM sync_state WHERE key = ?", (key,))
+            row = await cursor.fetchone()
+            return row[0] if row else None
+    
+    async def set_sync_state(self, key: str, value: str):
+        """Сохранить значение в sync_state"""
+        async with self.connection() as db:
+            await db.execute(
+                "INSERT OR REPLACE INTO sync_state (key, value, updated_at) VALUES (?, ?, ?)",
+                (key, value, datetime.now())
             )
             await db.commit()
     
     async def get_all_active_record_ids(self) -> set:
         """Получить все ID активных записей"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.connection() as db:
             cursor = await db.execute(
                 "SELECT record_id FROM known_records WHERE status = 'active'"
             )
             rows = await cursor.fetchall()
             return {row[0] for row in rows}
     
+    async def get_active_known_records(self, starts_after: Optional[int] = None) -> list:
+        """
+        Получить активные записи; starts_after (epoch) — только визиты,
+        начинающиеся позже (выборка по индексу status, starts_at)
+        """
+        async with self.connection() as db:
+            if starts_after is None:
+                cursor = await db.execute(
+                    "SELECT * FROM known_records WHERE status = 'active'"
+                )
+            else:
+                cursor = await db.execute(
+                    "SELECT * FROM known_records WHERE status = 'active' AND starts_at > ? "
+                    "ORDER BY starts_at",
+                    (starts_after,)
+                )
+            rows = await cursor.fetchall()
+            return [dict(row) for row in rows]
+    
+    async def archive_past_records(self, before: int) -> int:
+        """
+        Перевести записи, начавшиеся раньше before (epoch), в архив
+        (status = 'archived') и удалить их отработавшее расписание.
+        Возвращает число заархивированных записей.
+        """
+        async with self.connection() as db:
+            cursor = await db.execute(
+                "UPDATE known_records SET status = 'archived', updated_at = ? "
+                "WHERE status = 'active' AND starts_at < ?",
+                (datetime.now(), before)
+            )
+            archived = cursor.rowcount
+            await db.execute(
+                "DELETE FROM scheduled_messages WHERE state != 'pending' AND expires_at < ?",
+                (before,)
+            )
+            await db.commit()
+            return archived
+    
+    async def schedule_messages(self, items: list, replace: bool = True):
+        """
+        Записать моменты отправки: items — список
+        (record_id, kind, due_at, expires_at), время в секундах epoch.
+        replace=False не трогает уже запланированные (и отработавшие) строки.
+        """
+        if not items:
+            return
+        if replace:
+            sql = """INSERT INTO scheduled_messages (record_id, kind, due_at, expires_at, state) 
+                     VALUES (?, ?, ?, ?, 'pending') 
+                     ON CONFLICT(record_id, kind) DO UPDATE SET 
+                         due_at = excluded.due_at, 
+                         expires_at = excluded.expires_at, 
+                         state = 'pending'"""
+        else:
+            sql = """INSERT OR IGNORE INTO scheduled_messages 
+                     (record_id, kind, due_at, expires_at, state) 
+                     VALUES (?, ?, ?, ?, 'pending')"""
+        async with self.connection() as db:
+            await db.executemany(sql, items)
+            await db.commit()
+    
+    async def cancel_scheduled_messages(self, record_ids: list):
+        """Отменить запланированные отправки по записям"""
+        if not record_ids:
+            return
+        async with self.connection() as db:
+            await db.executemany(
+                "UPDATE scheduled_messages SET state = 'cancelled' "
+                "WHERE record_id = ? AND state = 'pending'",
+                [(record_id,) for record_id in record_ids]
+            )
+            await db.commit()
+    
+    async def get_next_scheduled_at(self) -> Optional[int]:
+        """Ближайший момент отправки (или None, если ничего не запланировано)"""
+        async with self.connection() as db:
+            cursor = await db.execute(
+                "SELECT MIN(due_at) FROM scheduled_messages WHERE state = 'pending'"
+            )
+            row = await cursor.fetchone()
+            return row[0]
+    
+    async def take_due_messages(self, now: int, limit: int = 100) -> list:
+        """
+        Забрать наступившие отправки (state -> firing) вместе с данными
+        записи из known_records. Отправки удалённых записей отменяются.
+        Взятые отправки нужно завершить: finish_scheduled_messages после
+        постановки в outbox или release_scheduled_messages при ошибке.
+        """
+        async with self.connection() as db:
+            cursor = await db.execute(
+                """UPDATE scheduled_messages SET state = 'firing' 
+                   WHERE rowid IN (
+                       SELECT rowid FROM scheduled_messages 
+                       WHERE state = 'pending' AND due_at <= ? 
+                       ORDER BY due_at LIMIT ?
+                   ) 
+                   RETURNING record_id, kind, due_at, expires_at""",
+                (now, limit)
+            )
+            due = [dict(row) for row in await cursor.fetchall()]
+            
+            records = {}
+            if due:
+                record_ids = list({item["record_id"] for item in due})
+                placeholders = ",".join("?" * len(record_ids))
+                cursor = await db.execute(
+                    f"SELECT * FROM known_records "
+                    f"WHERE status = 'active' AND record_id IN ({placeholders})",
+                    record_ids
+                )
+                records = {row["record_id"]: dict(row) for row in await cursor.fetchall()}
+                
+                gone = [(item["record_id"], item["kind"]) for item in due if item["record_id"] not in records]
+                await db.executemany(
+                    "UPDATE scheduled_messages SET state = 'cancelled' WHERE record_id = ? AND kind = ?",
+                    gone
+                )
+            await db.commit()
+        
+        result = []
+        for item in sorted(due, key=lambda item: item["due_at"]):
+            record = records.get(item["record_id"])
+            if record is not None:
+                result.append({**record, **item})
+        return result
+    
+    async def finish_scheduled_messages(self, keys: list):
+        """Отправки (record_id, kind) поставлены в outbox: firing -> fired"""
+        if not keys:
+            return
+        async with self.connection() as db:
+            await db.executemany(
+                "UPDATE scheduled_messages SET state = 'fired' "
+                "WHERE record_id = ? AND kind = ? AND state = 'firing'",
+                keys
+            )
+            await db.commit()
+    
+    async def release_scheduled_messages(self, keys: list, due_at: int):
+        """Вернуть взятые отправки (record_id, kind) в расписание с новой попыткой в due_at"""
+        if not keys:
+            return
+        async with self.connection() as db:
+            await db.executemany(
+                "UPDATE scheduled_messages SET state = 'pending', due_at = ? "
+                "WHERE record_id = ? AND kind = ? AND state = 'firing'",
+                [(due_at, record_id, kind) for record_id, kind in keys]
+            )
+            await db.commit()
+    
+    async def requeue_firing_messages(self) -> int:
+        """Вернуть в расписание отправки, прерванные перезапуском (firing -> pending)"""
+        async with self.connection() as db:
+            cursor = await db.execute(
+                "UPDATE scheduled_messages SET state = 'pending' WHERE state = 'firing'"
+            )
+            await db.commit()
+            return cursor.rowcount
+    
+    async def archive_rows(
+        self,
+        table: str,
+        time_column: str,
+        cutoff,
+        archive_path,
+        condition: Optional[str] = None,
+        epoch: bool = False
+    ) -> dict:
+        """
+        Перенести строки table старше cutoff в помесячные архивные базы.
+        archive_path(month) — путь к базе месяца "YYYY-MM"; база
+        подключается (ATTACH) только на время переноса.
+        time_column хранит текст "YYYY-MM-DD HH:MM:SS" или epoch (epoch=True).
+        condition — какие строки вообще можно переносить (например,
+        только завершённые). Возвращает dict месяц -> перенесено строк.
+        
+        В WAL коммит основной и архивной баз не атомарен: при падении между
+        ними строки остаются в основной базе и уже лежат в архиве. Архив
+        хранит исходный id как PRIMARY KEY, и повторный запуск пропускает
+        такие строки (INSERT OR IGNORE) — дубли не появляются, а в худшем
+        случае после сбоя строка есть и там, и там до следующего прогона.
+        """
+        month_expr = (
+            f"strftime('%Y-%m', {time_column}, 'unixepoch', 'localtime')"
+            if epoch else f"strftime('%Y-%m', {time_column})"
+        )
+        where = f"{time_column} < ?" + (f" AND {condition}" if condition else "")
+        moved = {}
+        async with self.connection() as db:
+            cursor = await db.execute(
+                f"SELECT DISTINCT {month_expr} FROM {table} WHERE {where}", (cutoff,)
+            )
+            months = sorted(row[0] for row in await cursor.fetchall() if row[0])
+            
+            cursor = await db.execute(f"PRAGMA main.table_info({table})")
+            table_info = await cursor.fetchall()
+            columns = [row["name"] for row in table_info]
+            column_list = ", ".join(columns)
+            # Без ограничений исходной таблицы, кроме ключа id
+            column_defs = ", ".join(
+                f"{row['name']} INTEGER PRIMARY KEY" if row["pk"]
+                else f"{row['name']} {row['type']}".rstrip()
+                for row in table_info
+            )
+            
+            for month in months:
+                path = archive_path(month)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                await db.execute("ATTACH DATABASE ? AS archive", (path,))
+                try:
+                    await db.execute(
+                        f"CREATE TABLE IF NOT EXISTS archive.{table} ({column_defs})"
+                    )
+                    # Колонки, добавленные миграциями после создания архива
+                    cursor = await db.execute(f"PRAGMA archive.table_info({table})")
+                    archived_columns = {row["name"] for row in await cursor.fetchall()}
+                    for column in columns:
+                        if column not in archived_columns:
+                            await db.execute(f"ALTER TABLE archive.{table} ADD COLUMN {column}")
+                    
+                    params = (cutoff, month)
+                    await db.execute(
+                        f"INSERT OR IGNORE INTO archive.{table} ({column_list}) "
+                        f"SELECT {column_list} FROM main.{table} "
+                        f"WHERE {where} AND {month_expr} = ?",
+                        params
+                    )
+                    cursor = await db.execute(
+                        f"DELETE FROM main.{table} WHERE {where} AND {month_expr} = ?",
+                        params
+                    )
+                    moved[month] = cursor.rowcount
+                    await db.commit()
+                except BaseException:
+                    await db.rollback()
+                    raise
+                finally:
+                    await db.execute("DETACH DATABASE archive")
+        return moved
+    
+    async def get_storage_stats(self) -> dict:
+        """Размер базы: страницы, свободные страницы, байты (с WAL)"""
+        async with self.connection() as db:
+            stats = {}
+            for pragma in ("page_count", "page_size", "freelist_count", "auto_vacuum"):
+                cursor = await db.execute(f"PRAGMA {pragma}")
+                stats[pragma] = (await cursor.fetchone())[0]
+        size = 0
+        for path in (self.db_path, f"{self.db_path}-wal"):
+            if os.path.exists(path):
+                size += os.path.getsize(path)
+        stats["bytes"] = size
+        return stats
+    
+    async def enable_incremental_vacuum(self) -> bool:
+        """
+        Включить auto_vacuum = INCREMENTAL. Для существующей базы нужен
+        один полный VACUUM — он требует монопольного доступа, поэтому
+        вызывается из ночного retention. Возвращает True, если режим включён.
+        """
+        async with self.connection() as db:
+            cursor = await db.execute("PRAGMA auto_vacuum")
+            if (await cursor.fetchone())[0] == 2:
+                return True
+            print("📦 Миграция: включаем incremental auto_vacuum (полный VACUUM)")
+            try:
+                await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                await db.execute("VACUUM")
+            except sqlite3.OperationalError as e:
+                print(f"⚠️ VACUUM не выполнен (база занята?): {e}")
+                return False
+            cursor = await db.execute("PRAGMA auto_vacuum")
+            return (await cursor.fetchone())[0] == 2
+    
+    async def incremental_vacuum(self, pages: int) -> int:
+        """Вернуть ОС до pages свободных страниц. Возвращает, сколько осталось"""
+        async with self.connection() as db:
+            cursor = await db.execute(f"PRAGMA incremental_vacuum({int(pages)})")
+            await cursor.fetchall()
+            await db.commit()
+            cursor = await db.execute("PRAGMA freelist_count")
+            return (await cursor.fetchone())[0]
+    
+    async def checkpoint(self):
+        """Перенести WAL в основной файл и обрезать его (после VACUUM WAL раздувается)"""
+        async with self.connection() as db:
+            cursor = await db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            await cursor.fetchall()
+    
     async def mark_record_deleted(self, record_id: int):
         """Отметить запись как удалённую"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.connection() as db:
             await db.execute(
                 "UPDATE known_records SET status = 'deleted', updated_at = ? WHERE record_id = ?",
                 (datetime.now(), record_id)
@@ -0,0 +1,81 @@
+"""
+Общие HTTP клиенты для внешних API
+Один keep-alive httpx.AsyncClient на каждый upstream-хост вместо
+нового соединения (DNS + TCP + TLS) на каждый запрос
+"""
+import importlib.util
+from typing import Optional
+
+import httpx
+
+from config import config
+
+
+def _http2_available() -> bool:
+    """HTTP/2 в httpx требует пакет h2 (pip install httpx[http2])"""
+    return importlib.util.find_spec("h2") is not None
+
+
+class HttpClients:
+    """
+    Реестр HTTP клиентов по upstream:
+    - "yclients" — REST API и чат YClients (api.yclients.com)
+    - "telegram_bot" — Telegram Bot API (api.telegram.org)
+    """
+    
+    def __init__(self):
+        self._clients = {}
+    
+    def _settings(self, upstream: str) -> dict:
+        """Лимиты и таймауты для upstream"""
+        if upstream == "yclients":
+            return {
+                "timeout": httpx.Timeout(config.YCLIENTS_HTTP_TIMEOUT, connect=5.0),
+                "limits": httpx.Limits(
+                    max_connections=config.YCLIENTS_HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=config.YCLIENTS_HTTP_MAX_CONNECTIONS,
+                    keepalive_expiry=60.0
+                ),
+            }
+        if upstream == "telegram_bot":
+            return {
+                "timeout": httpx.Timeout(config.BOT_API_HTTP_TIMEOUT, connect=5.0),
+                "limits": httpx.Limits(
+                    max_connections=config.BOT_API_HTTP_MAX_CONNECTIONS,
+                    max_keepalive_connections=config.BOT_API_HTTP_MAX_CONNECTIONS,
+                    keepalive_expiry=60.0
+                ),
+            }
+        raise ValueError(f"Неизвестный upstream: {upstream}")
+    
+    def get(self, upstream: str) -> httpx.AsyncClient:
+        """
+        Клиент для upstream. Создаётся при первом обращении,
+        поэтому работает и в скриптах без явного start()
+        """
+        client: Optional[httpx.AsyncClient] = self._clients.get(upstream)
+        if client is None or client.is_closed:
+            http2 = config.HTTP2_ENABLED and _http2_available()
+            client = httpx.AsyncClient(http2=http2, **self._settings(upstream))
+            self._clients[upstream] = client
+        return client
+    
+    async def start(self):
+        """Открыть клиенты при старте приложения"""
+        if config.HTTP2_ENABLED and not _http2_available():
+            print("⚠️ HTTP2_ENABLED, но пакет h2 не установлен — используем HTTP/1.1")
+        for upstream in ("yclients", "telegram_bot"):
+            self.get(upstream)
+    
+    async def close(self):
+        """Закрыть все соединения при остановке"""
+        clients, self._clients = self._clients, {}
+        for client in clients.values():
+            try:
+                await client.aclose()
+            except Exception:
+                pass
+
+
+# Синглтон
+http_clients = HttpClients()
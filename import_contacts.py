@@ -6,40 +6,26 @@ import asyncio
 from datetime import datetime
 
 from config import config
+from database import db
 from yclients_api import yclients
+from http_clients import http_clients
 from telegram_client import telegram
 
 
 async def get_all_clients():
     """Получить всех клиентов из YClients"""
     all_clients = []
-    page = 1
-    count = 200  # Максимум за раз
     
     print("📥 Загружаем клиентов из YClients...")
     
-    while True:
-        try:
-            result = await yclients.get_clients(page=page, count=count)
-            
-            if not result.get("success") or not result.get("data"):
-                break
-            
-            clients = result["data"]
-            all_clients.extend(clients)
-            
-            total = result.get("meta", {}).get("total_count", len(all_clients))
-            print(f"   Страница {page}: загружено {len(clients)} клиентов (всего: {len(all_clients)}/{total})")
-            
-            if len(clients) < count:
-                break
-            
-            page += 1
-            await asyncio.sleep(0.5)  # Пауза между запросами
-            
-        except Exception as e:
-            print(f"❌ Ошибка на странице {page}: {e}")
-            break
+    try:
+        # Страницы запрашиваются параллельно, клиенты приходят по мере загрузки
+        async for client in yclients.iter_clients(count=200):
+            all_clients.append(client)
+            if len(all_clients) % 1000 == 0:
+                print(f"   Загружено {len(all_clients)} клиентов...")
+    except Exception as e:
+        print(f"❌ Ошибка загрузки клиентов: {e}")
     
     print(f"✅ Всего загружено: {len(all_clients)} клиентов")
     return all_clients
@@ -69,6 +55,7 @@ async def import_contacts_to_telegram(clients: list):
         last_name = " ".join(name_parts[1:]) if len(name_parts) > 1 else ""
         
         contacts_to_import.append({
+            "yclients_client_id": client.get("id"),
             "phone": normalized,
             "first_name": first_name,
             "last_name": last_name
@@ -98,8 +85,12 @@ async def import_contacts_to_telegram(clients: list):
                 ImportContacts(contacts=input_contacts)
             )
             
-            imported = len(result.users) if result.users else 0
+            # Найденные пользователи сразу попадают в индекс контактов
+            imported = telegram.index_imported_contacts(
+                result, {idx: c["phone"] for idx, c in enumerate(batch)}
+            )
             imported_count += imported
+            await save_imported_links(result, batch)
             
             print(f"   Партия {i//batch_size + 1}: {imported} из {len(batch)} найдено в Telegram")
             
@@ -111,6 +102,24 @@ async def import_contacts_to_telegram(clients: list):
     return imported_count, len(contacts_to_import)
 
 
+async def save_imported_links(result, batch: list):
+    """
+    Сохранить найденных пользователей в client_telegram_links —
+    запущенный сервис подхватит их при старте без новых ImportContacts
+    """
+    users = {user.id: user for user in (result.users or [])}
+    for imported in result.imported or []:
+        contact = batch[imported.client_id]
+        if not contact["yclients_client_id"]:
+            continue
+        await db.link_client_telegram(
+            yclients_client_id=contact["yclients_client_id"],
+            phone=contact["phone"],
+            telegram_user_id=imported.user_id,
+            telegram_username=getattr(users.get(imported.user_id), "username", None)
+        )
+
+
 async def main():
     print("=" * 60)
     print("🚀 Импорт контактов YClients → Telegram")
@@ -118,38 +127,44 @@ async def main():
     print(f"⏰ Начало: {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
     print()
     
-    # Запускаем Telegram клиент
-    print("📱 Подключение к Telegram...")
-    await telegram.start()
-    print("✅ Telegram подключен!")
-    print()
-    
-    # Получаем клиентов
-    clients = await get_all_clients()
-    
-    if not clients:
-        print("❌ Нет клиентов для импорта")
+    # Пул соединений с БД открывается уже в telegram.start() — закрываем
+    # его в finally, иначе скрипт не завершится
+    try:
+        await db.init()
+        
+        # Запускаем Telegram клиент
+        print("📱 Подключение к Telegram...")
+        await telegram.start()
+        print("✅ Telegram подключен!")
+        print()
+        
+        # Получаем клиентов
+        clients = await get_all_clients()
+        
+        if not clients:
+            print("❌ Нет клиентов для импорта")
+            return
+        
+        # Импортируем контакты
+        imported, total = await import_contacts_to_telegram(clients)
+        
+        print()
+        print("=" * 60)
+        print(f"✅ ГОТОВО!")
+        print(f"   Всего клиентов: {len(clients)}")
+        print(f"   С телефонами: {total}")
+        print(f"   Найдено в Telegram: {imported}")
+        print(f"   Процент покрытия: {imported/total*100:.1f}%")
+        print("=" * 60)
+        print()
+        print("💡 Теперь сообщения будут доходить этим клиентам!")
+        print("   Клиенты без Telegram или с закрытыми настройками")
+        print("   не будут получать сообщения — это ограничение Telegram.")
+        print()
+    finally:
         await telegram.stop()
-        return
-    
-    # Импортируем контакты
-    imported, total = await import_contacts_to_telegram(clients)
-    
-    print()
-    print("=" * 60)
-    print(f"✅ ГОТОВО!")
-    print(f"   Всего клиентов: {len(clients)}")
-    print(f"   С телефонами: {total}")
-    print(f"   Найдено в Telegram: {imported}")
-    print(f"   Процент покрытия: {imported/total*100:.1f}%")
-    print("=" * 60)
-    print()
-    print("💡 Теперь сообщения будут доходить этим клиентам!")
-    print("   Клиенты без Telegram или с закрытыми настройками")
-    print("   не будут получать сообщения — это ограничение Telegram.")
-    print()
-    
-    await telegram.stop()
+        await http_clients.close()
+        await db.close()
 
 
 if __name__ == "__main__":
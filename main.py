@@ -10,11 +10,16 @@ from datetime import datetime
 
 from config import config
 from database import db
+from http_clients import http_clients
 from telegram_client import telegram
+from send_dispatcher import PRIORITY_HIGH
 from scheduler import reminder_scheduler
+from outbox import outbox
+from reminder_timer import reminder_timer
 from yclients_api import yclients
 from yclients_chat import yclients_chat  # Интеграция с чатом YClients
 from templates import msg_confirmed
+from bot_checker import bot_index
 from datetime import datetime
 
 
@@ -63,11 +68,12 @@ async def handle_incoming_message(message):
                 
                 # Отправляем подтверждение
                 confirm_text = msg_confirmed(client_name, record_datetime)
-                await telegram.send_message(
+                await telegram.enqueue(
                     phone_or_user_id=user_id,
                     text=confirm_text,
                     record_id=record_id,
-                    yclients_client_id=yclients_client_id
+                    yclients_client_id=yclients_client_id,
+                    priority=PRIORITY_HIGH
                 )
                 
                 print(f"✅ Запись #{record_id} подтверждена клиентом!")
@@ -138,48 +144,53 @@ async def main():
         print("\nСоздайте файл .env по примеру .env.example")
         sys.exit(1)
     
-    # Инициализация БД
-    print("\n📦 Инициализация базы данных...")
-    await db.init()
-    
-    # Запуск Telegram клиента
-    print("\n📱 Подключение к Telegram...")
-    telegram.add_message_handler(handle_incoming_message)
-    await telegram.start()
-    
-    # Проверка подключения к YClients
-    print("\n🔗 Проверка подключения к YClients...")
+    # Запуск и работа — внутри try: при ошибке старта (авторизация Telegram,
+    # сеть) finally всё равно закроет пул БД, иначе процесс не завершится
     try:
-        staff = await yclients.get_staff()
-        if staff.get("success"):
-            print(f"   ✅ Подключено! Сотрудников: {len(staff.get('data', []))}")
-        else:
-            print("   ⚠️ Не удалось получить данные (проверьте токены)")
-    except Exception as e:
-        print(f"   ❌ Ошибка подключения: {e}")
-    
-    # Первичная синхронизация записей (polling)
-    print("\n🔍 Первичная синхронизация записей...")
-    await db.init_records_tracking()
-    await reminder_scheduler.initial_sync()
-    
-    # Запуск планировщика напоминаний
-    print("\n⏰ Запуск планировщика...")
-    reminder_scheduler.start()
-    
-    print("\n" + "=" * 50)
-    print("✅ Система запущена и готова к работе!")
-    print("=" * 50)
-    print("\n📊 Режим работы: POLLING (без webhook)")
-    print("   - Проверка новых записей: каждые 60 секунд")
-    print("   - Напоминания: каждые 5 минут")
-    print("   - За 24 часа до визита — подтверждение")
-    print("   - За 1 час до визита — напоминание")
-    print("\nДля остановки нажмите Ctrl+C\n")
-    
-    # Бесконечный цикл работы
-    try:
-        # Ждём пока не будет сигнала остановки
+        # Инициализация БД
+        print("\n📦 Инициализация базы данных...")
+        await db.init()
+        await http_clients.start()
+        bot_index.start()
+        
+        # Запуск Telegram клиента
+        print("\n📱 Подключение к Telegram...")
+        telegram.add_message_handler(handle_incoming_message)
+        await telegram.start()
+        await outbox.start()
+        
+        # Проверка подключения к YClients
+        print("\n🔗 Проверка подключения к YClients...")
+        try:
+            staff = await yclients.get_staff()
+            if staff.get("success"):
+                print(f"   ✅ Подключено! Сотрудников: {len(staff.get('data', []))}")
+            else:
+                print("   ⚠️ Не удалось получить данные (проверьте токены)")
+        except Exception as e:
+            print(f"   ❌ Ошибка подключения: {e}")
+        
+        # Первичная синхронизация записей (polling)
+        print("\n🔍 Первичная синхронизация записей...")
+        await db.init_records_tracking()
+        await reminder_scheduler.initial_sync()
+        
+        # Запуск планировщика напоминаний
+        print("\n⏰ Запуск планировщика...")
+        reminder_scheduler.start()
+        reminder_timer.start()
+        
+        print("\n" + "=" * 50)
+        print("✅ Система запущена и готова к работе!")
+        print("=" * 50)
+        print("\n📊 Режим работы: POLLING (без webhook)")
+        print(f"   - Проверка новых записей: каждые {config.POLL_MIN_SECONDS}-{config.POLL_MAX_SECONDS} секунд")
+        print("   - Напоминания: точно по расписанию")
+        print("   - За 24 часа до визита — подтверждение")
+        print("   - За 1 час до визита — напоминание")
+        print("\nДля остановки нажмите Ctrl+C\n")
+        
+        # Бесконечный цикл работы — ждём сигнала остановки
         while True:
             await asyncio.sleep(60)
     except KeyboardInterrupt:
@@ -187,7 +198,12 @@ async def main():
     finally:
         print("\n🛑 Завершение работы...")
         reminder_scheduler.stop()
+        await reminder_timer.stop()
+        await outbox.stop()
         await telegram.stop()
+        await bot_index.stop()
+        await http_clients.close()
+        await db.close()
         print("👋 До свидания!")
 
 
@@ -0,0 +1,194 @@
+"""
+Outbox — надёжная доставка исходящих сообщений
+Планировщик и webhook только ставят сообщения в таблицу outbox
+(с ключом идемпотентности), а воркеры доставляют их с повторными попытками.
+Очередь переживает перезапуск процесса.
+
+Состояния: queued → sending → sent | failed (повтор позже) | dead
+Ожидающее сообщение можно придержать (held) на время склейки.
+"""
+import asyncio
+import json
+import time
+from datetime import datetime
+from typing import Optional
+
+from config import config
+from database import db
+from telegram_client import telegram
+from bot_checker import send_via_bot
+from send_dispatcher import PRIORITY_NORMAL
+
+
+class Outbox:
+    def __init__(self):
+        self._tasks = []
+        self._wakeup: Optional[asyncio.Event] = None
+    
+    async def enqueue(
+        self,
+        idempotency_key: str,
+        recipient,
+        text: str,
+        channel: str = "userbot",
+        record_id: Optional[int] = None,
+        yclients_client_id: Optional[int] = None,
+        reminder_type: Optional[str] = None,
+        priority: int = PRIORITY_NORMAL,
+        deadline: Optional[datetime] = None,
+        meta: Optional[dict] = None,
+        delay: float = 0,
+        coalesce_key: Optional[str] = None,
+        reminder_record_id: Optional[int] = None,
+        replace_ids: Optional[list] = None
+    ) -> bool:
+        """
+        Поставить сообщение в очередь.
+        recipient — телефон (userbot) или chat_id (bot).
+        reminder_type — после отправки запись попадёт в sent_reminders
+        с ключом reminder_record_id (по умолчанию — record_id).
+        delay — не отправлять раньше чем через столько секунд; пока сообщение
+        ждёт, его можно придержать по coalesce_key (db.hold_queued_outbox)
+        и заменить новым — replace_ids.
+        Возвращает False, если сообщение с таким ключом уже есть.
+        """
+        added = await db.enqueue_outbox(
+            idempotency_key=idempotency_key,
+            recipient=recipient,
+            message_text=text,
+            channel=channel,
+            record_id=record_id,
+            yclients_client_id=yclients_client_id,
+            reminder_type=reminder_type,
+            priority=priority,
+            deadline_at=int(deadline.timestamp()) if deadline else None,
+            meta=json.dumps(meta) if meta else None,
+            next_attempt_at=int(time.time() + delay) if delay else None,
+            coalesce_key=coalesce_key,
+            reminder_record_id=reminder_record_id,
+            replace_ids=replace_ids
+        )
+        if added and self._wakeup is not None:
+            self._wakeup.set()
+        return added
+    
+    async def start(self):
+        """Запустить доставку (и вернуть в очередь прерванные отправки)"""
+        if self._tasks:
+            return
+        interrupted = await db.requeue_interrupted_outbox()
+        if interrupted:
+            print(f"📮 Outbox: {interrupted} прерванных отправок возвращено в очередь")
+        self._wakeup = asyncio.Event()
+        workers = max(1, config.OUTBOX_WORKERS)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(workers)]
+    
+    async def stop(self):
+        """Остановить доставку"""
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+    
+    async def _worker(self):
+        """
+        Воркер доставки: берёт по OUTBOX_CLAIM_BATCH сообщений, поэтому
+        срочные не ждут, пока разойдётся большая пачка. Сообщения одному
+        получателю идут строго по порядку — claim_outbox не отдаёт
+        получателя, которому уже отправляет другой воркер.
+        """
+        while True:
+            self._wakeup.clear()
+            try:
+                rows = await db.claim_outbox(limit=config.OUTBOX_CLAIM_BATCH)
+            except Exception as e:
+                print(f"❌ Outbox: ошибка чтения очереди: {e}")
+                rows = []
+            
+            if not rows:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), config.OUTBOX_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            for row in rows:
+                await self._deliver(row)
+            # Освободились — пусть свободные воркеры заберут отложенных получателей
+            self._wakeup.set()
+    
+    async def _deliver(self, row: dict):
+        """Доставить одно сообщение и записать результат"""
+        if row["deadline_at"] and time.time() > row["deadline_at"]:
+            print(f"⌛ Outbox: {row['idempotency_key']} устарело, не отправляем")
+            await db.fail_outbox(row["id"], "deadline expired", None)
+            return
+        
+        message_id = None
+        try:
+            if row["channel"] == "bot":
+                delivered = await send_via_bot(int(row["recipient"]), row["message_text"])
+            else:
+                message = await telegram.enqueue(
+                    phone_or_user_id=row["recipient"],
+                    text=row["message_text"],
+                    record_id=row["record_id"],
+                    yclients_client_id=row["yclients_client_id"],
+                    priority=row["priority"],
+                    deadline=row["deadline_at"]
+                )
+                delivered = message is not None
+                if message is not None:
+                    message_id = message.id
+        except Exception as e:
+            delivered = False
+            error = str(e)
+        else:
+            error = "not delivered"
+        
+        if delivered:
+            await db.complete_outbox(
+                row["id"],
+                telegram_message_id=message_id,
+                record_id=(
+                    row["reminder_record_id"] if row["reminder_record_id"] is not None
+                    else row["record_id"]
+                ),
+                reminder_type=row["reminder_type"]
+            )
+            if message_id is not None:
+                try:
+                    await self._after_sent(row, message)
+                except Exception as e:
+                    print(f"⚠️ Outbox: ошибка обработки после отправки {row['idempotency_key']}: {e}")
+            return
+        
+        if row["attempts"] >= config.OUTBOX_MAX_ATTEMPTS:
+            print(f"☠️ Outbox: {row['idempotency_key']} не доставлено за {row['attempts']} попыток")
+            await db.fail_outbox(row["id"], error, None)
+        else:
+            delay = config.OUTBOX_RETRY_SECONDS * 2 ** (row["attempts"] - 1)
+            await db.fail_outbox(row["id"], error, int(time.time() + delay))
+    
+    async def _after_sent(self, row: dict, message):
+        """Действия после отправки, описанные в meta"""
+        if not row["meta"]:
+            return
+        meta = json.loads(row["meta"])
+        
+        # Запрос подтверждения за 24ч — ждём ответа клиента
+        if "pending_confirmation" in meta:
+            await db.add_pending_confirmation(
+                record_id=row["record_id"],
+                telegram_user_id=message.chat.id,
+                yclients_client_id=row["yclients_client_id"],
+                record_datetime=meta["pending_confirmation"]["record_datetime"]
+            )
+
+
+# Синглтон
+outbox = Outbox()
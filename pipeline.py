@@ -0,0 +1,235 @@
+"""
+Конвейер обработки для проходов планировщика
+Каждый этап (маршрутизация, поиск в Telegram, подготовка текста, постановка
+в outbox) работает своим числом воркеров и читает из своей ограниченной
+очереди, поэтому ожидания ввода-вывода разных этапов перекрываются.
+Элементы с одинаковым ключом (получатель) всегда попадают к одному воркеру
+этапа и проходят конвейер в исходном порядке.
+"""
+import asyncio
+import itertools
+from typing import AsyncIterable, Awaitable, Callable, Iterable, Optional, Union
+
+from config import config
+from database import db, phone_key
+from telegram_client import telegram
+from outbox import outbox
+from bot_checker import get_bot_client_chat_id
+
+
+# Маркер конца потока в очередях этапов
+_DONE = object()
+
+
+class Stage:
+    """
+    Этап конвейера.
+    func(item) возвращает элемент для следующего этапа или None (элемент
+    отброшен). При batch_size > 1 func получает список элементов
+    (сколько накопилось в очереди за batch_wait секунд, но не больше
+    batch_size) и возвращает список прошедших дальше.
+    """
+    
+    def __init__(
+        self,
+        name: str,
+        func: Callable[..., Awaitable],
+        workers: int = 1,
+        batch_size: int = 1,
+        batch_wait: float = 0
+    ):
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.batch_size = max(1, batch_size)
+        self.batch_wait = batch_wait
+
+
+class Pipeline:
+    """
+    on_error(items) вызывается для элементов, на которых этап упал
+    (сами элементы дальше не идут, конвейер продолжает работу)
+    """
+    
+    def __init__(
+        self,
+        stages: list,
+        key: Optional[Callable] = None,
+        queue_size: int = 100,
+        on_error: Optional[Callable[[list], None]] = None
+    ):
+        self.stages = stages
+        self.key = key
+        self.queue_size = queue_size
+        self.on_error = on_error
+        self._round_robin = itertools.count()
+    
+    def _partition(self, item, workers: int) -> int:
+        """Номер воркера этапа для элемента"""
+        if workers == 1:
+            return 0
+        if self.key is None:
+            return next(self._round_robin) % workers
+        return hash(self.key(item)) % workers
+    
+    async def run(self, source: Union[Iterable, AsyncIterable]) -> int:
+        """
+        Прогнать элементы источника через все этапы.
+        Возвращает количество элементов, прошедших последний этап.
+        """
+        queues = [
+            [asyncio.Queue(self.queue_size) for _ in range(stage.workers)]
+            for stage in self.stages
+        ]
+        completed = 0
+        
+        async def put(index: int, item):
+            if index == len(self.stages):
+                nonlocal completed
+                completed += 1
+                return
+            stage_queues = queues[index]
+            await stage_queues[self._partition(item, len(stage_queues))].put(item)
+        
+        async def process(index: int, items: list):
+            stage = self.stages[index]
+            try:
+                if stage.batch_size > 1:
+                    results = await stage.func(items) or []
+                else:
+                    results = [await stage.func(items[0])]
+            except Exception as e:
+                print(f"❌ Конвейер, этап {stage.name}: {e}")
+                if self.on_error is not None:
+                    self.on_error(items)
+                return
+            for result in results:
+                if result is not None:
+                    await put(index + 1, result)
+        
+        async def worker(index: int, queue: asyncio.Queue):
+            stage = self.stages[index]
+            loop = asyncio.get_running_loop()
+            while True:
+                item = await queue.get()
+                if item is _DONE:
+                    return
+                items = [item]
+                done = False
+                batch_until = loop.time() + stage.batch_wait
+                while len(items) < stage.batch_size:
+                    # Добираем пачку: что уже в очереди, а потом ждём до batch_wait
+                    if queue.empty():
+                        remaining = batch_until - loop.time()
+                        if remaining <= 0:
+                            break
+                        try:
+                            item = await asyncio.wait_for(queue.get(), remaining)
+                        except asyncio.TimeoutError:
+                            break
+                    else:
+                        item = queue.get_nowait()
+                    if item is _DONE:
+                        done = True
+                        break
+                    items.append(item)
+                await process(index, items)
+                if done:
+                    return
+        
+        async def run_stage(index: int):
+            await asyncio.gather(*(worker(index, queue) for queue in queues[index]))
+            # Этап закончил — закрываем следующий
+            if index + 1 < len(self.stages):
+                for queue in queues[index + 1]:
+                    await queue.put(_DONE)
+        
+        async def feed():
+            if hasattr(source, "__aiter__"):
+                async for item in source:
+                    await put(0, item)
+            else:
+                for item in source:
+                    await put(0, item)
+            for queue in queues[0]:
+                await queue.put(_DONE)
+        
+        tasks = [asyncio.create_task(run_stage(i)) for i in range(len(self.stages))]
+        try:
+            await feed()
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        return completed
+
+
+# === Конвейер уведомлений клиентам ===
+# Элемент — dict с телефоном получателя ("phone") и, для напоминаний,
+# парой "reminder" = (record_id, reminder_type) для sent_reminders.
+# Маршрутизация добавляет "bot_chat_id" для отправки через бота,
+# этап render — "message" (аргументы outbox.enqueue).
+
+async def route_recipient(item: dict) -> Optional[dict]:
+    """
+    Маршрутизация: уже отправленные напоминания отбрасываются.
+    Клиенту бота пишем через бота, если элемент это разрешает ("via_bot"),
+    иначе бот отправит сам (напоминание отмечается отправленным)
+    """
+    reminder = item.get("reminder")
+    if reminder and await db.is_reminder_sent(*reminder):
+        return None
+    bot_chat_id = await get_bot_client_chat_id(item["phone"])
+    if bot_chat_id:
+        if item.get("via_bot"):
+            print(f"🤖 Клиент в боте (chat_id={bot_chat_id}), отправим через бота")
+            return {**item, "bot_chat_id": bot_chat_id}
+        print(f"   ℹ️ Клиент {item['phone']} подключил бота - уведомление отправит бот")
+        if reminder:
+            await db.mark_reminder_sent(*reminder, 0)
+        return None
+    return item
+
+
+async def resolve_recipients(items: list) -> list:
+    """Поиск неизвестных номеров в Telegram одним пакетом"""
+    await telegram.resolve_phones(item["phone"] for item in items)
+    return items
+
+
+async def send_notification(item: dict) -> dict:
+    """Постановка сообщения в outbox"""
+    if item.get("bot_chat_id"):
+        await outbox.enqueue(recipient=item["bot_chat_id"], channel="bot", **item["message"])
+    else:
+        await outbox.enqueue(recipient=item["phone"], **item["message"])
+    return item
+
+
+def notification_pipeline(
+    render: Callable[[dict], Optional[dict]],
+    before: list = (),
+    on_error: Optional[Callable[[list], None]] = None
+) -> Pipeline:
+    """
+    Конвейер: [before...] -> маршрутизация -> поиск в Telegram ->
+    текст (render возвращает аргументы outbox.enqueue или None) -> outbox.
+    on_error — элементы, которые не дошли до outbox из-за ошибки
+    """
+    async def render_stage(item: dict) -> Optional[dict]:
+        message = render(item)
+        if message is None:
+            return None
+        return {**item, "message": message}
+    
+    return Pipeline(
+        list(before) + [
+            Stage("route", route_recipient, workers=config.PIPELINE_ROUTE_WORKERS),
+            Stage("resolve", resolve_recipients, batch_size=100, batch_wait=config.PIPELINE_BATCH_WAIT),
+            Stage("render", render_stage),
+            Stage("send", send_notification, workers=config.PIPELINE_SEND_WORKERS),
+        ],
+        key=lambda item: phone_key(item["phone"]),
+        queue_size=config.PIPELINE_QUEUE_SIZE,
+        on_error=on_error
+    )
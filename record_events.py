@@ -0,0 +1,243 @@
+"""
+Шина событий по записям
+Webhook и polling публикуют сюда нормализованные события (запись
+создана/изменена или удалена). Повторы отсекаются по отпечатку записи
+в known_records, а один обработчик планирует напоминания и ставит
+уведомления клиентам в outbox — при работе обоих источников на одно
+реальное изменение уходит одно сообщение.
+Уведомление ждёт в outbox RECORD_EVENT_COALESCE_SECONDS: серия правок
+одной записи склеивается в одно сообщение об итоговом состоянии.
+"""
+import asyncio
+import json
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Optional
+
+from config import config
+from database import db
+from pipeline import notification_pipeline
+from reminder_timer import reminder_timer, parse_record_datetime, record_starts_at
+from templates import msg_booking_created, msg_booking_changed, msg_booking_cancelled
+from bot_checker import get_bot_link_text
+
+
+@dataclass(frozen=True, slots=True)
+class RecordEvent:
+    record_id: int
+    known: Optional[dict] = None  # Строка known_records (Record.to_known_record())
+    deleted: bool = False
+    source: str = "poll"  # poll / webhook
+
+
+def coalesce_key(record_id: int) -> str:
+    """Ключ склейки уведомлений по записи в outbox"""
+    return f"record:{record_id}"
+
+
+def merge_pending(pending: list, change: dict, new_hash: str) -> Optional[tuple]:
+    """
+    Итоговое уведомление с учётом ещё не отправленного по той же записи.
+    Возвращает (kind, old_hash) или None, если сообщать нечего.
+    old_hash — отпечаток, который знает клиент (для отмены — тоже).
+    """
+    kind = change["kind"]
+    old_hash = change["old_hash"]
+    if not pending:
+        return kind, old_hash
+    
+    previous = json.loads(pending[0]["meta"] or "{}").get("record_event") or {}
+    previous_kind = previous.get("kind")
+    known_hash = previous.get("old_hash")
+    
+    if previous_kind == "created":
+        # Создана и тут же удалена — клиент ничего не узнает;
+        # создана и изменена — сообщаем о создании с итоговыми данными
+        return None if kind == "cancelled" else ("created", None)
+    
+    if previous_kind in ("changed", "cancelled"):
+        if kind == "cancelled":
+            return "cancelled", known_hash
+        # Вернулись к тому, что клиент уже знает, — сообщать нечего
+        if known_hash == new_hash:
+            return None
+        return "changed", known_hash
+    
+    return kind, old_hash
+
+
+class RecordEventBus:
+    """
+    Общая блокировка держится только на время приёма изменений в БД
+    (и планирования напоминаний). Уведомления по одной записи ставятся
+    в outbox строго в порядке приёма, разные записи друг друга не ждут.
+    Если уведомление не удалось поставить в очередь, придержанное
+    сообщение возвращается в outbox, а приём изменения откатывается —
+    следующая сверка примет его заново.
+    """
+    
+    def __init__(self):
+        self._lock = asyncio.Lock()
+        # record_id -> Future последней обработки уведомлений по записи
+        self._tails = {}
+    
+    async def publish(self, events: list, notify: bool = True) -> list:
+        """
+        Принять события, отбросить повторы и обработать новые.
+        notify=False — только запомнить записи (первая синхронизация).
+        Возвращает принятые изменения.
+        """
+        if not events:
+            return []
+        async with self._lock:
+            accepted = await db.apply_record_events(events)
+            if not accepted:
+                return []
+            sources = {event.source for event in events}
+            self._log(accepted, "/".join(sorted(sources)))
+            
+            # Напоминания: новые и изменённые — (пере)планируем, удалённые — отменяем
+            await reminder_timer.schedule([
+                change["row"] for change in accepted if change["kind"] != "cancelled"
+            ])
+            await reminder_timer.cancel([
+                change["record_id"] for change in accepted if change["kind"] == "cancelled"
+            ])
+            
+            changes = [
+                change for change in accepted
+                if notify and change["row"].get("client_phone")
+            ]
+            if not changes:
+                return accepted
+            record_ids = [change["record_id"] for change in changes]
+            previous, turn = self._take_turn(record_ids)
+        
+        try:
+            await asyncio.gather(*previous)
+            await self._notify(changes)
+        finally:
+            self._end_turn(record_ids, turn)
+        return accepted
+    
+    def _take_turn(self, record_ids: list) -> tuple:
+        """
+        Встать в очередь уведомлений по записям (без ожидания).
+        Возвращает (Future предыдущих обработок, свой Future)
+        """
+        turn = asyncio.get_running_loop().create_future()
+        previous = []
+        for record_id in record_ids:
+            tail = self._tails.get(record_id)
+            if tail is not None and not tail.done():
+                previous.append(tail)
+            self._tails[record_id] = turn
+        return previous, turn
+    
+    def _end_turn(self, record_ids: list, turn: asyncio.Future):
+        turn.set_result(None)
+        for record_id in record_ids:
+            if self._tails.get(record_id) is turn:
+                del self._tails[record_id]
+    
+    def _log(self, accepted: list, source: str):
+        for change in accepted:
+            row = change["row"]
+            if change["kind"] == "created":
+                print(f"📌 Новая запись ({source}): {row.get('client_name')} ({change['record_id']})")
+            elif change["kind"] == "changed":
+                print(f"✏️ Запись изменена ({source}): {row.get('client_name')} ({change['record_id']})")
+            else:
+                print(f"🗑️ Запись удалена ({source}): {row.get('client_name')} ({change['record_id']})")
+    
+    async def _notify(self, changes: list):
+        """
+        Уведомления клиентам — через конвейер: маршрутизация, поиск
+        в Telegram, текст и постановка в outbox
+        """
+        held = []
+        failed = []
+        try:
+            items = []
+            for change in changes:
+                row = change["row"]
+                # Склейка: ещё не отправленное уведомление по этой записи
+                # придерживаем — его заменит одно про итоговое состояние
+                pending = await db.hold_queued_outbox(coalesce_key(change["record_id"]))
+                pending_ids = [message["id"] for message in pending]
+                held += pending_ids
+                merged = merge_pending(pending, change, row["hash"])
+                if merged is None:
+                    print(f"   ↩️ Запись #{change['record_id']}: изменения взаимно отменились, уведомлять не о чем")
+                    await db.drop_held_outbox(pending_ids)
+                    continue
+                kind, old_hash = merged
+                
+                record_datetime = parse_record_datetime(row.get("record_date"), row.get("record_time"))
+                items.append({
+                    **row,
+                    "event": kind,
+                    "event_seq": change["seq"],
+                    "old_hash": old_hash,
+                    "record_datetime": record_datetime or datetime.now(),
+                    "phone": row["client_phone"],
+                    "via_bot": True,
+                    "replace_ids": pending_ids,
+                    "change": change,
+                })
+            
+            if items:
+                await notification_pipeline(
+                    self._render,
+                    on_error=lambda errored: failed.extend(item["change"] for item in errored)
+                ).run(items)
+        except BaseException:
+            failed = changes
+            raise
+        finally:
+            # Не заменённые (ошибка) — обратно в очередь; заменённых уже нет
+            await db.release_held_outbox(held)
+            if failed:
+                print(f"⚠️ Уведомления не поставлены в очередь ({len(failed)}), приём изменений откатываем")
+                await db.revert_record_events(failed)
+    
+    def _render(self, item: dict) -> dict:
+        """Текст уведомления о новой, изменённой или отменённой записи"""
+        record_id = item["record_id"]
+        client_name = item.get("client_name") or "Клиент"
+        service_name = item.get("service_name") or "Услуга"
+        staff_name = item.get("staff_name") or "Мастер"
+        # Ссылку на бота добавляем, только если пишем не через бота
+        bot_link = "" if item.get("bot_chat_id") else get_bot_link_text()
+        
+        if item["event"] == "created":
+            print(f"📤 Уведомление о новой записи в очередь: {client_name}")
+            text = msg_booking_created(client_name, service_name, staff_name, item["record_datetime"])
+            text += bot_link
+            key = f"{record_id}:{item['event_seq']}:created"
+        elif item["event"] == "changed":
+            print(f"📤 Уведомление об изменении в очередь: {client_name}")
+            text = msg_booking_changed(client_name, service_name, staff_name, item["record_datetime"])
+            text += bot_link
+            key = f"{record_id}:{item['event_seq']}:changed:{item['old_hash']}:{item['hash']}"
+        else:
+            print(f"📤 Уведомление об отмене в очередь: {client_name}")
+            text = msg_booking_cancelled(client_name, service_name, item["record_datetime"])
+            key = f"{record_id}:{item['event_seq']}:cancelled"
+        
+        return {
+            "idempotency_key": key,
+            "text": text,
+            "record_id": record_id,
+            "yclients_client_id": item.get("client_id"),
+            "deadline": record_starts_at(item),
+            # Ждём окно склейки: следующая правка записи заменит это сообщение
+            "delay": config.RECORD_EVENT_COALESCE_SECONDS,
+            "coalesce_key": coalesce_key(record_id),
+            "replace_ids": item["replace_ids"],
+            "meta": {"record_event": {"kind": item["event"], "old_hash": item["old_hash"]}},
+        }
+
+
+# Синглтон
+record_events = RecordEventBus()
@@ -0,0 +1,130 @@
+"""
+Модель записи YClients
+Запись из ответа API разбирается один раз: имя и телефон клиента, услуги,
+мастер, время визита (с часовым поясом) и отпечаток для поиска изменений.
+Дальше все модули работают с готовым Record.
+"""
+import hashlib
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Optional
+from zoneinfo import ZoneInfo
+
+from config import config
+
+
+# Часовой пояс салона: в нём YClients отдаёт время без смещения
+SALON_TZ = ZoneInfo(config.SALON_TIMEZONE)
+
+
+def parse_api_datetime(record: dict) -> Optional[datetime]:
+    """
+    Время визита из записи API (с часовым поясом).
+    datetime бывает ISO со смещением (2026-02-06T22:15:00+03:00)
+    или "YYYY-MM-DD HH:MM:SS"; время без смещения — по часовому поясу салона.
+    """
+    candidates = [record.get("datetime"), record.get("date")]
+    # Старый формат: дата и время в разных полях
+    if record.get("date") and record.get("datetime"):
+        candidates.append(f"{record['date']} {str(record['datetime']).split(' ')[-1]}")
+    
+    for value in candidates:
+        if not value or len(str(value)) <= 10:
+            continue  # Только дата без времени
+        try:
+            parsed = datetime.fromisoformat(str(value))
+        except ValueError:
+            continue
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=SALON_TZ)
+        return parsed
+    return None
+
+
+# Префикс отпечатков текущего формата (старые — md5 без префикса)
+FINGERPRINT_PREFIX = "v2:"
+
+
+def record_fingerprint(record: dict) -> str:
+    """
+    Отпечаток записи API для определения изменений: время визита (epoch),
+    ID мастера и отсортированные ID услуг. Строится из нормализованных
+    полей — список записей, запрос одной записи и webhook форматируют
+    дату и услуги по-разному, а отпечаток у них должен совпадать.
+    """
+    starts_at = parse_api_datetime(record)
+    staff_id = (record.get("staff") or {}).get("id") or record.get("staff_id")
+    service_ids = sorted(
+        str(service.get("id")) for service in record.get("services") or []
+        if service.get("id") is not None
+    )
+    data = "|".join([
+        str(int(starts_at.timestamp())) if starts_at else "",
+        str(staff_id or ""),
+        ",".join(service_ids),
+    ])
+    return FINGERPRINT_PREFIX + hashlib.md5(data.encode()).hexdigest()
+
+
+@dataclass(frozen=True, slots=True)
+class Record:
+    id: int
+    client_id: Optional[int]
+    client_name: str
+    client_phone: str
+    service_name: str
+    staff_name: str
+    starts_at: Optional[datetime]
+    fingerprint: str
+    deleted: bool = False
+    
+    @classmethod
+    def from_api(cls, record: dict) -> "Record":
+        """Разобрать запись из ответа API"""
+        client_data = record.get("client") or {}
+        services = record.get("services") or []
+        staff = record.get("staff") or {}
+        return cls(
+            id=record.get("id"),
+            client_id=client_data.get("id"),
+            client_name=client_data.get("name", "").split()[0] if client_data.get("name") else "Клиент",
+            client_phone=client_data.get("phone") or "",
+            service_name=", ".join([s.get("title", "") for s in services]) or "Услуга",
+            staff_name=staff.get("name") or "Мастер",
+            starts_at=parse_api_datetime(record),
+            fingerprint=record_fingerprint(record),
+            deleted=bool(record.get("deleted"))
+        )
+    
+    @property
+    def local_start(self) -> datetime:
+        """
+        Время визита по часам салона, без часового пояса — для шаблонов
+        и known_records. Если время не разобралось — текущее.
+        """
+        if self.starts_at is None:
+            return datetime.now()
+        return self.starts_at.astimezone(SALON_TZ).replace(tzinfo=None)
+    
+    def minutes_until(self) -> Optional[int]:
+        """Минут до визита"""
+        if self.starts_at is None:
+            return None
+        return int((self.starts_at - datetime.now(timezone.utc)).total_seconds() / 60)
+    
+    def to_known_record(self) -> dict:
+        """Строка для known_records (и разбора изменений в polling)"""
+        local_start = self.local_start
+        return {
+            "record_id": self.id,
+            "client_phone": self.client_phone,
+            "client_name": self.client_name,
+            "client_id": self.client_id,
+            "service_name": self.service_name,
+            "staff_name": self.staff_name,
+            "record_date": local_start.strftime("%Y-%m-%d") if self.starts_at else "",
+            "record_time": local_start.strftime("%H:%M:%S") if self.starts_at else "",
+            "record_datetime": local_start,
+            "starts_at": int(self.starts_at.timestamp()) if self.starts_at else None,
+            "hash": self.fingerprint,
+        }
@@ -0,0 +1,237 @@
+"""
+Таймер напоминаний по записям
+Моменты отправки (за 24ч, за 1ч, отзыв после визита) считаются при создании
+или изменении записи и хранятся в таблице scheduled_messages.
+Таймер спит до ближайшего момента и ставит сообщения в outbox —
+без периодического перебора всех записей.
+"""
+import asyncio
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+
+from config import config
+from database import db
+from records import SALON_TZ
+from pipeline import notification_pipeline
+from templates import msg_confirmation_24h, msg_reminder_1h, msg_review_request
+from bot_checker import get_bot_link_text
+
+
+# Вид напоминания -> (момент отправки, до какого момента ещё отправлять),
+# оба — смещение от начала визита. Опоздавшие (например, запись создана
+# за 10 часов до визита) не отправляются
+REMINDER_TIMES = {
+    "24h": (timedelta(hours=-24), timedelta(hours=-23)),
+    "1h": (timedelta(hours=-1), timedelta(minutes=-45)),
+    "review": (timedelta(hours=1), timedelta(hours=3)),
+}
+
+
+def parse_record_datetime(record_date: str, record_time: str) -> Optional[datetime]:
+    """Дата и время визита из полей known_records"""
+    for fmt in ("%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M"):
+        try:
+            return datetime.strptime(f"{record_date} {record_time}", fmt)
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+def record_starts_at(item: dict) -> Optional[datetime]:
+    """
+    Начало визита с часовым поясом салона — для дедлайнов outbox.
+    record_date/record_time — время салона, а не сервера
+    """
+    if item.get("starts_at") is not None:
+        return datetime.fromtimestamp(item["starts_at"], SALON_TZ)
+    record_datetime = parse_record_datetime(item.get("record_date"), item.get("record_time"))
+    return record_datetime.replace(tzinfo=SALON_TZ) if record_datetime else None
+
+
+def schedule_for(record_id: int, starts_at: int) -> list:
+    """
+    Строки scheduled_messages для записи: (record_id, kind, due_at, expires_at).
+    starts_at — начало визита в epoch (known_records.starts_at)
+    """
+    return [
+        (
+            record_id,
+            kind,
+            starts_at + int(due.total_seconds()),
+            starts_at + int(until.total_seconds())
+        )
+        for kind, (due, until) in REMINDER_TIMES.items()
+    ]
+
+
+class ReminderTimer:
+    def __init__(self):
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup: Optional[asyncio.Event] = None
+    
+    async def schedule(self, records: list, replace: bool = True):
+        """
+        Запланировать (или перепланировать после изменения) напоминания.
+        records — dict с полями known_records (record_id, starts_at)
+        """
+        items = []
+        for record in records:
+            if record.get("starts_at") is not None:
+                items.extend(schedule_for(record["record_id"], record["starts_at"]))
+        await db.schedule_messages(items, replace=replace)
+        self._wake()
+    
+    async def cancel(self, record_ids: list):
+        """Отменить напоминания удалённых записей"""
+        await db.cancel_scheduled_messages(record_ids)
+        self._wake()
+    
+    def _wake(self):
+        if self._wakeup is not None:
+            self._wakeup.set()
+    
+    def start(self):
+        """Запустить таймер (повторный вызов ничего не делает)"""
+        if self._task is not None and not self._task.done():
+            return
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+    
+    async def stop(self):
+        """Остановить таймер"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+    
+    async def _backfill(self):
+        """
+        Запланировать активные записи, у которых ещё нет расписания
+        (база, созданная до появления scheduled_messages).
+        Берутся только визиты, по которым ещё можно что-то отправить
+        """
+        latest = max(until for _, until in REMINDER_TIMES.values())
+        starts_after = int(time.time() - latest.total_seconds())
+        await self.schedule(await db.get_active_known_records(starts_after), replace=False)
+    
+    async def _run(self):
+        try:
+            interrupted = await db.requeue_firing_messages()
+            if interrupted:
+                print(f"⏰ Таймер напоминаний: {interrupted} прерванных отправок возвращено в расписание")
+            await self._backfill()
+        except Exception as e:
+            print(f"❌ Таймер напоминаний: ошибка заполнения расписания: {e}")
+        
+        while True:
+            self._wakeup.clear()
+            delay = config.REMINDER_TIMER_MAX_SLEEP
+            try:
+                await self.fire_due()
+                next_at = await db.get_next_scheduled_at()
+                if next_at is not None:
+                    delay = min(delay, max(0, next_at - time.time()))
+            except Exception as e:
+                print(f"❌ Таймер напоминаний: {e}")
+            
+            # Спим до ближайшего напоминания или до изменения расписания.
+            # Верхняя граница — на случай, если расписание менял другой процесс
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+    
+    async def fire_due(self):
+        """
+        Поставить в outbox все наступившие напоминания.
+        Отправка считается сработавшей только после конвейера; упавшие
+        на каком-либо этапе возвращаются в расписание с повтором через
+        REMINDER_TIMER_MAX_SLEEP секунд (пока не истечёт срок)
+        """
+        failed = []
+        pipeline = notification_pipeline(
+            self._render,
+            on_error=lambda items: failed.extend((item["record_id"], item["kind"]) for item in items)
+        )
+        while True:
+            now = int(time.time())
+            due = await db.take_due_messages(now)
+            if not due:
+                return
+            
+            keys = [(item["record_id"], item["kind"]) for item in due]
+            failed.clear()
+            try:
+                await pipeline.run(self._prepare(due, now))
+            except BaseException:
+                await db.release_scheduled_messages(keys, now + config.REMINDER_TIMER_MAX_SLEEP)
+                raise
+            failed_keys = set(failed)
+            await db.release_scheduled_messages(list(failed_keys), now + config.REMINDER_TIMER_MAX_SLEEP)
+            await db.finish_scheduled_messages([key for key in keys if key not in failed_keys])
+    
+    def _prepare(self, due: list, now: int) -> list:
+        """Элементы конвейера: без телефона и опоздавшие пропускаются"""
+        items = []
+        for item in due:
+            if not item["client_phone"]:
+                continue
+            if item["expires_at"] < now:
+                print(f"⌛ Напоминание {item['kind']} по записи {item['record_id']} опоздало, пропускаем")
+                continue
+            items.append({
+                **item,
+                "phone": item["client_phone"],
+                "reminder": (item["record_id"], item["kind"]),
+            })
+        return items
+    
+    def _render(self, item: dict) -> dict:
+        """Текст напоминания и параметры для outbox"""
+        record_id = item["record_id"]
+        kind = item["kind"]
+        client_name = item["client_name"] or "Клиент"
+        record_datetime = parse_record_datetime(item["record_date"], item["record_time"])
+        service_name = item["service_name"] or "Услуга"
+        staff_name = item["staff_name"] or "Мастер"
+        
+        # === Подтверждение записи за 24 часа ===
+        if kind == "24h":
+            print(f"📤 Запрос подтверждения в очередь: {client_name}")
+            text = msg_confirmation_24h(client_name, service_name, staff_name, record_datetime)
+            # После отправки outbox сохранит ожидание подтверждения.
+            # Текст про визит «завтра» — не отправляем позже чем за 20 часов
+            deadline = record_starts_at(item) - timedelta(hours=20)
+            meta = {"pending_confirmation": {"record_datetime": record_datetime.isoformat()}}
+        
+        # === Напоминание за 1 час ===
+        elif kind == "1h":
+            print(f"📤 Напоминание за 1ч в очередь: {client_name}")
+            text = msg_reminder_1h(client_name, service_name, staff_name, record_datetime)
+            deadline = record_starts_at(item)
+            meta = None
+        
+        # === Запрос отзыва после визита ===
+        else:
+            print(f"📤 Запрос отзыва в очередь: {client_name}")
+            text = msg_review_request(client_name, service_name, staff_name)
+            deadline = None
+            meta = None
+        
+        return {
+            "idempotency_key": f"{record_id}:{kind}",
+            "text": text + get_bot_link_text(),
+            "record_id": record_id,
+            "yclients_client_id": item["client_id"],
+            "reminder_type": kind,
+            "deadline": deadline,
+            "meta": meta,
+        }
+
+
+# Синглтон
+reminder_timer = ReminderTimer()
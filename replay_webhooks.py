@@ -0,0 +1,44 @@
+"""
+Повтор webhook из журнала за период
+Возвращает события в очередь — запущенный webhook_server обработает их
+заново. Повторные уведомления отсекаются шиной событий по отпечатку записи.
+
+Использование:
+    python replay_webhooks.py "2026-10-01 00:00" ["2026-10-02 00:00"] [record|client]
+"""
+import asyncio
+import sys
+from datetime import datetime
+
+from database import db
+
+
+def parse_time(value: str) -> int:
+    return int(datetime.fromisoformat(value).timestamp())
+
+
+async def replay():
+    if len(sys.argv) < 2:
+        print('Использование: python replay_webhooks.py "С" ["ДО"] [record|client]')
+        return
+    
+    since = parse_time(sys.argv[1])
+    until = parse_time(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[2] else None
+    resource = sys.argv[3] if len(sys.argv) > 3 else None
+    
+    await db.init()
+    try:
+        count = await db.requeue_webhooks(
+            since=since,
+            until=until,
+            resource=resource,
+            states=("done", "failed")
+        )
+    finally:
+        await db.close()
+    
+    print(f"🔁 Возвращено в очередь: {count} webhook")
+
+
+if __name__ == "__main__":
+    asyncio.run(replay())
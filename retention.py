@@ -0,0 +1,108 @@
+"""
+Хранение данных: архив и сжатие базы
+Строки старше RETENTION_DAYS переносятся из основной базы в помесячные
+архивные базы (data/archive/reminders-YYYY-MM.db), после чего
+освободившиеся страницы возвращаются ОС небольшими шагами
+incremental_vacuum. Запускается ночью из планировщика или вручную:
+
+    python retention.py
+"""
+import asyncio
+import json
+import os
+from datetime import datetime, timedelta
+
+from config import config
+from database import db, RETENTION_STATS_KEY
+
+
+# Таблица -> (колонка времени, epoch ли это, какие строки можно переносить)
+RETENTION_TABLES = {
+    "conversations": ("created_at", False, None),
+    "sent_reminders": ("sent_at", False, None),  # В т.ч. ключи lost21_/lost35_/lost65_
+    "outbox": ("created_at", False, "state IN ('sent', 'dead')"),
+    "webhook_journal": ("received_at", True, "state IN ('done', 'failed')"),
+}
+
+
+def archive_path(month: str) -> str:
+    """Архивная база месяца "YYYY-MM" """
+    name = os.path.splitext(os.path.basename(config.DATABASE_PATH))[0]
+    return os.path.join(config.RETENTION_ARCHIVE_DIR, f"{name}-{month}.db")
+
+
+class RetentionEngine:
+    def __init__(self):
+        self._lock = asyncio.Lock()
+    
+    async def run(self) -> dict:
+        """Перенести старые строки в архив и сжать базу. Возвращает отчёт"""
+        async with self._lock:
+            before = await db.get_storage_stats()
+            cutoff = datetime.now() - timedelta(days=config.RETENTION_DAYS)
+            
+            moved = {}
+            for table, (time_column, epoch, condition) in RETENTION_TABLES.items():
+                try:
+                    by_month = await db.archive_rows(
+                        table,
+                        time_column,
+                        int(cutoff.timestamp()) if epoch else cutoff.strftime("%Y-%m-%d %H:%M:%S"),
+                        archive_path,
+                        condition=condition,
+                        epoch=epoch
+                    )
+                except Exception as e:
+                    print(f"❌ Retention: ошибка архивации {table}: {e}")
+                    continue
+                if by_month:
+                    moved[table] = by_month
+                    print(f"🗄 Retention: {table} -> архив {by_month}")
+            
+            await self._vacuum()
+            after = await db.get_storage_stats()
+            
+            report = {
+                "finished_at": datetime.now().isoformat(timespec="seconds"),
+                "cutoff": cutoff.isoformat(timespec="seconds"),
+                "moved": moved,
+                "bytes_before": before["bytes"],
+                "bytes_after": after["bytes"],
+                "free_pages": after["freelist_count"],
+            }
+            await db.set_sync_state(RETENTION_STATS_KEY, json.dumps(report))
+            print(f"🧹 Retention: база {before['bytes'] / 1048576:.1f} МБ -> "
+                  f"{after['bytes'] / 1048576:.1f} МБ")
+            return report
+    
+    async def _vacuum(self):
+        """
+        Вернуть свободные страницы ОС шагами по RETENTION_VACUUM_PAGES —
+        между шагами база доступна остальным процессам
+        """
+        if await db.enable_incremental_vacuum():
+            free_pages = (await db.get_storage_stats())["freelist_count"]
+            while free_pages > 0:
+                remaining = await db.incremental_vacuum(config.RETENTION_VACUUM_PAGES)
+                if remaining >= free_pages:
+                    break  # Страницы не освобождаются — не крутимся впустую
+                free_pages = remaining
+                await asyncio.sleep(config.RETENTION_VACUUM_PAUSE)
+        await db.checkpoint()
+
+
+# Синглтон
+retention = RetentionEngine()
+
+
+async def main():
+    await db.init()
+    await db.init_records_tracking()
+    try:
+        await retention.run()
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,53 +1,96 @@
 """
 Планировщик напоминаний
-Периодически проверяет записи и отправляет напоминания
+Периодически синхронизирует записи (напоминания по ним планирует reminder_timer)
+и проверяет потерянных клиентов
 С поддержкой POLLING для отслеживания новых/изменённых/удалённых записей
 """
-import asyncio
-import hashlib
+import json
+import time
+from collections import deque
 from datetime import datetime, timedelta
+from typing import Optional
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
 from apscheduler.triggers.interval import IntervalTrigger
 
 from config import config
-from database import db
-from yclients_api import yclients
-from telegram_client import telegram
+from database import db, RECORDS_CURSOR_KEY, POLL_STATS_KEY
+from yclients_api import yclients, records_snapshot
+from records import Record, SALON_TZ
+from pipeline import Stage, notification_pipeline
+from record_events import RecordEvent, record_events
+from reminder_timer import reminder_timer
+from retention import retention
+from send_dispatcher import PRIORITY_LOW
 from templates import (
-    msg_confirmation_24h, msg_reminder_1h, msg_review_request,
-    msg_lost_client_21, msg_lost_client_35, msg_lost_client_65,
-    msg_booking_created, msg_booking_changed, msg_booking_cancelled
+    msg_lost_client_21, msg_lost_client_35, msg_lost_client_65
 )
-from bot_checker import get_bot_client_chat_id, get_bot_link_text
+from bot_checker import get_bot_link_text
+
+
+# Окна потеряшек: (от, до дней с последнего визита, метка, шаблон)
+LOST_CLIENT_WINDOWS = (
+    (20, 22, 21, msg_lost_client_21),
+    (34, 36, 35, msg_lost_client_35),
+    (64, 66, 65, msg_lost_client_65),
+)
+
+
+class AdaptivePollInterval:
+    """
+    Интервал polling по частоте изменений: нашли изменения — сразу
+    минимальный интервал, пусто — интервал растёт в POLL_BACKOFF раз до
+    POLL_MAX_SECONDS. Пока webhook исправно доставляет события, polling
+    остаётся редкой сверкой (до POLL_RECONCILE_SECONDS).
+    """
+    
+    def __init__(self):
+        self.interval = float(config.POLL_MIN_SECONDS)
+        self.hits = deque(maxlen=50)  # Были ли изменения в последних опросах
+        self.observed = None  # Сглаженный фактический интервал, сек
+        self._last_poll = None
+    
+    def update(self, changes: int, webhook_healthy: bool) -> float:
+        """Учесть результат опроса и вернуть следующий интервал"""
+        now = time.monotonic()
+        if self._last_poll is not None:
+            elapsed = now - self._last_poll
+            self.observed = elapsed if self.observed is None else 0.8 * self.observed + 0.2 * elapsed
+        self._last_poll = now
+        self.hits.append(changes > 0)
+        
+        if changes > 0:
+            self.interval = float(config.POLL_MIN_SECONDS)
+        else:
+            limit = config.POLL_RECONCILE_SECONDS if webhook_healthy else config.POLL_MAX_SECONDS
+            self.interval = min(float(limit), self.interval * config.POLL_BACKOFF)
+        return self.interval
+    
+    @property
+    def hit_rate(self) -> float:
+        return sum(self.hits) / len(self.hits) if self.hits else 0.0
+    
+    def stats(self) -> dict:
+        return {
+            "interval": round(self.interval),
+            "observed_interval": round(self.observed) if self.observed is not None else None,
+            "hit_rate": round(self.hit_rate, 2),
+            "polls": len(self.hits),
+        }
 
 
 class ReminderScheduler:
     def __init__(self):
         self.scheduler = AsyncIOScheduler()
         self.is_running = False
-        self.first_poll = True  # Первый запуск — не отправляем уведомления о старых записях
-    
-    async def _should_send_via_userbot(self, phone: str) -> bool:
-        """
-        Проверяет, нужно ли отправлять через userbot.
-        Если клиент подключил бота - бот сам отправит, мы пропускаем.
-        Если клиент НЕ в боте - отправляем через userbot.
-        """
-        bot_chat_id = await get_bot_client_chat_id(phone)
-        if bot_chat_id:
-            print(f"   ℹ️ Клиент {phone} подключил бота - уведомление отправит бот")
-            return False
-        return True
-    
-    def _make_record_hash(self, record: dict) -> str:
-        """Создать хеш записи для определения изменений"""
-        data = f"{record.get('date')}|{record.get('datetime')}|{record.get('staff', {}).get('id')}|{record.get('services', [])}"
-        return hashlib.md5(data.encode()).hexdigest()
+        self.last_generation = 0  # Последний обработанный снимок записей
+        self.last_full_sync = None  # time.monotonic() последней полной сверки
+        self.poll_interval = AdaptivePollInterval()
     
-    async def poll_records(self):
+    async def poll_records(self) -> int:
         """
         POLLING: Проверка новых/изменённых/удалённых записей через API
-        Заменяет webhook
+        Заменяет webhook (или страхует его). Возвращает число найденных изменений.
         """
         print(f"🔄 [{datetime.now().strftime('%H:%M:%S')}] Polling записей...")
         
@@ -55,441 +98,242 @@ class ReminderScheduler:
             # Инициализируем таблицу если нужно
             await db.init_records_tracking()
             
-            # Получаем записи на ближайшие 14 дней
-            start_date = datetime.now()
-            end_date = start_date + timedelta(days=14)
+            # Курсор: момент начала последней успешной загрузки.
+            # Нет курсора — база новая: запоминаем записи без уведомлений.
+            # Есть — после перезапуска догоняем всё, что изменилось за простой.
+            # Курсор хранится со смещением (время салона); старый курсор
+            # без смещения был записан по часам сервера
+            cursor_value = await db.get_sync_state(RECORDS_CURSOR_KEY)
+            cursor = (
+                datetime.fromisoformat(cursor_value).astimezone(SALON_TZ)
+                if cursor_value else None
+            )
+            silent = cursor is None
             
-            result = await yclients.get_records(start_date, end_date)
+            full = (
+                cursor is None
+                or self.last_full_sync is None
+                or time.monotonic() - self.last_full_sync >= config.RECORDS_FULL_SYNC_MINUTES * 60
+            )
             
-            if not result.get("success"):
-                print(f"❌ Ошибка получения записей: {result}")
-                return
-            
-            current_records = result.get("data", [])
-            current_record_ids = set()
-            
-            for record in current_records:
-                if record.get("deleted"):
-                    continue
-                    
-                record_id = record.get("id")
-                current_record_ids.add(record_id)
-                
-                # Получаем данные записи
-                client_data = record.get("client") or {}
-                client_name = client_data.get("name", "").split()[0] if client_data.get("name") else "Клиент"
-                client_phone = client_data.get("phone", "")
-                client_id = client_data.get("id")
-                
-                if not client_phone:
-                    continue
-                
-                services = record.get("services", [])
-                service_name = ", ".join([s.get("title", "") for s in services]) or "Услуга"
-                staff = record.get("staff", {})
-                staff_name = staff.get("name", "Мастер")
-                
-                record_date = record.get("date", "")
-                record_time = record.get("datetime", "").split(" ")[-1] if record.get("datetime") else ""
-                
-                record_hash = self._make_record_hash(record)
-                
-                # Парсим дату для шаблона
+            gone_rows = []
+            if not full:
+                # Только изменённые с прошлой загрузки (с запасом на разницу часов)
+                fetch_started = datetime.now(SALON_TZ)
                 try:
-                    record_datetime = datetime.strptime(f"{record_date} {record_time}", "%Y-%m-%d %H:%M:%S")
-                except ValueError:
-                    record_datetime = datetime.now()
-                
-                # Проверяем, знаем ли мы эту запись
-                known = await db.get_known_record(record_id)
-                
-                if known is None:
-                    # НОВАЯ ЗАПИСЬ
-                    print(f"📌 Новая запись: {client_name} ({record_id})")
-                    
-                    # Сохраняем
-                    await db.save_known_record(
-                        record_id=record_id,
-                        client_phone=client_phone,
-                        client_name=client_name,
-                        service_name=service_name,
-                        staff_name=staff_name,
-                        record_date=record_date,
-                        record_time=record_time,
-                        record_hash=record_hash
-                    )
-                    
-                    # Отправляем уведомление (кроме первого запуска)
-                    if not self.first_poll:
-                        # Проверяем, нужно ли отправлять через userbot
-                        if await self._should_send_via_userbot(client_phone):
-                            print(f"📤 Отправляем уведомление о новой записи: {client_name}")
-                            text = msg_booking_created(client_name, service_name, staff_name, record_datetime)
-                            text += get_bot_link_text()  # Добавляем ссылку на бота
-                            await telegram.send_message(
-                                phone_or_user_id=client_phone,
-                                text=text,
-                                record_id=record_id,
-                                yclients_client_id=client_id
-                            )
-                
-                elif known.get("hash") != record_hash and known.get("status") == "active":
-                    # ЗАПИСЬ ИЗМЕНЕНА
-                    print(f"✏️ Запись изменена: {client_name} ({record_id})")
-                    
-                    # Обновляем
-                    await db.save_known_record(
-                        record_id=record_id,
-                        client_phone=client_phone,
-                        client_name=client_name,
-                        service_name=service_name,
-                        staff_name=staff_name,
-                        record_date=record_date,
-                        record_time=record_time,
-                        record_hash=record_hash
-                    )
-                    
-                    # Отправляем уведомление об изменении
-                    if await self._should_send_via_userbot(client_phone):
-                        print(f"📤 Отправляем уведомление об изменении: {client_name}")
-                        text = msg_booking_changed(client_name, service_name, staff_name, record_datetime)
-                        text += get_bot_link_text()
-                        await telegram.send_message(
-                            phone_or_user_id=client_phone,
-                            text=text,
-                            record_id=record_id,
-                            yclients_client_id=client_id
+                    changes = [
+                        Record.from_api(record)
+                        async for record in yclients.iter_records(
+                            fetch_started,
+                            fetch_started + timedelta(days=config.RECORDS_WINDOW_DAYS),
+                            changed_after=cursor - timedelta(seconds=config.RECORDS_CURSOR_OVERLAP)
                         )
+                    ]
+                except Exception as e:
+                    print(f"⚠️ Загрузка изменений не удалась ({e}), делаем полную сверку")
+                    full = True
+                else:
+                    records = [record for record in changes if not record.deleted]
+                    gone_rows = await db.get_active_known_records_by_ids(
+                        [record.id for record in changes if record.deleted]
+                    )
+                    window = (None, None)
+            
+            if full:
+                # Полная сверка — снимок записей на ближайшие дни
+                # (все страницы): запись, не попавшая в снимок, считается удалённой
+                snapshot = await records_snapshot.get()
+                if snapshot.generation == self.last_generation:
+                    return 0  # Этот снимок уже обработан
+                records = snapshot.records
+                fetch_started = snapshot.window_start
+                window = (
+                    snapshot.window_start.strftime("%Y-%m-%d"),
+                    snapshot.window_end.strftime("%Y-%m-%d")
+                )
+            
+            # record_id -> строка для known_records
+            current = {record.id: record.to_known_record() for record in records}
             
-            # Проверяем УДАЛЁННЫЕ записи
-            known_ids = await db.get_all_active_record_ids()
-            deleted_ids = known_ids - current_record_ids
+            # Новые, изменённые и удалённые — тремя запросами к БД
+            new_ids, changed, deleted_rows = await db.diff_known_records(
+                list(current.values()), *window
+            )
+            deleted_rows += gone_rows
             
-            for deleted_id in deleted_ids:
-                known = await db.get_known_record(deleted_id)
-                if known and known.get("status") == "active":
-                    print(f"🗑️ Запись удалена: {known.get('client_name')} ({deleted_id})")
-                    
-                    # Отмечаем как удалённую
-                    await db.mark_record_deleted(deleted_id)
-                    
-                    # Отправляем уведомление об отмене
-                    client_phone = known.get("client_phone")
-                    if client_phone:
-                        try:
-                            record_datetime = datetime.strptime(
-                                f"{known.get('record_date')} {known.get('record_time')}", 
-                                "%Y-%m-%d %H:%M:%S"
-                            )
-                        except ValueError:
-                            record_datetime = datetime.now()
-                        
-                        if await self._should_send_via_userbot(client_phone):
-                            print(f"📤 Отправляем уведомление об отмене: {known.get('client_name')}")
-                            text = msg_booking_cancelled(
-                                known.get("client_name", "Клиент"),
-                                known.get("service_name", "Услуга"),
-                                record_datetime
-                            )
-                            await telegram.send_message(
-                                phone_or_user_id=client_phone,
-                                text=text
-                            )
+            # Кандидаты — в общую шину событий: она отсеет то, что уже
+            # пришло через webhook, сохранит изменения и отправит уведомления
+            events = [
+                RecordEvent(record_id, known=current[record_id])
+                for record_id in new_ids + list(changed)
+            ] + [
+                RecordEvent(row["record_id"], deleted=True)
+                for row in deleted_rows
+            ]
+            accepted = await record_events.publish(events, notify=not silent)
             
-            # После первого запуска — отправляем уведомления
-            if self.first_poll:
-                self.first_poll = False
-                print(f"✅ Первичная синхронизация завершена. Найдено {len(current_record_ids)} записей.")
+            # Загрузка обработана — сдвигаем курсор
+            await db.set_sync_state(RECORDS_CURSOR_KEY, fetch_started.isoformat())
+            if full:
+                self.last_generation = snapshot.generation
+                self.last_full_sync = time.monotonic()
+            
+            if silent:
+                print(f"✅ Первичная синхронизация завершена. Найдено {len(current)} записей.")
+                return 0
+            return len(accepted)
             
         except Exception as e:
             print(f"❌ Ошибка polling: {e}")
             import traceback
             traceback.print_exc()
+            return 0
     
-    async def check_and_send_reminders(self):
-        """
-        Проверить ближайшие записи и отправить напоминания
-        """
-        print(f"🔄 [{datetime.now().strftime('%H:%M:%S')}] Проверка записей для напоминаний...")
+    async def _webhook_healthy(self) -> bool:
+        """Webhook недавно доставлял события (по журналу webhook_server)"""
+        last_event = await db.get_last_webhook_at()
+        if not last_event:
+            return False
+        return time.time() - last_event <= config.WEBHOOK_HEALTHY_MINUTES * 60
+    
+    async def _poll_job(self):
+        """Опрос записей и подбор интервала до следующего"""
+        changes = await self.poll_records()
         
         try:
-            # Получаем записи на ближайшие 48 часов
-            records = await yclients.get_upcoming_records(hours_ahead=48)
-            
-            for record in records:
-                await self._process_record(record)
-                
+            webhook_healthy = await self._webhook_healthy()
         except Exception as e:
-            print(f"❌ Ошибка при проверке записей: {e}")
-    
-    async def _process_record(self, record: dict):
-        """Обработка отдельной записи"""
-        record_id = record.get("id")
-        minutes_until = record.get("minutes_until", 0)
+            print(f"⚠️ Не удалось проверить webhook: {e}")
+            webhook_healthy = False
+        if changes and webhook_healthy:
+            # Polling нашёл то, чего webhook не доставил — не доверяем ему
+            print(f"⚠️ Polling нашёл {changes} изменений, пропущенных webhook")
+            webhook_healthy = False
         
-        # Получаем данные для напоминания
-        client_data = record.get("client") or {}
-        client_name = client_data.get("name", "").split()[0] if client_data.get("name") else "Клиент"
-        client_phone = client_data.get("phone", "")
-        client_id = client_data.get("id")
+        previous = self.poll_interval.interval
+        interval = self.poll_interval.update(changes, webhook_healthy)
+        stats = self.poll_interval.stats()
+        print(f"   ⏱️ Следующий polling через {stats['interval']} сек "
+              f"(факт. интервал {stats['observed_interval']} сек, "
+              f"с изменениями {stats['hit_rate']:.0%} опросов)")
         
-        if not client_phone:
-            return
-        
-        # Получаем услуги
-        services = record.get("services", [])
-        service_name = ", ".join([s.get("title", "") for s in services]) or "Услуга"
-        
-        # Получаем мастера
-        staff = record.get("staff", {})
-        staff_name = staff.get("name", "Мастер")
-        
-        record_datetime = record.get("record_datetime")
-        
-        # === Подтверждение записи за 24 часа ===
-        if 1380 <= minutes_until <= 1500:  # 23-25 часов
-            if not await db.is_reminder_sent(record_id, "24h"):
-                if await self._should_send_via_userbot(client_phone):
-                    print(f"📤 Отправляем запрос подтверждения: {client_name}")
-                    
-                    text = msg_confirmation_24h(client_name, service_name, staff_name, record_datetime)
-                    text += get_bot_link_text()
-                    message = await telegram.send_message(
-                        phone_or_user_id=client_phone,
-                        text=text,
-                        record_id=record_id,
-                        yclients_client_id=client_id
-                    )
-                    
-                    if message:
-                        await db.mark_reminder_sent(record_id, "24h", message.id)
-                        
-                        # Сохраняем ожидание подтверждения
-                        user_info = await telegram.find_user_by_phone(client_phone)
-                        if user_info:
-                            await db.add_pending_confirmation(
-                                record_id=record_id,
-                                telegram_user_id=user_info["user_id"],
-                                yclients_client_id=client_id,
-                                record_datetime=record_datetime.isoformat()
-                            )
-                        
-                        print(f"✅ Запрос подтверждения отправлен: {client_name}")
-                else:
-                    # Клиент в боте, отмечаем как отправленное
-                    await db.mark_reminder_sent(record_id, "24h", 0)
+        try:
+            await db.set_sync_state(POLL_STATS_KEY, json.dumps(stats))
+        except Exception as e:
+            print(f"⚠️ Не удалось сохранить статистику polling: {e}")
         
-        # === Напоминание за 1 час ===
-        if 45 <= minutes_until <= 75:  # 45-75 минут
-            if not await db.is_reminder_sent(record_id, "1h"):
-                if await self._should_send_via_userbot(client_phone):
-                    print(f"📤 Отправляем напоминание за 1ч: {client_name}")
-                    
-                    text = msg_reminder_1h(client_name, service_name, staff_name, record_datetime)
-                    text += get_bot_link_text()
-                    message = await telegram.send_message(
-                        phone_or_user_id=client_phone,
-                        text=text,
-                        record_id=record_id,
-                        yclients_client_id=client_id
-                    )
-                    
-                    if message:
-                        await db.mark_reminder_sent(record_id, "1h", message.id)
-                        print(f"✅ Напоминание за 1ч отправлено: {client_name}")
-                else:
-                    await db.mark_reminder_sent(record_id, "1h", 0)
+        if self.is_running and round(interval) != round(previous):
+            self.scheduler.reschedule_job(
+                "poll_records", trigger=IntervalTrigger(seconds=round(interval))
+            )
     
-    async def check_completed_visits(self):
-        """Проверка завершённых визитов для запроса отзыва"""
-        print(f"🔄 [{datetime.now().strftime('%H:%M:%S')}] Проверка завершённых визитов...")
+    async def _select_lost_client(self, client: dict) -> Optional[dict]:
+        """Клиент в окне потеряшек (21/35/65 дней с визита) или None"""
+        last_visit = client.get("last_visit_date")
+        if not client.get("phone") or not last_visit:
+            return None
         
         try:
-            # Получаем записи за последние 3 часа
-            end_date = datetime.now()
-            start_date = end_date - timedelta(hours=3)
-            
-            result = await yclients.get_records(start_date, end_date)
-            
-            if not result.get("success"):
-                return
-            
-            records = result.get("data", [])
-            
-            for record in records:
-                if record.get("deleted"):
-                    continue
-                
-                record_id = record.get("id")
-                
-                # Проверяем, прошла ли запись
-                record_datetime_str = f"{record.get('date')} {record.get('datetime', '').split(' ')[-1]}"
-                try:
-                    record_datetime = datetime.strptime(record_datetime_str, "%Y-%m-%d %H:%M:%S")
-                except (ValueError, IndexError):
-                    continue
-                
-                # Если запись была 1-3 часа назад — отправляем запрос отзыва
-                hours_ago = (datetime.now() - record_datetime).total_seconds() / 3600
-                
-                if 1 <= hours_ago <= 3:
-                    if not await db.is_reminder_sent(record_id, "review"):
-                        client_data = record.get("client") or {}
-                        client_name = client_data.get("name", "").split()[0] if client_data.get("name") else "Клиент"
-                        client_phone = client_data.get("phone", "")
-                        client_id = client_data.get("id")
-                        
-                        if not client_phone:
-                            continue
-                        
-                        services = record.get("services", [])
-                        service_name = ", ".join([s.get("title", "") for s in services]) or "Услуга"
-                        staff = record.get("staff", {})
-                        staff_name = staff.get("name", "Мастер")
-                        
-                        if await self._should_send_via_userbot(client_phone):
-                            print(f"📤 Отправляем запрос отзыва: {client_name}")
-                            
-                            text = msg_review_request(client_name, service_name, staff_name)
-                            text += get_bot_link_text()
-                            message = await telegram.send_message(
-                                phone_or_user_id=client_phone,
-                                text=text,
-                                record_id=record_id,
-                                yclients_client_id=client_id
-                            )
-                            
-                            if message:
-                                await db.mark_reminder_sent(record_id, "review", message.id)
-                                print(f"✅ Запрос отзыва отправлен: {client_name}")
-                        else:
-                            await db.mark_reminder_sent(record_id, "review", 0)
-                            
-        except Exception as e:
-            print(f"❌ Ошибка при проверке завершённых визитов: {e}")
+            last_visit_date = datetime.strptime(last_visit, "%Y-%m-%d")
+        except ValueError:
+            return None
+        
+        days_since = (datetime.now() - last_visit_date).days
+        for low, high, days, template in LOST_CLIENT_WINDOWS:
+            if low <= days_since <= high:
+                client_id = client.get("id")
+                reminder_key = f"lost{days}_{client_id}"
+                return {
+                    "phone": client["phone"],
+                    "client_id": client_id,
+                    "client_name": client.get("name", "").split()[0] if client.get("name") else "Клиент",
+                    "days": days,
+                    "template": template,
+                    "reminder": (client_id, reminder_key),
+                }
+        return None
+    
+    def _render_lost_client(self, item: dict) -> dict:
+        """Текст сообщения потеряшке"""
+        client_id, reminder_key = item["reminder"]
+        print(f"📤 В очередь: потеряшка {item['days']} дней: {item['client_name']}")
+        return {
+            "idempotency_key": f"{client_id}:{reminder_key}",
+            "text": item["template"](item["client_name"]) + get_bot_link_text(),
+            "record_id": None,  # Не запись — в переписку record_id не пишем
+            "yclients_client_id": client_id,
+            "reminder_type": reminder_key,
+            "reminder_record_id": client_id,
+            "priority": PRIORITY_LOW,
+        }
     
     async def check_lost_clients(self):
         """Проверка потерянных клиентов"""
         print(f"🔄 [{datetime.now().strftime('%H:%M:%S')}] Проверка потерянных клиентов...")
         
         try:
-            # Получаем всех клиентов
-            result = await yclients.get_clients(page=1, count=200)
+            # Клиенты читаются постранично и сразу идут по конвейеру:
+            # отбор -> маршрутизация -> поиск в Telegram -> текст -> outbox
+            pipeline = notification_pipeline(
+                self._render_lost_client,
+                before=[Stage("select", self._select_lost_client)]
+            )
+            queued = await pipeline.run(yclients.iter_clients(count=200))
+            print(f"   Потеряшек в очереди: {queued}")
             
-            if not result.get("success"):
-                return
-            
-            clients = result.get("data", [])
-            now = datetime.now()
-            
-            for client in clients:
-                client_id = client.get("id")
-                client_name = client.get("name", "").split()[0] if client.get("name") else "Клиент"
-                client_phone = client.get("phone", "")
-                last_visit = client.get("last_visit_date")
-                
-                if not client_phone or not last_visit:
-                    continue
-                
-                try:
-                    last_visit_date = datetime.strptime(last_visit, "%Y-%m-%d")
-                except ValueError:
-                    continue
-                
-                days_since = (now - last_visit_date).days
-                
-                # Потеряшки 21 день (20-22 дня)
-                if 20 <= days_since <= 22:
-                    reminder_key = f"lost21_{client_id}"
-                    if not await db.is_reminder_sent(client_id, reminder_key):
-                        if await self._should_send_via_userbot(client_phone):
-                            print(f"📤 Потеряшка 21 день: {client_name}")
-                            
-                            text = msg_lost_client_21(client_name)
-                            text += get_bot_link_text()
-                            message = await telegram.send_message(
-                                phone_or_user_id=client_phone,
-                                text=text,
-                                yclients_client_id=client_id
-                            )
-                            
-                            if message:
-                                await db.mark_reminder_sent(client_id, reminder_key, message.id)
-                        else:
-                            await db.mark_reminder_sent(client_id, reminder_key, 0)
-                
-                # Потеряшки 35 дней (34-36 дней)
-                elif 34 <= days_since <= 36:
-                    reminder_key = f"lost35_{client_id}"
-                    if not await db.is_reminder_sent(client_id, reminder_key):
-                        if await self._should_send_via_userbot(client_phone):
-                            print(f"📤 Потеряшка 35 дней: {client_name}")
-                            
-                            text = msg_lost_client_35(client_name)
-                            text += get_bot_link_text()
-                            message = await telegram.send_message(
-                                phone_or_user_id=client_phone,
-                                text=text,
-                                yclients_client_id=client_id
-                            )
-                            
-                            if message:
-                                await db.mark_reminder_sent(client_id, reminder_key, message.id)
-                        else:
-                            await db.mark_reminder_sent(client_id, reminder_key, 0)
-                
-                # Потеряшки 65 дней (64-66 дней)
-                elif 64 <= days_since <= 66:
-                    reminder_key = f"lost65_{client_id}"
-                    if not await db.is_reminder_sent(client_id, reminder_key):
-                        if await self._should_send_via_userbot(client_phone):
-                            print(f"📤 Потеряшка 65 дней: {client_name}")
-                            
-                            text = msg_lost_client_65(client_name)
-                            text += get_bot_link_text()
-                            message = await telegram.send_message(
-                                phone_or_user_id=client_phone,
-                                text=text,
-                                yclients_client_id=client_id
-                            )
-                            
-                            if message:
-                                await db.mark_reminder_sent(client_id, reminder_key, message.id)
-                        else:
-                            await db.mark_reminder_sent(client_id, reminder_key, 0)
-                            
         except Exception as e:
             print(f"❌ Ошибка при проверке потерянных клиентов: {e}")
     
+    async def archive_past_records(self):
+        """Перевести в архив записи, визит по которым давно прошёл"""
+        try:
+            before = int(time.time()) - config.RECORDS_ARCHIVE_AFTER_HOURS * 3600
+            archived = await db.archive_past_records(before)
+            if archived:
+                print(f"🗄 В архив переведено прошедших записей: {archived}")
+        except Exception as e:
+            print(f"❌ Ошибка архивации записей: {e}")
+    
+    async def run_retention(self):
+        """Перенести старые данные в архивные базы и сжать основную"""
+        try:
+            await retention.run()
+        except Exception as e:
+            print(f"❌ Ошибка retention: {e}")
+    
     def start(self):
         """Запуск планировщика"""
         if self.is_running:
             return
         
-        # POLLING: Проверяем записи каждые 60 секунд (замена webhook)
+        # POLLING: интервал подстраивается под частоту изменений и работу webhook
         self.scheduler.add_job(
-            self.poll_records,
-            trigger=IntervalTrigger(seconds=60),
+            self._poll_job,
+            trigger=IntervalTrigger(seconds=round(self.poll_interval.interval)),
             id="poll_records",
             name="Polling записей",
             replace_existing=True
         )
         
-        # Проверяем записи каждые 5 минут (напоминания)
+        # Напоминания за 24ч/1ч и запросы отзывов отправляет reminder_timer
+        # точно в срок — здесь их не проверяем
+        
+        # Прошедшие записи — в архив, чтобы рабочие выборки оставались
+        # размером с предстоящее расписание
         self.scheduler.add_job(
-            self.check_and_send_reminders,
-            trigger=IntervalTrigger(minutes=5),
-            id="check_reminders",
-            name="Проверка напоминаний",
+            self.archive_past_records,
+            trigger=IntervalTrigger(hours=1),
+            id="archive_records",
+            name="Архивация прошедших записей",
             replace_existing=True
         )
         
-        # Проверяем завершённые визиты каждые 30 минут
+        # Старые переписка и напоминания — в архив, ночью
         self.scheduler.add_job(
-            self.check_completed_visits,
-            trigger=IntervalTrigger(minutes=30),
-            id="check_reviews",
-            name="Проверка отзывов",
+            self.run_retention,
+            trigger=CronTrigger(hour=config.RETENTION_HOUR, minute=30),
+            id="retention",
+            name="Архив и сжатие базы",
             replace_existing=True
         )
         
@@ -504,7 +348,7 @@ class ReminderScheduler:
         
         self.scheduler.start()
         self.is_running = True
-        print("⏰ Планировщик запущен (polling каждые 2 мин)")
+        print(f"⏰ Планировщик запущен (polling каждые {config.POLL_MIN_SECONDS}-{config.POLL_MAX_SECONDS} сек)")
     
     def stop(self):
         """Остановка планировщика"""
@@ -517,7 +361,7 @@ class ReminderScheduler:
     
     async def run_once(self):
         """Однократная проверка (для отладки)"""
-        await self.check_and_send_reminders()
+        await reminder_timer.fire_due()
     
     async def initial_sync(self):
         """Первичная синхронизация записей при старте"""
@@ -0,0 +1,189 @@
+"""
+Диспетчер исходящих сообщений Telegram
+Единая очередь отправки с приоритетами и дедлайнами, token bucket на аккаунт
+и общей паузой при FloodWait вместо повторной отправки внутри вызова
+"""
+import asyncio
+import heapq
+import itertools
+import time
+from typing import Awaitable, Callable, Optional
+
+from pyrogram.errors import FloodWait
+
+
+# Приоритеты: меньше — раньше
+PRIORITY_HIGH = 0     # Ответы клиенту, подтверждения
+PRIORITY_NORMAL = 1   # Уведомления о записях, напоминания
+PRIORITY_LOW = 2      # Рассылки (потеряшки)
+
+
+class TokenBucket:
+    """
+    Token bucket с адаптивной скоростью (AIMD): после FloodWait скорость
+    уменьшается вдвое, после серии успешных отправок растёт на шаг,
+    но не выше max_rate
+    """
+    
+    def __init__(self, rate: float, burst: int, min_rate: float, max_rate: float):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._successes = 0
+    
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+    
+    async def acquire(self):
+        """Дождаться токена"""
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+    
+    def refund(self):
+        """Вернуть токен, который взяли, но на отправку не потратили"""
+        self._tokens = min(self.burst, self._tokens + 1)
+    
+    def on_success(self):
+        self._successes += 1
+        if self._successes >= self.burst * 10:
+            self._successes = 0
+            self.rate = min(self.max_rate, self.rate + self.min_rate)
+    
+    def on_flood(self):
+        self._successes = 0
+        self._tokens = 0
+        self.rate = max(self.min_rate, self.rate / 2)
+
+
+class SendDispatcher:
+    """
+    Очередь отправки для одного аккаунта.
+    enqueue() возвращает Future с результатом send_func (или None,
+    если дедлайн истёк). При FloodWait все воркеры ставятся на общую
+    паузу, а сообщение возвращается в очередь.
+    """
+    
+    def __init__(
+        self,
+        send_func: Callable[..., Awaitable],
+        rate: float,
+        burst: int,
+        min_rate: float,
+        max_rate: float,
+        workers: int
+    ):
+        self.send_func = send_func
+        self.bucket = TokenBucket(rate, burst, min_rate, max_rate)
+        self.workers = max(1, workers)
+        self._heap = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._tasks = []
+        self._paused_until = 0.0
+        self.sent = 0
+        self.flood_waits = 0
+    
+    def start(self):
+        """Запустить воркеры (повторный вызов ничего не делает)"""
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+    
+    async def stop(self):
+        """Остановить воркеры, неотправленные сообщения завершаются с None"""
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        while self._heap:
+            *_, future, _, _ = heapq.heappop(self._heap)
+            if not future.done():
+                future.set_result(None)
+    
+    def enqueue(
+        self,
+        *args,
+        priority: int = PRIORITY_NORMAL,
+        deadline: Optional[float] = None,
+        **kwargs
+    ) -> asyncio.Future:
+        """
+        Поставить отправку в очередь.
+        deadline — time.time(), после которого сообщение уже не нужно.
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._heap, (priority, next(self._seq), deadline, future, args, kwargs))
+        self._wakeup.set()
+        return future
+    
+    @property
+    def pending(self) -> int:
+        return len(self._heap)
+    
+    async def _worker(self):
+        while True:
+            while not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            
+            # Общая пауза после FloodWait
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            
+            # Токен, не ушедший на отправку, возвращается — иначе
+            # при конкуренции воркеров реальная скорость ниже заданной
+            await self.bucket.acquire()
+            if not self._heap:
+                self.bucket.refund()
+                continue
+            if self._paused_until > time.monotonic():
+                # Пока ждали токен, другой воркер получил FloodWait
+                self.bucket.refund()
+                continue
+            
+            priority, seq, deadline, future, args, kwargs = heapq.heappop(self._heap)
+            if future.done():
+                self.bucket.refund()
+                continue
+            if deadline is not None and time.time() > deadline:
+                print("⌛ Сообщение не отправлено: истёк срок актуальности")
+                future.set_result(None)
+                self.bucket.refund()
+                continue
+            
+            try:
+                result = await self.send_func(*args, **kwargs)
+            except FloodWait as e:
+                self.flood_waits += 1
+                self.bucket.on_flood()
+                self._paused_until = max(self._paused_until, time.monotonic() + e.value)
+                print(f"⏳ FloodWait: пауза отправки {e.value} сек, "
+                      f"скорость снижена до {self.bucket.rate:.2f} сообщ/сек")
+                heapq.heappush(self._heap, (priority, seq, deadline, future, args, kwargs))
+                continue
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            
+            self.sent += 1
+            self.bucket.on_success()
+            if not future.done():
+                future.set_result(result)
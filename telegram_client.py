@@ -4,14 +4,16 @@ Telegram клиент (userbot) для отправки напоминаний
 """
 import asyncio
 import re
+import time
 from datetime import datetime
-from typing import Optional, Callable, Union
+from typing import Iterable, Optional, Callable, Union
 from pyrogram import Client, filters
 from pyrogram.types import Message
 from pyrogram.errors import FloodWait, UserNotMutualContact, PeerIdInvalid
 
 from config import config
-from database import db
+from database import db, phone_key
+from send_dispatcher import SendDispatcher, PRIORITY_NORMAL
 
 
 class TelegramClient:
@@ -23,6 +25,20 @@ class TelegramClient:
             phone_number=config.TELEGRAM_PHONE
         )
         self.message_handlers = []
+        # Индекс контактов: phone_key -> данные пользователя Telegram
+        self.contacts = {}
+        self._contact_keys = {}  # user_id -> phone_key
+        # Номера без Telegram: phone_key -> (attempts, next_check_at)
+        self._misses = {}
+        # Единая очередь отправки с ограничением скорости
+        self.dispatcher = SendDispatcher(
+            self._send_now,
+            rate=config.TELEGRAM_SEND_RATE,
+            burst=config.TELEGRAM_SEND_BURST,
+            min_rate=config.TELEGRAM_SEND_MIN_RATE,
+            max_rate=config.TELEGRAM_SEND_MAX_RATE,
+            workers=config.TELEGRAM_SEND_WORKERS
+        )
         self._setup_handlers()
     
     def _setup_handlers(self):
@@ -30,12 +46,145 @@ class TelegramClient:
         @self.app.on_message(filters.private & filters.incoming)
         async def handle_incoming_message(client: Client, message: Message):
             """Обработка входящих сообщений от клиентов"""
+            user = message.from_user
+            if user and user.phone_number:
+                self._index_user(user.phone_number, user.id, user.username,
+                                 user.first_name, user.last_name)
+            
             for handler in self.message_handlers:
                 try:
                     await handler(message)
                 except Exception as e:
                     print(f"Ошибка в обработчике сообщений: {e}")
     
+        @self.app.on_raw_update(group=1)
+        async def handle_raw_update(client: Client, update, users, chats):
+            """Смена номера у пользователя — обновляем индекс контактов"""
+            from pyrogram.raw.types import UpdateUserPhone
+            if isinstance(update, UpdateUserPhone):
+                known = self.contacts.get(self._contact_keys.get(update.user_id), {})
+                self._index_user(update.phone, update.user_id, known.get("username"),
+                                 known.get("first_name"), known.get("last_name"))
+    
+    def _index_user(
+        self,
+        phone: Optional[str],
+        user_id: int,
+        username: Optional[str] = None,
+        first_name: Optional[str] = None,
+        last_name: Optional[str] = None
+    ) -> Optional[dict]:
+        """Добавить пользователя в индекс контактов"""
+        key = phone_key(phone)
+        if not key or not user_id:
+            return None
+        
+        old_key = self._contact_keys.get(user_id)
+        if old_key and old_key != key:
+            self.contacts.pop(old_key, None)
+        
+        user_info = {
+            "user_id": user_id,
+            "username": username,
+            "first_name": first_name,
+            "last_name": last_name,
+            "phone": self.normalize_phone(phone)
+        }
+        self.contacts[key] = user_info
+        self._contact_keys[user_id] = key
+        return user_info
+    
+    def _is_known_miss(self, key: Optional[str]) -> bool:
+        """Номер недавно проверялся и не найден — повторно не ищем"""
+        miss = self._misses.get(key)
+        return miss is not None and time.time() < miss[1]
+    
+    async def _remember_misses(self, keys: Iterable[str]):
+        """
+        Запомнить ненайденные номера. Интервал до повторной проверки
+        удваивается с каждой неудачной попыткой
+        """
+        now = int(time.time())
+        rows = []
+        for key in keys:
+            attempts = self._misses.get(key, (0, 0))[0] + 1
+            delay_hours = min(
+                config.TELEGRAM_MISS_RECHECK_HOURS * 2 ** (attempts - 1),
+                config.TELEGRAM_MISS_RECHECK_MAX_HOURS
+            )
+            next_check_at = now + int(delay_hours * 3600)
+            self._misses[key] = (attempts, next_check_at)
+            rows.append((key, attempts, now, next_check_at))
+        try:
+            await db.save_phone_misses(rows)
+        except Exception as e:
+            print(f"⚠️ Не удалось сохранить кэш ненайденных номеров: {e}")
+    
+    async def _forget_misses(self, keys: list):
+        """Убрать из кэша ненайденных номера, которые нашлись"""
+        keys = [key for key in keys if self._misses.pop(key, None)]
+        if not keys:
+            return
+        try:
+            await db.clear_phone_misses(keys)
+        except Exception as e:
+            print(f"⚠️ Не удалось обновить кэш ненайденных номеров: {e}")
+    
+    def index_imported_contacts(self, result, phones_by_client_id: dict) -> int:
+        """
+        Добавить в индекс результат ImportContacts.
+        phones_by_client_id — client_id из InputPhoneContact -> телефон.
+        Возвращает количество найденных пользователей.
+        """
+        users = {user.id: user for user in (result.users or [])}
+        found = 0
+        for imported in result.imported or []:
+            user = users.get(imported.user_id)
+            phone = getattr(user, "phone", None) or phones_by_client_id.get(imported.client_id)
+            if self._index_user(
+                phone, imported.user_id,
+                getattr(user, "username", None),
+                getattr(user, "first_name", None),
+                getattr(user, "last_name", None)
+            ):
+                found += 1
+        return found
+    
+    async def load_contact_index(self):
+        """
+        Построить индекс контактов при старте:
+        сначала из client_telegram_links (тёплый старт), затем одним
+        запросом списка контактов Telegram
+        """
+        try:
+            for link in await db.get_telegram_links():
+                self._index_user(link["phone"], link["telegram_user_id"], link["telegram_username"])
+            self._misses = await db.get_phone_misses()
+        except Exception as e:
+            print(f"⚠️ Не удалось загрузить связи из БД: {e}")
+        warm = len(self.contacts)
+        
+        try:
+            contacts = await self.app.get_contacts()
+        except Exception as e:
+            print(f"⚠️ Не удалось получить контакты Telegram: {e}")
+            return
+        
+        for contact in contacts:
+            if contact.phone_number:
+                self._index_user(contact.phone_number, contact.id, contact.username,
+                                 contact.first_name, contact.last_name)
+        
+        # Сохраняем найденные ID для клиентов, у которых их ещё нет
+        try:
+            await db.attach_telegram_by_phone([
+                (key, info["user_id"], info["username"]) for key, info in self.contacts.items()
+            ])
+        except Exception as e:
+            print(f"⚠️ Не удалось сохранить индекс контактов: {e}")
+        
+        print(f"📇 Индекс контактов: {len(self.contacts)} (из БД: {warm})")
+    
     def add_message_handler(self, handler: Callable):
         """Добавить обработчик входящих сообщений"""
         self.message_handlers.append(handler)
@@ -45,9 +194,12 @@ class TelegramClient:
         await self.app.start()
         me = await self.app.get_me()
         print(f"✅ Telegram клиент запущен как: {me.first_name} (@{me.username})")
+        await self.load_contact_index()
+        self.dispatcher.start()
     
     async def stop(self):
         """Остановка клиента"""
+        await self.dispatcher.stop()
         try:
             await self.app.stop()
         except Exception:
@@ -73,22 +225,17 @@ class TelegramClient:
         """
         normalized = self.normalize_phone(phone)
         
+        # Известные пользователи — из индекса, без запросов в сеть
+        key = phone_key(phone)
+        known = self.contacts.get(key)
+        if known:
+            return known
+        
+        # Номер недавно искали и не нашли — не тратим запросы (FloodWait)
+        if self._is_known_miss(key):
+            return None
+        
         try:
-            # Пробуем получить контакт по телефону
-            contacts = await self.app.get_contacts()
-            
-            for contact in contacts:
-                if contact.phone_number:
-                    contact_phone = self.normalize_phone(contact.phone_number)
-                    if contact_phone == normalized or contact_phone.endswith(normalized[-10:]):
-                        return {
-                            "user_id": contact.id,
-                            "username": contact.username,
-                            "first_name": contact.first_name,
-                            "last_name": contact.last_name,
-                            "phone": contact.phone_number
-                        }
-            
             # Если не нашли в контактах, пробуем импортировать с разными форматами
             from pyrogram.raw.functions.contacts import ImportContacts
             from pyrogram.raw.types import InputPhoneContact
@@ -120,13 +267,10 @@ class TelegramClient:
                     if result.users:
                         user = result.users[0]
                         print(f"✅ Контакт импортирован: {user.first_name} (ID: {user.id})")
-                        return {
-                            "user_id": user.id,
-                            "username": user.username,
-                            "first_name": user.first_name,
-                            "last_name": user.last_name,
-                            "phone": normalized
-                        }
+                        await self._forget_misses([key])
+                        return self._index_user(
+                            normalized, user.id, user.username, user.first_name, user.last_name
+                        )
                 except Exception as e:
                     print(f"   Формат {phone_format}: ошибка {e}")
                     continue
@@ -139,23 +283,103 @@ class TelegramClient:
                 if result.users:
                     user = result.users[0]
                     print(f"✅ Найден через ResolvePhone: {user.first_name} (ID: {user.id})")
-                    return {
-                        "user_id": user.id,
-                        "username": getattr(user, 'username', None),
-                        "first_name": getattr(user, 'first_name', ''),
-                        "last_name": getattr(user, 'last_name', ''),
-                        "phone": normalized
-                    }
+                    await self._forget_misses([key])
+                    return self._index_user(
+                        normalized, user.id,
+                        getattr(user, 'username', None),
+                        getattr(user, 'first_name', ''),
+                        getattr(user, 'last_name', '')
+                    )
             except Exception as e:
                 print(f"   ResolvePhone: {e}")
             
             print(f"⚠️ Пользователь с номером {normalized} не найден ни в одном формате")
+            if key:
+                await self._remember_misses([key])
             return None
             
         except Exception as e:
             print(f"Ошибка поиска пользователя по телефону {phone}: {e}")
             return None
     
+    async def resolve_phones(self, phones: Iterable[str]) -> int:
+        """
+        Пакетно найти в Telegram номера, которых нет в индексе.
+        Номера из кэша ненайденных (до срока повторной проверки) пропускаются,
+        остальные импортируются партиями по 100 контактов за запрос.
+        Возвращает количество найденных пользователей.
+        """
+        from pyrogram.raw.functions.contacts import ImportContacts
+        from pyrogram.raw.types import InputPhoneContact
+        
+        unknown = {}
+        for phone in phones:
+            key = phone_key(phone)
+            if key and key not in self.contacts and not self._is_known_miss(key):
+                unknown[key] = self.normalize_phone(phone)
+        
+        if not unknown:
+            return 0
+        
+        print(f"📥 Пакетный поиск в Telegram: {len(unknown)} номеров")
+        
+        batch_size = 100
+        items = list(unknown.items())
+        found_total = 0
+        
+        for i in range(0, len(items), batch_size):
+            batch = items[i:i + batch_size]
+            phones_by_client_id = {idx: phone for idx, (_, phone) in enumerate(batch)}
+            
+            try:
+                result = await self.app.invoke(
+                    ImportContacts(
+                        contacts=[
+                            InputPhoneContact(
+                                client_id=idx,
+                                phone=phone,
+                                first_name="Клиент",
+                                last_name="YClients"
+                            )
+                            for idx, phone in phones_by_client_id.items()
+                        ]
+                    )
+                )
+            except FloodWait as e:
+                print(f"⏳ FloodWait при пакетном поиске: {e.value} сек, остаток пропущен")
+                break
+            except Exception as e:
+                print(f"❌ Ошибка пакетного поиска: {e}")
+                continue
+            
+            found_total += self.index_imported_contacts(result, phones_by_client_id)
+            
+            batch_keys = [key for key, _ in batch]
+            await self._forget_misses([key for key in batch_keys if key in self.contacts])
+            await self._remember_misses([key for key in batch_keys if key not in self.contacts])
+        
+        print(f"   Найдено: {found_total} из {len(unknown)}")
+        return found_total
+    
+    def enqueue(
+        self,
+        phone_or_user_id: Union[str, int],
+        text: str,
+        record_id: Optional[int] = None,
+        yclients_client_id: Optional[int] = None,
+        priority: int = PRIORITY_NORMAL,
+        deadline: Optional[float] = None
+    ) -> asyncio.Future:
+        """
+        Поставить сообщение в очередь отправки.
+        Возвращает Future с отправленным Message (None — не доставлено
+        или истёк deadline, time.time()).
+        """
+        return self.dispatcher.enqueue(
+            phone_or_user_id, text, record_id, yclients_client_id,
+            priority=priority, deadline=deadline
+        )
+    
     async def send_message(
         self, 
         phone_or_user_id: Union[str, int],
@@ -164,7 +388,20 @@ class TelegramClient:
         yclients_client_id: Optional[int] = None
     ) -> Optional[Message]:
         """
-        Отправить сообщение клиенту
+        Отправить сообщение клиенту (через общую очередь отправки)
+        """
+        return await self.enqueue(phone_or_user_id, text, record_id, yclients_client_id)
+    
+    async def _send_now(
+        self, 
+        phone_or_user_id: Union[str, int],
+        text: str,
+        record_id: Optional[int] = None,
+        yclients_client_id: Optional[int] = None
+    ) -> Optional[Message]:
+        """
+        Непосредственная отправка (вызывается диспетчером).
+        FloodWait пробрасывается — паузу выдерживает диспетчер.
         """
         try:
             # Если передан телефон, ищем пользователя
@@ -205,10 +442,8 @@ class TelegramClient:
             print(f"✉️ Сообщение отправлено пользователю {user_id}")
             return message
             
-        except FloodWait as e:
-            print(f"⏳ FloodWait: ждём {e.value} секунд...")
-            await asyncio.sleep(e.value)
-            return await self.send_message(phone_or_user_id, text, record_id, yclients_client_id)
+        except FloodWait:
+            raise
             
         except UserNotMutualContact:
             print(f"⚠️ Пользователь {phone_or_user_id} не в контактах")
@@ -0,0 +1,101 @@
+"""
+Журнал webhook — приём событий YClients без потерь
+Endpoint только записывает событие в таблицу webhook_journal и сразу
+отвечает 200, а воркеры разбирают журнал по порядку. Необработанные
+события переживают перезапуск, за период их можно повторить
+(replay_webhooks.py).
+
+Состояния: pending → processing → done | failed
+"""
+import asyncio
+import json
+from typing import Awaitable, Callable, Optional
+
+from config import config
+from database import db
+
+
+class WebhookJournal:
+    def __init__(self):
+        self._handler: Optional[Callable[[dict], Awaitable]] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._queues = []
+        self._tasks = []
+    
+    async def append(self, data: dict) -> int:
+        """Записать webhook в журнал (одна локальная запись)"""
+        journal_id = await db.append_webhook(
+            resource=data.get("resource", ""),
+            status=data.get("status", ""),
+            resource_id=data.get("resource_id"),
+            payload=json.dumps(data, ensure_ascii=False)
+        )
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return journal_id
+    
+    async def start(self, handler: Callable[[dict], Awaitable]):
+        """Запустить разбор журнала (и вернуть в очередь прерванные события)"""
+        if self._tasks:
+            return
+        interrupted = await db.requeue_webhooks()
+        if interrupted:
+            print(f"📒 Журнал webhook: {interrupted} прерванных событий возвращено в очередь")
+        self._handler = handler
+        self._wakeup = asyncio.Event()
+        workers = max(1, config.WEBHOOK_WORKERS)
+        self._queues = [asyncio.Queue(maxsize=10) for _ in range(workers)]
+        self._tasks = [asyncio.create_task(self._dispatch())]
+        self._tasks += [asyncio.create_task(self._worker(queue)) for queue in self._queues]
+    
+    async def stop(self):
+        """Остановить разбор (взятые события вернутся в очередь при старте)"""
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._queues = []
+    
+    async def _dispatch(self):
+        """Забирать события из журнала и раздавать воркерам"""
+        while True:
+            try:
+                rows = await db.claim_webhooks(limit=len(self._queues) * 5)
+            except Exception as e:
+                print(f"❌ Журнал webhook: ошибка чтения: {e}")
+                rows = []
+            
+            if not rows:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), config.WEBHOOK_JOURNAL_POLL_SECONDS)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            
+            # События одной записи (клиента) — всегда одному воркеру,
+            # поэтому они обрабатываются строго по порядку.
+            # Полная очередь воркера притормаживает чтение журнала.
+            for row in rows:
+                key = f"{row['resource']}:{row['resource_id']}"
+                await self._queues[hash(key) % len(self._queues)].put(row)
+    
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            row = await queue.get()
+            try:
+                await self._handler(json.loads(row["payload"]))
+            except Exception as e:
+                await db.finish_webhook(row["id"], error=str(e) or type(e).__name__)
+            else:
+                await db.finish_webhook(row["id"])
+            finally:
+                queue.task_done()
+
+
+# Синглтон
+webhook_journal = WebhookJournal()
@@ -1,152 +1,74 @@
 """
 Webhook сервер для получения событий из YClients
 Позволяет реагировать на новые записи, отмены и изменения в реальном времени
-+ Scheduler для напоминаний за 24ч и 1ч
++ Таймер напоминаний за 24ч и 1ч
 """
+import base64
 import hashlib
 import hmac
+import html
+import json
 import asyncio
-from datetime import datetime, timedelta
-from fastapi import FastAPI, Request, HTTPException, BackgroundTasks
+from datetime import datetime
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
 from config import config
-from database import db
+from database import db, POLL_STATS_KEY, RETENTION_STATS_KEY, SNIPPET_OPEN, SNIPPET_CLOSE
+from http_clients import http_clients
 from telegram_client import telegram
+from outbox import outbox
+from reminder_timer import reminder_timer
+from webhook_journal import webhook_journal
+from conversation_feed import conversation_feed
+from record_events import RecordEvent, record_events
 from yclients_api import yclients
-from templates import (
-    msg_booking_created, msg_booking_changed, msg_booking_cancelled,
-    msg_confirmation_24h, msg_reminder_1h
-)
-from bot_checker import get_bot_client_chat_id, send_via_bot
+from records import Record
+from bot_checker import bot_index
 
 
 app = FastAPI(title="YClients Telegram Integration", version="1.0.0")
 
-# Scheduler для напоминаний
-scheduler = AsyncIOScheduler()
-
-
-# === Инициализация Telegram и Scheduler при старте ===
+# === Инициализация Telegram и таймера напоминаний при старте ===
 @app.on_event("startup")
 async def startup_event():
-    """Запуск Telegram клиента и scheduler при старте сервера"""
-    await db.init()
-    await db.init_records_tracking()
-    await telegram.start()
-    
-    # Запускаем scheduler для напоминаний
-    scheduler.add_job(check_reminders, 'interval', minutes=5, id='check_reminders')
-    scheduler.start()
+    """Запуск Telegram клиента и таймера напоминаний при старте сервера"""
+    # При ошибке старта shutdown не вызывается — закрываем всё сами,
+    # иначе потоки соединений с БД не дадут процессу завершиться
+    try:
+        await db.init()
+        await db.init_records_tracking()
+        await http_clients.start()
+        bot_index.start()
+        await telegram.start()
+        await outbox.start()
+        
+        # Напоминания за 24ч и 1ч — по расписанию из БД
+        reminder_timer.start()
+        
+        # Разбор принятых webhook из журнала
+        await webhook_journal.start(process_webhook)
+    except BaseException:
+        await shutdown_event()
+        raise
     
     print("✅ Telegram клиент запущен!")
-    print("✅ Scheduler напоминаний запущен (проверка каждые 5 минут)")
+    print("✅ Таймер напоминаний запущен")
 
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    """Остановка Telegram клиента и scheduler"""
-    scheduler.shutdown()
+    """Остановка Telegram клиента и таймера напоминаний"""
+    await conversation_feed.stop()
+    await webhook_journal.stop()
+    await reminder_timer.stop()
+    await outbox.stop()
     await telegram.stop()
-
-
-async def check_reminders():
-    """Проверка и отправка напоминаний за 24ч и 1ч"""
-    try:
-        now = datetime.now()
-        print(f"⏰ Проверка напоминаний: {now.strftime('%H:%M')}")
-        
-        # Получаем все активные записи из БД
-        import aiosqlite
-        async with aiosqlite.connect(config.DATABASE_PATH) as conn:
-            conn.row_factory = aiosqlite.Row
-            cursor = await conn.execute(
-                "SELECT * FROM known_records WHERE status = 'active'"
-            )
-            records = await cursor.fetchall()
-        
-        for record in records:
-            record_id = record["record_id"]
-            client_phone = record["client_phone"]
-            client_name = record["client_name"]
-            service_name = record["service_name"]
-            staff_name = record["staff_name"]
-            record_date = record["record_date"]
-            record_time = record["record_time"]
-            
-            if not client_phone:
-                continue
-            
-            # Парсим дату записи
-            try:
-                record_datetime = datetime.strptime(f"{record_date} {record_time}", "%Y-%m-%d %H:%M:%S")
-            except:
-                try:
-                    record_datetime = datetime.strptime(f"{record_date} {record_time}", "%Y-%m-%d %H:%M")
-                except:
-                    continue
-            
-            # Пропускаем прошедшие записи
-            if record_datetime < now:
-                continue
-            
-            time_until = record_datetime - now
-            hours_until = time_until.total_seconds() / 3600
-            
-            # === Напоминание за 24 часа ===
-            if 23 <= hours_until <= 25:
-                if not await db.is_reminder_sent(record_id, "24h"):
-                    print(f"📤 Напоминание 24ч: {client_name} ({record_id})")
-                    
-                    # Проверяем, есть ли клиент в боте
-                    bot_chat_id = await get_bot_client_chat_id(client_phone)
-                    
-                    if not bot_chat_id:
-                        # Клиент НЕ в боте — отправляем через userbot
-                        text = msg_confirmation_24h(client_name, service_name, staff_name, record_datetime)
-                        result = await telegram.send_message(
-                            phone_or_user_id=client_phone,
-                            text=text,
-                            record_id=record_id
-                        )
-                        if result:
-                            await db.mark_reminder_sent(record_id, "24h", result.id if hasattr(result, 'id') else None)
-                            print(f"   ✅ Отправлено через userbot")
-                    else:
-                        print(f"   ℹ️ Клиент в боте — бот отправит напоминание")
-                        await db.mark_reminder_sent(record_id, "24h")
-            
-            # === Напоминание за 1 час ===
-            elif 0.5 <= hours_until <= 1.5:
-                if not await db.is_reminder_sent(record_id, "1h"):
-                    print(f"📤 Напоминание 1ч: {client_name} ({record_id})")
-                    
-                    # Проверяем, есть ли клиент в боте
-                    bot_chat_id = await get_bot_client_chat_id(client_phone)
-                    
-                    if not bot_chat_id:
-                        # Клиент НЕ в боте — отправляем через userbot
-                        text = msg_reminder_1h(client_name, service_name, staff_name, record_datetime)
-                        result = await telegram.send_message(
-                            phone_or_user_id=client_phone,
-                            text=text,
-                            record_id=record_id
-                        )
-                        if result:
-                            await db.mark_reminder_sent(record_id, "1h", result.id if hasattr(result, 'id') else None)
-                            print(f"   ✅ Отправлено через userbot")
-                    else:
-                        print(f"   ℹ️ Клиент в боте — бот отправит напоминание")
-                        await db.mark_reminder_sent(record_id, "1h")
-        
-        print(f"   Проверено записей: {len(records)}")
-        
-    except Exception as e:
-        import traceback
-        print(f"❌ Ошибка проверки напоминаний: {e}")
-        traceback.print_exc()
+    await bot_index.stop()
+    await http_clients.close()
+    await db.close()
 
 
 def verify_signature(payload: bytes, signature: str, secret: str) -> bool:
@@ -171,14 +93,20 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    """Health check endpoint"""
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+    """Health check endpoint (+ статистика polling из main.py)"""
+    poll_stats = await db.get_sync_state(POLL_STATS_KEY)
+    retention_stats = await db.get_sync_state(RETENTION_STATS_KEY)
+    return {
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "polling": json.loads(poll_stats) if poll_stats else None,
+        "retention": json.loads(retention_stats) if retention_stats else None
+    }
 
 
 @app.post("/webhook/yclients")
 async def yclients_webhook(
-    request: Request,
-    background_tasks: BackgroundTasks
+    request: Request
 ):
     """
     Обработка webhook от YClients
@@ -196,13 +124,14 @@ async def yclients_webhook(
     
     print(f"📥 Webhook: {data.get('resource')}.{data.get('status')}")
     
-    background_tasks.add_task(process_webhook, data)
+    # Сначала на диск, обработка — воркерами журнала
+    await webhook_journal.append(data)
     
     return {"status": "accepted"}
 
 
 async def process_webhook(data: dict):
-    """Обработка webhook в фоновом режиме"""
+    """Обработка webhook из журнала (ошибка — событие помечается failed)"""
     resource = data.get("resource", "")
     status = data.get("status", "")
     resource_id = data.get("resource_id")
@@ -222,10 +151,14 @@ async def process_webhook(data: dict):
         import traceback
         print(f"❌ Ошибка обработки webhook: {e}")
         traceback.print_exc()
+        raise
 
 
 async def handle_record_event(status: str, record_id: int, data: dict):
-    """Обработка событий записей"""
+    """
+    Обработка событий записей: событие публикуется в общую шину
+    (та же, что у polling) — повторы отсекаются по отпечатку записи
+    """
     
     # Получаем полные данные записи
     try:
@@ -234,153 +167,27 @@ async def handle_record_event(status: str, record_id: int, data: dict):
     except Exception:
         record = data
     
-    # Извлекаем информацию
-    client_data = record.get("client") or {}
-    client_name = client_data.get("name", "").split()[0] if client_data.get("name") else "Клиент"
-    client_phone = client_data.get("phone", "")
-    client_id = client_data.get("id")
+    # Разбираем запись один раз
+    parsed = Record.from_api(record)
     
-    if not client_phone:
+    if not parsed.client_phone:
         print(f"⚠️ Запись {record_id}: нет телефона клиента")
-        return
-    
-    services = record.get("services", [])
-    service_name = ", ".join([s.get("title", "") for s in services]) or "Услуга"
-    
-    staff = record.get("staff", {})
-    staff_name = staff.get("name", "Мастер")
-    
-    # Парсим дату - YClients возвращает datetime в ISO формате: 2026-02-06T22:15:00+03:00
-    datetime_field = record.get("datetime", "")
     
-    print(f"📅 Парсинг даты: datetime={datetime_field}")
-    
-    try:
-        # ISO формат с часовым поясом: 2026-02-06T22:15:00+03:00
-        if "T" in str(datetime_field):
-            # Убираем часовой пояс и парсим
-            dt_str = str(datetime_field).split("+")[0].split("-03:00")[0].split("-00:00")[0]
-            record_datetime = datetime.fromisoformat(dt_str)
-            print(f"📅 Время записи (ISO): {record_datetime}")
-        else:
-            # Старый формат: YYYY-MM-DD HH:MM:SS
-            date_str = record.get("date", "")
-            time_str = str(datetime_field).split(" ")[-1] if datetime_field else "00:00:00"
-            record_datetime = datetime.strptime(f"{date_str} {time_str}", "%Y-%m-%d %H:%M:%S")
-            print(f"📅 Время записи: {record_datetime}")
-    except Exception as e:
-        print(f"⚠️ Ошибка парсинга даты: {e}")
-        record_datetime = datetime.now()
-        print(f"⚠️ Используем текущее время: {record_datetime}")
+    # YClients возвращает datetime в ISO формате: 2026-02-06T22:15:00+03:00
+    if parsed.starts_at is None:
+        print(f"⚠️ Ошибка парсинга даты: datetime={record.get('datetime')}, используем текущее время")
+    print(f"📅 Время записи: {parsed.local_start}")
     
-    # === НОВАЯ ЗАПИСЬ ===
-    if status == "create":
-        print(f"📝 Новая запись #{record_id}: {client_name}, тел: {client_phone}")
-        
-        # Сохраняем запись в БД для напоминаний
-        await db.save_known_record(
-            record_id=record_id,
-            client_phone=client_phone,
-            client_name=client_name,
-            service_name=service_name,
-            staff_name=staff_name,
-            record_date=record_datetime.strftime("%Y-%m-%d"),
-            record_time=record_datetime.strftime("%H:%M:%S"),
-            record_hash="",
-            status="active"
-        )
-        print(f"   💾 Запись сохранена в БД для напоминаний")
-        
-        text = msg_booking_created(client_name, service_name, staff_name, record_datetime)
-        
-        # Проверяем, есть ли клиент в боте
-        bot_chat_id = await get_bot_client_chat_id(client_phone)
-        
-        if bot_chat_id:
-            # Клиент в боте — отправляем через бота
-            print(f"🤖 Клиент в боте (chat_id={bot_chat_id}), отправляем через бота")
-            result = await send_via_bot(bot_chat_id, text)
-            if result:
-                print(f"✅ Сообщение отправлено через бота")
-            else:
-                print(f"⚠️ Ошибка отправки через бота")
-        else:
-            # Клиент НЕ в боте — отправляем через userbot + ссылка на бота
-            if config.BOT_USERNAME:
-                text += f"\n\n🤖 Для управления записями подключите бота: @{config.BOT_USERNAME}"
-            
-            result = await telegram.send_message(
-                phone_or_user_id=client_phone,
-                text=text,
-                record_id=record_id,
-                yclients_client_id=client_id
-            )
-            if result:
-                print(f"✅ Сообщение отправлено через userbot клиенту {client_phone}")
-            else:
-                print(f"⚠️ Не удалось отправить сообщение клиенту {client_phone}")
-    
-    # === ЗАПИСЬ ОТМЕНЕНА ===
-    elif status == "delete" or record.get("deleted"):
-        print(f"❌ Запись #{record_id} отменена: {client_name}, тел: {client_phone}")
-        
-        # Удаляем запись из БД напоминаний
-        await db.mark_record_deleted(record_id)
-        print(f"   💾 Запись удалена из БД напоминаний")
-        
-        text = msg_booking_cancelled(client_name, service_name, record_datetime)
-        
-        # Проверяем, есть ли клиент в боте
-        bot_chat_id = await get_bot_client_chat_id(client_phone)
-        
-        if bot_chat_id:
-            print(f"🤖 Клиент в боте, отправляем через бота")
-            await send_via_bot(bot_chat_id, text)
-        else:
-            result = await telegram.send_message(
-                phone_or_user_id=client_phone,
-                text=text,
-                record_id=record_id,
-                yclients_client_id=client_id
-            )
-            if result:
-                print(f"✅ Сообщение об отмене отправлено через userbot")
+    deleted = status == "delete" or parsed.deleted
+    if not deleted and status not in ("create", "update"):
+        print(f"⚠️ Неизвестный статус записи: {status}")
+        return
     
-    # === ЗАПИСЬ ИЗМЕНЕНА ===
-    elif status == "update":
-        print(f"📝 Запись #{record_id} изменена: {client_name}, тел: {client_phone}")
-        
-        # Обновляем запись в БД для напоминаний
-        await db.save_known_record(
-            record_id=record_id,
-            client_phone=client_phone,
-            client_name=client_name,
-            service_name=service_name,
-            staff_name=staff_name,
-            record_date=record_datetime.strftime("%Y-%m-%d"),
-            record_time=record_datetime.strftime("%H:%M:%S"),
-            record_hash="",
-            status="active"
-        )
-        print(f"   💾 Запись обновлена в БД для напоминаний")
-        
-        text = msg_booking_changed(client_name, service_name, staff_name, record_datetime)
-        
-        # Проверяем, есть ли клиент в боте
-        bot_chat_id = await get_bot_client_chat_id(client_phone)
-        
-        if bot_chat_id:
-            print(f"🤖 Клиент в боте, отправляем через бота")
-            await send_via_bot(bot_chat_id, text)
-        else:
-            result = await telegram.send_message(
-                phone_or_user_id=client_phone,
-                text=text,
-                record_id=record_id,
-                yclients_client_id=client_id
-            )
-            if result:
-                print(f"✅ Сообщение об изменении отправлено через userbot")
+    accepted = await record_events.publish([
+        RecordEvent(record_id, known=parsed.to_known_record(), deleted=deleted, source="webhook")
+    ])
+    if not accepted:
+        print(f"   ℹ️ Запись #{record_id}: изменений нет (уже обработано)")
 
 
 async def handle_client_event(status: str, client_id: int, data: dict):
@@ -397,108 +204,313 @@ async def handle_client_event(status: str, client_id: int, data: dict):
 
 
 # API для просмотра переписки
-@app.get("/api/conversations/{client_id}")
-async def get_client_conversations(client_id: int, limit: int = 50):
-    """Получить историю переписки с клиентом"""
-    history = await db.get_conversation_history(client_id, limit)
+HISTORY_MAX_LIMIT = 500  # Сообщений на страницу, не больше
+
+
+SEARCH_MAX_LIMIT = 100   # Результатов поиска на страницу, не больше
+
+
+def encode_cursor(*values) -> str:
+    """Непрозрачный курсор страницы из значений ключа сортировки"""
+    raw = "|".join(str(value) for value in values)
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token: Optional[str], *types) -> Optional[tuple]:
+    """Разобрать курсор: types — типы значений по порядку"""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        values = raw.rsplit("|", len(types) - 1)
+        if len(values) != len(types):
+            raise ValueError(raw)
+        return tuple(cast(value) for cast, value in zip(types, values))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def encode_history_cursor(message: dict) -> str:
+    """Курсор страницы переписки: (created_at, id) сообщения"""
+    return encode_cursor(message["created_at"], message["id"])
+
+
+def decode_history_cursor(token: Optional[str]) -> Optional[tuple]:
+    return decode_cursor(token, str, int)
+
+
+async def history_etag(client_id: int, request: Request) -> str:
+    """ETag переписки: версия истории + параметры страницы"""
+    count, last_id = await db.get_conversation_version(client_id)
+    params = "&".join(f"{key}={value}" for key, value in sorted(request.query_params.items()))
+    digest = hashlib.md5(f"{client_id}|{count}|{last_id}|{params}".encode()).hexdigest()
+    return f'W/"{digest}"'
+
+
+def _opaque_tag(tag: str) -> str:
+    """ETag без признака W/ — If-None-Match сравнивается слабо"""
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+
+def not_modified(request: Request, etag: str) -> bool:
+    """Есть ли etag в If-None-Match (список тегов через запятую или *)"""
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return _opaque_tag(etag) in {_opaque_tag(tag) for tag in header.split(",")}
+
+
+@app.get("/api/conversations/search")
+async def search_conversations(
+    q: str,
+    limit: int = 20,
+    client_id: Optional[int] = None,
+    cursor: Optional[str] = None
+):
+    """
+    Поиск по тексту переписки: лучшие совпадения первыми, в snippet
+    найденные слова выделены <b>. cursor — из next_cursor предыдущей страницы
+    """
+    limit = max(1, min(limit, SEARCH_MAX_LIMIT))
+    results = await db.search_conversations(
+        q, limit,
+        yclients_client_id=client_id,
+        after=decode_cursor(cursor, float, int)
+    )
+    for result in results:
+        result["snippet"] = (
+            html.escape(result["snippet"] or "", quote=False)
+            .replace(SNIPPET_OPEN, "<b>")
+            .replace(SNIPPET_CLOSE, "</b>")
+        )
     return {
-        "client_id": client_id,
-        "messages": history
+        "query": q,
+        "results": results,
+        "next_cursor": (
+            encode_cursor(repr(results[-1]["rank"]), results[-1]["id"])
+            if len(results) == limit else None
+        )
     }
 
 
-@app.get("/api/conversations/{client_id}/html")
-async def get_client_conversations_html(client_id: int, limit: int = 50):
-    """Получить историю переписки в HTML формате"""
-    history = await db.get_conversation_history(client_id, limit)
-    
-    html = """
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <meta charset="utf-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1">
-        <style>
-            * { box-sizing: border-box; }
-            body {
-                font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
-                padding: 16px;
-                background: #f5f5f5;
-                margin: 0;
-            }
-            .chat-container {
-                max-width: 500px;
-                margin: 0 auto;
-            }
-            .message {
-                padding: 10px 14px;
-                border-radius: 16px;
-                margin-bottom: 8px;
-                max-width: 85%;
-                word-wrap: break-word;
-                white-space: pre-wrap;
-            }
-            .outgoing {
-                background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-                color: white;
-                margin-left: auto;
-                border-bottom-right-radius: 4px;
-            }
-            .incoming {
-                background: white;
-                color: #333;
-                border: 1px solid #e0e0e0;
-                border-bottom-left-radius: 4px;
-            }
-            .time {
-                font-size: 11px;
-                color: #999;
-                margin-top: 4px;
-            }
-            .outgoing .time {
-                color: rgba(255,255,255,0.7);
-            }
-            .empty {
-                text-align: center;
-                color: #999;
-                padding: 40px;
-            }
-            .header {
-                text-align: center;
-                padding: 10px;
-                color: #666;
-                font-size: 14px;
-            }
-        </style>
-    </head>
-    <body>
-        <div class="chat-container">
-            <div class="header">💬 История переписки</div>
+@app.get("/api/conversations/{client_id}")
+async def get_client_conversations(
+    request: Request,
+    client_id: int,
+    limit: int = 50,
+    before: Optional[str] = None,
+    after: Optional[str] = None
+):
+    """
+    Получить историю переписки с клиентом (новые первыми).
+    before / after — курсоры из ответа для соседних страниц
     """
+    etag = await history_etag(client_id, request)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
     
-    if not history:
-        html += '<div class="empty">Нет сообщений</div>'
-    else:
-        for msg in reversed(history):
-            direction_class = msg["direction"]
-            time_str = msg["created_at"][:16].replace("T", " ") if msg.get("created_at") else ""
-            text = msg["message_text"].replace("<", "&lt;").replace(">", "&gt;")
-            
-            html += f'''
-            <div class="message {direction_class}">
+    limit = max(1, min(limit, HISTORY_MAX_LIMIT))
+    history = await db.get_conversation_history(
+        client_id, limit,
+        before=decode_history_cursor(before),
+        after=decode_history_cursor(after)
+    )
+    return JSONResponse(
+        {
+            "client_id": client_id,
+            "messages": history,
+            "cursors": {
+                "before": encode_history_cursor(history[-1]) if history else None,
+                "after": encode_history_cursor(history[0]) if history else None,
+            }
+        },
+        headers={"ETag": etag}
+    )
+
+
+CHAT_HTML_HEAD = """<!DOCTYPE html>
+<html>
+<head>
+    <meta charset="utf-8">
+    <meta name="viewport" content="width=device-width, initial-scale=1">
+    <style>
+        * { box-sizing: border-box; }
+        body {
+            font-family: -apple-system, BlinkMacSystemFont, 'Segoe UI', Roboto, sans-serif;
+            padding: 16px;
+            background: #f5f5f5;
+            margin: 0;
+        }
+        .chat-container {
+            max-width: 500px;
+            margin: 0 auto;
+        }
+        .message {
+            padding: 10px 14px;
+            border-radius: 16px;
+            margin-bottom: 8px;
+            max-width: 85%;
+            word-wrap: break-word;
+            white-space: pre-wrap;
+        }
+        .outgoing {
+            background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+            color: white;
+            margin-left: auto;
+            border-bottom-right-radius: 4px;
+        }
+        .incoming {
+            background: white;
+            color: #333;
+            border: 1px solid #e0e0e0;
+            border-bottom-left-radius: 4px;
+        }
+        .time {
+            font-size: 11px;
+            color: #999;
+            margin-top: 4px;
+        }
+        .outgoing .time {
+            color: rgba(255,255,255,0.7);
+        }
+        .empty {
+            text-align: center;
+            color: #999;
+            padding: 40px;
+        }
+        .header {
+            text-align: center;
+            padding: 10px;
+            color: #666;
+            font-size: 14px;
+        }
+    </style>
+</head>
+<body>
+    <div class="chat-container">
+        <div class="header">💬 История переписки</div>
+"""
+
+CHAT_HTML_TAIL = """
+    </div>
+    <script>
+        // Новые сообщения приходят по SSE (только для последней страницы)
+        (function () {
+            var params = new URLSearchParams(location.search);
+            if (params.has("before") || !window.EventSource) return;
+            var container = document.querySelector(".chat-container");
+            var messages = container.querySelectorAll(".message");
+            var lastId = messages.length ? messages[messages.length - 1].dataset.id : "";
+            var url = location.pathname.replace(/html$/, "events") + (lastId ? "?last_id=" + lastId : "");
+            var source = new EventSource(url);
+            source.onmessage = function (event) {
+                var msg = JSON.parse(event.data);
+                var empty = container.querySelector(".empty");
+                if (empty) empty.remove();
+                var div = document.createElement("div");
+                div.className = "message " + msg.direction;
+                div.dataset.id = msg.id;
+                div.textContent = msg.message_text;
+                var time = document.createElement("div");
+                time.className = "time";
+                time.textContent = (msg.created_at || "").slice(0, 16).replace("T", " ");
+                div.appendChild(time);
+                container.appendChild(div);
+                window.scrollTo(0, document.body.scrollHeight);
+            };
+        })();
+    </script>
+</body>
+</html>
+"""
+
+
+def render_chat_message(msg: dict) -> str:
+    """HTML одного сообщения переписки"""
+    time_str = msg["created_at"][:16].replace("T", " ") if msg.get("created_at") else ""
+    text = html.escape(msg["message_text"], quote=False)
+    return f'''
+            <div class="message {msg["direction"]}" data-id="{msg["id"]}">
                 {text}
                 <div class="time">{time_str}</div>
             </div>
             '''
+
+
+@app.get("/api/conversations/{client_id}/html")
+async def get_client_conversations_html(
+    request: Request,
+    client_id: int,
+    limit: int = 50,
+    before: Optional[str] = None,
+    after: Optional[str] = None
+):
+    """
+    Получить историю переписки в HTML формате.
+    Страница отдаётся потоком — сообщения выводятся по мере чтения из БД
+    """
+    etag = await history_etag(client_id, request)
+    if not_modified(request, etag):
+        return Response(status_code=304, headers={"ETag": etag})
+    
+    limit = max(1, min(limit, HISTORY_MAX_LIMIT))
+    messages = db.iter_conversation_history(
+        client_id, limit,
+        before=decode_history_cursor(before),
+        after=decode_history_cursor(after)
+    )
+    
+    async def render():
+        yield CHAT_HTML_HEAD
+        empty = True
+        async for msg in messages:
+            empty = False
+            yield render_chat_message(msg)
+        if empty:
+            yield '<div class="empty">Нет сообщений</div>'
+        yield CHAT_HTML_TAIL
     
-    html += """
-        </div>
-    </body>
-    </html>
+    return StreamingResponse(
+        render(),
+        media_type="text/html; charset=utf-8",
+        headers={"ETag": etag}
+    )
+
+
+@app.get("/api/conversations/{client_id}/events")
+async def stream_client_conversations(
+    request: Request,
+    client_id: int,
+    last_id: Optional[int] = None
+):
+    """
+    Новые сообщения переписки (Server-Sent Events).
+    Продолжает с last_id или заголовка Last-Event-ID (переподключение
+    EventSource); без них — только сообщения после подключения
     """
+    last_event_id = request.headers.get("Last-Event-ID")
+    if last_event_id and last_event_id.isdigit():
+        last_id = int(last_event_id)
     
-    from fastapi.responses import HTMLResponse
-    return HTMLResponse(content=html)
+    async def events():
+        yield "retry: 3000\n\n"
+        async for msg in conversation_feed.subscribe(client_id, last_id):
+            if await request.is_disconnected():
+                return
+            if msg is None:
+                yield ": ping\n\n"
+                continue
+            data = json.dumps(msg, ensure_ascii=False, default=str)
+            yield f"id: {msg['id']}\ndata: {data}\n\n"
+    
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
 
 
 def run_server():
@@ -2,10 +2,17 @@
 Модуль для работы с YClients API
 https://api.yclients.com/
 """
-import httpx
+import asyncio
+import time
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import AsyncIterator, Awaitable, Callable, NamedTuple, Optional
 from config import config
+from http_clients import http_clients
+from records import Record, SALON_TZ
+
+
+class YClientsError(Exception):
+    """API вернул success=false"""
 
 
 class YClientsAPI:
@@ -28,13 +35,16 @@ class YClientsAPI:
         start_date: Optional[datetime] = None,
         end_date: Optional[datetime] = None,
         page: int = 1,
-        count: int = 100
+        count: int = 100,
+        changed_after: Optional[datetime] = None
     ) -> dict:
         """
         Получить записи за период
+        (changed_after — только созданные/изменённые после этого момента;
+        уходит в API со смещением, наивное время считается временем сервера)
         """
         if not start_date:
-            start_date = datetime.now()
+            start_date = datetime.now(SALON_TZ)
         if not end_date:
             end_date = start_date + timedelta(days=7)
             
@@ -44,48 +54,135 @@ class YClientsAPI:
             "page": page,
             "count": count
         }
+        if changed_after:
+            params["changed_after"] = changed_after.astimezone(SALON_TZ).isoformat(timespec="seconds")
+        
+        client = http_clients.get("yclients")
+        response = await client.get(
+            f"{self.base_url}/records/{self.company_id}",
+            headers=self._get_headers(),
+            params=params
+        )
+        response.raise_for_status()
+        return response.json()
+    
+    async def _iter_pages(
+        self,
+        fetch_page: Callable[[int], Awaitable[dict]],
+        count: int
+    ) -> AsyncIterator[dict]:
+        """
+        Обойти все страницы списка.
+        Первая страница читается сразу и даёт meta.total_count, остальные
+        запрашиваются параллельно (не больше YCLIENTS_PAGE_CONCURRENCY
+        одновременно) и отдаются по мере получения.
+        """
+        first = await fetch_page(1)
+        if not first.get("success"):
+            raise YClientsError(f"Ошибка получения страницы 1: {first}")
         
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.base_url}/records/{self.company_id}",
-                headers=self._get_headers(),
-                params=params
+        items = first.get("data") or []
+        for item in items:
+            yield item
+        
+        total = (first.get("meta") or {}).get("total_count")
+        if total is None:
+            # Без meta — читаем по одной странице, пока не придёт неполная
+            page = 1
+            while len(items) >= count:
+                page += 1
+                result = await fetch_page(page)
+                if not result.get("success"):
+                    raise YClientsError(f"Ошибка получения страницы {page}: {result}")
+                items = result.get("data") or []
+                for item in items:
+                    yield item
+            return
+        
+        pages = (int(total) + count - 1) // count
+        if pages <= 1:
+            return
+        
+        semaphore = asyncio.Semaphore(config.YCLIENTS_PAGE_CONCURRENCY)
+        
+        async def fetch(page: int) -> dict:
+            async with semaphore:
+                result = await fetch_page(page)
+            if not result.get("success"):
+                raise YClientsError(f"Ошибка получения страницы {page}: {result}")
+            return result
+        
+        tasks = [asyncio.create_task(fetch(page)) for page in range(2, pages + 1)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                result = await next_done
+                for item in result.get("data") or []:
+                    yield item
+        finally:
+            # Прервали обход или ошибка на странице — гасим остальные запросы
+            # и дожидаемся их, чтобы не осталось висящих задач и исключений
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def iter_records(
+        self,
+        start_date: Optional[datetime] = None,
+        end_date: Optional[datetime] = None,
+        count: int = 100,
+        changed_after: Optional[datetime] = None
+    ) -> AsyncIterator[dict]:
+        """
+        Все записи за период (все страницы).
+        При ошибке любой страницы бросает YClientsError — неполный список
+        нельзя использовать для поиска удалённых записей.
+        """
+        async def fetch_page(page: int) -> dict:
+            return await self.get_records(
+                start_date, end_date, page=page, count=count, changed_after=changed_after
             )
-            response.raise_for_status()
-            return response.json()
+        
+        return self._iter_pages(fetch_page, count)
+    
+    def iter_clients(self, count: int = 200) -> AsyncIterator[dict]:
+        """Все клиенты компании (все страницы)"""
+        async def fetch_page(page: int) -> dict:
+            return await self.get_clients(page=page, count=count)
+        
+        return self._iter_pages(fetch_page, count)
     
     async def get_record(self, record_id: int) -> dict:
         """Получить информацию о конкретной записи"""
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.base_url}/record/{self.company_id}/{record_id}",
-                headers=self._get_headers()
-            )
-            response.raise_for_status()
-            return response.json()
+        client = http_clients.get("yclients")
+        response = await client.get(
+            f"{self.base_url}/record/{self.company_id}/{record_id}",
+            headers=self._get_headers()
+        )
+        response.raise_for_status()
+        return response.json()
     
     async def get_client(self, client_id: int) -> dict:
         """Получить информацию о клиенте"""
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.base_url}/client/{self.company_id}/{client_id}",
-                headers=self._get_headers()
-            )
-            response.raise_for_status()
-            return response.json()
+        client = http_clients.get("yclients")
+        response = await client.get(
+            f"{self.base_url}/client/{self.company_id}/{client_id}",
+            headers=self._get_headers()
+        )
+        response.raise_for_status()
+        return response.json()
     
     async def get_clients(self, page: int = 1, count: int = 100) -> dict:
         """Получить список клиентов"""
         params = {"page": page, "count": count}
         
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.base_url}/clients/{self.company_id}",
-                headers=self._get_headers(),
-                params=params
-            )
-            response.raise_for_status()
-            return response.json()
+        client = http_clients.get("yclients")
+        response = await client.get(
+            f"{self.base_url}/clients/{self.company_id}",
+            headers=self._get_headers(),
+            params=params
+        )
+        response.raise_for_status()
+        return response.json()
     
     async def search_clients(self, phone: str = None, name: str = None) -> dict:
         """Поиск клиентов по телефону или имени"""
@@ -95,94 +192,119 @@ class YClientsAPI:
         if name:
             data["name"] = name
             
-        async with httpx.AsyncClient() as client:
-            response = await client.post(
-                f"{self.base_url}/clients/{self.company_id}/search",
-                headers=self._get_headers(),
-                json=data
-            )
-            response.raise_for_status()
-            return response.json()
+        client = http_clients.get("yclients")
+        response = await client.post(
+            f"{self.base_url}/clients/{self.company_id}/search",
+            headers=self._get_headers(),
+            json=data
+        )
+        response.raise_for_status()
+        return response.json()
     
     async def get_staff(self) -> dict:
         """Получить список сотрудников"""
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.base_url}/staff/{self.company_id}",
-                headers=self._get_headers()
-            )
-            response.raise_for_status()
-            return response.json()
+        client = http_clients.get("yclients")
+        response = await client.get(
+            f"{self.base_url}/staff/{self.company_id}",
+            headers=self._get_headers()
+        )
+        response.raise_for_status()
+        return response.json()
     
     async def get_services(self) -> dict:
         """Получить список услуг"""
-        async with httpx.AsyncClient() as client:
-            response = await client.get(
-                f"{self.base_url}/services/{self.company_id}",
-                headers=self._get_headers()
-            )
-            response.raise_for_status()
-            return response.json()
-    
-    async def get_upcoming_records(self, hours_ahead: int = 48) -> list:
-        """
-        Получить ближайшие записи для напоминаний
-        """
-        start_date = datetime.now()
-        end_date = start_date + timedelta(hours=hours_ahead)
-        
-        result = await self.get_records(start_date, end_date)
-        
-        if not result.get("success"):
-            return []
-        
-        records = result.get("data", [])
-        upcoming = []
-        
-        for record in records:
-            # Пропускаем отменённые записи
-            if record.get("deleted"):
-                continue
-            
-            # Парсим дату и время записи
-            record_datetime_str = f"{record.get('date')} {record.get('datetime', '').split(' ')[-1]}"
-            try:
-                record_datetime = datetime.strptime(record_datetime_str, "%Y-%m-%d %H:%M:%S")
-            except (ValueError, IndexError):
-                continue
-            
-            # Добавляем информацию о времени до визита
-            time_until = record_datetime - datetime.now()
-            record["minutes_until"] = int(time_until.total_seconds() / 60)
-            record["record_datetime"] = record_datetime
-            
-            upcoming.append(record)
-        
-        return sorted(upcoming, key=lambda x: x["record_datetime"])
+        client = http_clients.get("yclients")
+        response = await client.get(
+            f"{self.base_url}/services/{self.company_id}",
+            headers=self._get_headers()
+        )
+        response.raise_for_status()
+        return response.json()
     
     async def add_comment_to_record(self, record_id: int, comment: str) -> dict:
         """Добавить комментарий к записи (для хранения переписки)"""
-        async with httpx.AsyncClient() as client:
-            response = await client.put(
-                f"{self.base_url}/record/{self.company_id}/{record_id}",
-                headers=self._get_headers(),
-                json={"comment": comment}
-            )
-            response.raise_for_status()
-            return response.json()
+        client = http_clients.get("yclients")
+        response = await client.put(
+            f"{self.base_url}/record/{self.company_id}/{record_id}",
+            headers=self._get_headers(),
+            json={"comment": comment}
+        )
+        response.raise_for_status()
+        return response.json()
     
     async def confirm_record(self, record_id: int) -> dict:
         """Подтвердить запись клиентом (attendance_status = 1)"""
-        async with httpx.AsyncClient() as client:
-            response = await client.put(
-                f"{self.base_url}/record/{self.company_id}/{record_id}",
-                headers=self._get_headers(),
-                json={"attendance": 1}  # 1 = клиент подтвердил
+        client = http_clients.get("yclients")
+        response = await client.put(
+            f"{self.base_url}/record/{self.company_id}/{record_id}",
+            headers=self._get_headers(),
+            json={"attendance": 1}  # 1 = клиент подтвердил
+        )
+        response.raise_for_status()
+        return response.json()
+
+
+class Snapshot(NamedTuple):
+    """Загруженное окно записей"""
+    generation: int
+    fetched_at: float
+    window_start: datetime
+    window_end: datetime
+    records: list  # Record
+
+
+class RecordsSnapshot:
+    """
+    Снимок записей на RECORDS_WINDOW_DAYS дней вперёд в памяти — для полной
+    сверки в ReminderScheduler.poll_records. Пока снимок моложе max_age
+    (по умолчанию RECORDS_SNAPSHOT_TTL), API не вызывается, а одновременные
+    запросы ждут одну загрузку. generation растёт при каждой загрузке —
+    по нему сверка понимает, обработала ли она уже этот снимок.
+    Удалённые записи в снимок не попадают.
+    """
+    
+    def __init__(self, api: YClientsAPI):
+        self.api = api
+        self._snapshot: Optional[Snapshot] = None
+        self._lock = asyncio.Lock()
+    
+    def _is_fresh(self, max_age: float) -> bool:
+        return (
+            self._snapshot is not None
+            and time.monotonic() - self._snapshot.fetched_at < max_age
+        )
+    
+    async def get(self, max_age: Optional[float] = None) -> Snapshot:
+        """Снимок не старше max_age секунд (при необходимости загружается)"""
+        if max_age is None:
+            max_age = config.RECORDS_SNAPSHOT_TTL
+        if self._is_fresh(max_age):
+            return self._snapshot
+        
+        async with self._lock:
+            # Пока ждали, снимок мог загрузить другой вызов
+            if self._is_fresh(max_age):
+                return self._snapshot
+            
+            window_start = datetime.now(SALON_TZ)
+            window_end = window_start + timedelta(days=config.RECORDS_WINDOW_DAYS)
+            records = [
+                Record.from_api(record)
+                async for record in self.api.iter_records(window_start, window_end)
+                if not record.get("deleted")
+            ]
+            generation = self._snapshot.generation + 1 if self._snapshot else 1
+            self._snapshot = Snapshot(
+                generation=generation,
+                fetched_at=time.monotonic(),
+                window_start=window_start,
+                window_end=window_end,
+                records=records
             )
-            response.raise_for_status()
-            return response.json()
+            return self._snapshot
 
 
-# Синглтон для использования в других модулях
+# Синглтоны для использования в других модулях
 yclients = YClientsAPI()
+records_snapshot = RecordsSnapshot(yclients)
 
@@ -2,9 +2,9 @@
 Интеграция с чатом YClients
 Отправляет сообщения из Telegram в боковую панель чата YClients
 """
-import httpx
 import logging
 from config import config
+from http_clients import http_clients
 
 logger = logging.getLogger(__name__)
 
@@ -63,21 +63,21 @@ class YClientsChat:
             data["name"] = name
         
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.post(
-                    self.api_url,
-                    headers=headers,
-                    json=data,
-                    timeout=10.0
-                )
+            client = http_clients.get("yclients")
+            response = await client.post(
+                self.api_url,
+                headers=headers,
+                json=data,
+                timeout=10.0
+            )
+            
+            if response.status_code == 200:
+                logger.info(f"✅ Сообщение отправлено в чат YClients от {normalized_phone}")
+                return True
+            else:
+                logger.error(f"❌ Ошибка отправки в чат YClients: {response.status_code} - {response.text}")
+                return False
                 
-                if response.status_code == 200:
-                    logger.info(f"✅ Сообщение отправлено в чат YClients от {normalized_phone}")
-                    return True
-                else:
-                    logger.error(f"❌ Ошибка отправки в чат YClients: {response.status_code} - {response.text}")
-                    return False
-                    
         except Exception as e:
             logger.error(f"❌ Исключение при отправке в чат YClients: {e}")
             return False